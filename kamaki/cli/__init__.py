@@ -32,8 +32,10 @@
 # or implied, of GRNET S.A.command
 
 import logging
+import atexit
 from sys import argv, exit, stdout, stderr
-from os.path import basename, exists
+from os import makedirs
+from os.path import basename, exists, join, dirname
 from inspect import getargspec
 
 from kamaki.cli.argument import (
@@ -45,7 +47,8 @@ from kamaki.cli.utils import (
 from kamaki.cli.errors import CLIError, CLICmdSpecError
 from kamaki.cli import logger
 from kamaki.clients.astakos import CachedAstakosClient
-from kamaki.clients import ClientError, KamakiSSLError
+from kamaki.clients import (
+    ClientError, KamakiSSLError, TraceFile, add_trace_hook)
 from kamaki.clients.utils import https, escape_ctrl_chars
 
 
@@ -184,6 +187,46 @@ def _setup_logging(debug=False, verbose=False):
     kloger = logger.get_logger(__name__)
 
 
+def _setup_connection_pools(cnf):
+    """Apply the global.pool_* settings to all connection pools"""
+    settings = dict()
+    for key, cast in (
+            ('size', int), ('idle_timeout', float), ('max_lifetime', float)):
+        value = cnf.get('global', 'pool_%s' % key)
+        if value:
+            try:
+                settings[key] = cast(value)
+            except ValueError:
+                kloger.warning('Ignore invalid pool_%s value %s' % (
+                    key, value))
+    https.configure_pool(**settings)
+
+
+def _setup_tracing(cnf, debug=False):
+    """Trace all requests to global.trace_file, or to the cache directory
+    in debug mode"""
+    trace_file = cnf.get('global', 'trace_file')
+    if debug and not trace_file:
+        cache_dir = cnf.get('global', 'cache_dir')
+        trace_file = join(cache_dir, 'trace.jsonl') if cache_dir else None
+    if trace_file:
+        try:
+            if dirname(trace_file) and not exists(dirname(trace_file)):
+                makedirs(dirname(trace_file))
+        except OSError as ose:
+            kloger.warning('Failed to trace to %s: %s' % (trace_file, ose))
+            return
+        if debug:
+            print('Trace location: %s' % trace_file)
+        add_trace_hook(TraceFile(trace_file))
+
+
+def _log_pool_stats():
+    for netloc, stats in sorted(https.pool_stats().items()):
+        kloger.debug('Connections to %s: %s' % (netloc, ', '.join([
+            '%s=%s' % (k, round(stats[k], 3)) for k in https.POOL_COUNTERS])))
+
+
 def _check_config_version(cnf):
     guess = cnf.guess_version()
     if exists(cnf.path) and guess < 0.12:
@@ -250,6 +293,10 @@ def _init_session(arguments, is_non_api=False):
         warn = red('CA certifications path not set (insecure) ')
         kloger.warning(warn)
     https.patch_ignore_ssl(ignore_ssl)
+    _setup_connection_pools(_cnf)
+    _setup_tracing(_cnf, _debug)
+    if _debug:
+        atexit.register(_log_pool_stats)
 
     _check_config_version(_cnf.value)
 
@@ -309,13 +356,16 @@ def init_cached_authenticator(config_argument, cloud, logger):
         _cnf = config_argument.value
         url = _cnf.get_cloud(cloud, 'url')
         tokens = _cnf.get_cloud(cloud, 'token').split()
+        cache_dir = _cnf.get('global', 'cache_dir')
+        cache_file = join(cache_dir, 'astakos.cache') if cache_dir else None
         astakos, failed, help_message = None, [], []
         for token in tokens:
             try:
                 if astakos:
                     astakos.authenticate(token)
                 else:
-                    tmp_base = CachedAstakosClient(url, token)
+                    tmp_base = CachedAstakosClient(
+                        url, token, cache_file=cache_file)
                     from kamaki.cli.cmds import CommandInit
                     fake_cmd = CommandInit(dict(config=config_argument))
                     fake_cmd.client = astakos
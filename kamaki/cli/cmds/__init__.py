@@ -32,6 +32,7 @@
 # or implied, of GRNET S.A.command
 
 from sys import stdin, stdout, stderr, exit
+from os.path import join
 from traceback import format_exc
 
 from kamaki.cli.logger import get_logger
@@ -42,6 +43,9 @@ from kamaki.cli.argument import ValueArgument, ProgressBarArgument
 from kamaki.cli.errors import CLIInvalidArgument, CLIBaseUrlError
 from kamaki.cli.cmds import errors
 from kamaki.clients.utils import escape_ctrl_chars
+from kamaki.clients.pithos.hashindex import (
+    BlockHashIndex, UploadJournal, ListingIndex)
+from kamaki.clients.utils.cache import ResponseCache
 
 
 log = get_logger(__name__)
@@ -130,7 +134,24 @@ class CommandInit(object):
                 TOKEN = TOKEN or astakos.token
             else:
                 raise CLIBaseUrlError(service=service)
-        return cls(URL, TOKEN)
+        client = cls(URL, TOKEN)
+        self._set_timeouts(client, service)
+        client.response_cache = self._get_response_cache()
+        return client
+
+    def _set_timeouts(self, client, service):
+        """Apply the cloud <service>_connect_timeout and _read_timeout
+        settings, or the global connect_timeout and read_timeout ones
+        A value of 0 means no timeout
+        """
+        for key in ('connect_timeout', 'read_timeout'):
+            try:
+                value = self._custom_timeout(service, key) or self.config.get(
+                    'global', key)
+                if value:
+                    setattr(client, key.upper(), float(value) or None)
+            except Exception as e:
+                log.debug('Failed to read %s setting: %s' % (key, e))
 
     @errors.Astakos.project_id
     def _project_id_exists(self, project_id):
@@ -186,6 +207,10 @@ class CommandInit(object):
     def _custom_version(self, service):
         return self.config.get_cloud(self.cloud, '%s_version' % service)
 
+    @dont_raise(KeyError)
+    def _custom_timeout(self, service, key):
+        return self.config.get_cloud(self.cloud, '%s_%s' % (service, key))
+
     def _uuids2usernames(self, uuids):
         return self.astakos.post_user_catalogs(uuids)
 
@@ -220,6 +245,61 @@ class CommandInit(object):
             log.debug('Failed to read custom log_pid setting:'
                       '%s\n default for log_pid is off' % e)
 
+    def _get_block_hash_index(self):
+        """:returns: (BlockHashIndex) in global.cache_dir or None if not set"""
+        try:
+            cache_dir = self['config'].get('global', 'cache_dir')
+        except Exception as e:
+            log.debug('Failed to read cache_dir setting: %s' % e)
+            return None
+        return BlockHashIndex(
+            join(cache_dir, 'blockhashes.db')) if cache_dir else None
+
+    def _get_response_cache(self):
+        """:returns: (ResponseCache) in global.cache_dir, if
+            global.cache_responses is on, otherwise None
+        """
+        try:
+            if self['config'].get(
+                    'global', 'cache_responses').lower() != 'on':
+                return None
+            cache_dir = self['config'].get('global', 'cache_dir')
+        except Exception as e:
+            log.debug('Failed to read cache_responses setting: %s' % e)
+            return None
+        return ResponseCache(
+            join(cache_dir, 'responses.db')) if cache_dir else None
+
+    def _get_listing_index(self):
+        """:returns: (ListingIndex) in global.cache_dir, if
+            global.listing_index is on, otherwise None
+        """
+        try:
+            if self['config'].get('global', 'listing_index').lower() != 'on':
+                return None
+            cache_dir = self['config'].get('global', 'cache_dir')
+        except Exception as e:
+            log.debug('Failed to read listing_index setting: %s' % e)
+            return None
+        try:
+            max_age = float(
+                self['config'].get('global', 'listing_index_max_age') or 0)
+        except Exception as e:
+            log.debug('Failed to read listing_index_max_age setting: %s' % e)
+            max_age = 0
+        return ListingIndex(
+            join(cache_dir, 'listings.db'), max_age) if cache_dir else None
+
+    def _get_upload_journal(self):
+        """:returns: (UploadJournal) in global.cache_dir or None if not set"""
+        try:
+            cache_dir = self['config'].get('global', 'cache_dir')
+        except Exception as e:
+            log.debug('Failed to read cache_dir setting: %s' % e)
+            return None
+        return UploadJournal(
+            join(cache_dir, 'uploads.db')) if cache_dir else None
+
     def _safe_progress_bar(
             self, msg, arg='progress_bar', countdown=False, timeout=100):
         """Try to get a progress bar, but do not raise errors"""
@@ -40,7 +40,8 @@ from pydoc import pager
 from kamaki.cli import command
 from kamaki.cli.cmdtree import CommandTree
 from kamaki.cli.utils import remove_from_items, filter_dicts_by_dict
-from kamaki.cli.errors import raiseCLIError, CLISyntaxError, CLIInvalidArgument
+from kamaki.cli.errors import (
+    raiseCLIError, CLIError, CLISyntaxError, CLIInvalidArgument)
 from kamaki.clients.cyclades import (
     CycladesComputeClient, ClientError, CycladesNetworkClient)
 from kamaki.cli.argument import (
@@ -723,7 +724,9 @@ class server_delete(_CycladesInit, _ServerWait):
             '(DANGEROUS) Delete all VMs with names starting with the cluster '
             'prefix. Do not use it if unsure. Syntax:'
             ' kamaki server delete --cluster CLUSTER_PREFIX',
-            '--cluster')
+            '--cluster'),
+        max_threads=IntArgument(
+            'Max threads in cluster mode (default 5)', '--threads')
     )
 
     def _server_ids(self, server_var):
@@ -743,17 +746,32 @@ class server_delete(_CycladesInit, _ServerWait):
         if self['wait']:
             self.wait_while(server_id, status)
 
+    def _delete_cluster(self, server_ids):
+        """Delete servers concurrently, report the ones that failed"""
+        deleted, failed = self.client.delete_servers(
+            server_ids, max_threads=self['max_threads'] or 5)
+        for server_id, error in failed.items():
+            self.error('Failed to delete server %s: %s' % (server_id, error))
+        return [s for s in server_ids if s in deleted]
+
     @errors.Generic.all
     @errors.Cyclades.connection
     def _run(self, server_var):
-        deleted_vms = []
-        for server_id in self._server_ids(server_var):
-            self._delete_server(server_id=server_id)
-            deleted_vms.append(server_id)
+        server_ids = self._server_ids(server_var)
+        if self['cluster'] and not self['wait']:
+            deleted_vms = self._delete_cluster(server_ids)
+        else:
+            deleted_vms = []
+            for server_id in server_ids:
+                self._delete_server(server_id=server_id)
+                deleted_vms.append(server_id)
         if self['cluster']:
             dlen = len(deleted_vms)
             self.error('%s virtual server %s deleted' % (
                 dlen, '' if dlen == 1 else 's'))
+            if dlen < len(server_ids):
+                raise CLIError('Failed to delete %s virtual servers' % (
+                    len(server_ids) - dlen))
 
     def main(self, server_id_or_cluster_prefix):
         super(self.__class__, self)._run()
@@ -44,6 +44,15 @@ log = getLogger(__name__)
 CLOUDNAME = ['Note: Set a cloud and use its name instead of "default"']
 
 
+def _expire_cached_token(cmd):
+    """Make sure a rejected token will not be reused from the cache"""
+    astakos = getattr(cmd, 'astakos', None)
+    try:
+        astakos.expire_token(getattr(cmd.client, 'token', None))
+    except Exception as e:
+        log.debug('Failed to expire cached token: %s' % e)
+
+
 class Generic(object):
 
     @classmethod
@@ -77,6 +86,7 @@ class Generic(object):
             except ClientError as ce:
                 ce_msg = ('%s' % ce).lower()
                 if ce.status == 401:
+                    _expire_cached_token(self)
                     raise CLIError('Authorization failed', details=[
                         'To check if token is valid',
                         '  kamaki user authenticate',
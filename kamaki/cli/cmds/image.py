@@ -493,7 +493,9 @@ class image_register(_ImageInit, OptionalOutput):
                 pithos.upload_object(
                     locator.path, f,
                     hash_cb=hash_cb, upload_cb=upload_cb,
-                    container_info_cache=self.container_info_cache)
+                    container_info_cache=self.container_info_cache,
+                    hash_index=self._get_block_hash_index(),
+                    journal=self._get_upload_journal())
                 pbar.finish()
 
         (params, properties, new_loc) = self._load_params_from_file(location)
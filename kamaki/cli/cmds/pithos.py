@@ -31,8 +31,9 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.command
 
-from time import localtime, strftime
+from time import localtime, strftime, time
 from io import StringIO
+from itertools import chain
 from pydoc import pager
 from os import path, walk, makedirs
 from threading import activeCount, enumerate as activethreads
@@ -95,6 +96,7 @@ class _PithosInit(CommandInit):
         self.client.account = self.account
         self.container = self._custom_container() or 'pithos'
         self.client.container = self.container
+        self.client.listing_index = self._get_listing_index()
 
     def main(self):
         self._run()
@@ -109,11 +111,19 @@ class _PithosAccount(_PithosInit):
             'A user UUID or name', ('-A', '--account'))
         self.arguments['account'].account_client = astakos
 
-    def print_objects(self, object_list):
+    def print_objects(self, object_list, count=None):
+        """
+        :param count: (int) the max number of objects, to align the --enum
+            indices when object_list is a generator (default: its length)
+        """
+        if count is None:
+            count = len(object_list) if (
+                hasattr(object_list, '__len__')) else 0
+        width = len(str(count)) if count else 0
         for index, obj in enumerate(object_list):
             pretty_obj = obj.copy()
             index += 1
-            empty_space = ' ' * (len(str(len(object_list))) - len(str(index)))
+            empty_space = ' ' * (width - len(str(index)))
             if 'subdir' in obj:
                 continue
             if self.object_is_dir(obj):
@@ -241,7 +251,9 @@ class file_info(_PithosContainer, OptionalOutput):
                 r = self.version_print(
                     self.client.get_object_versionlist(self.path))
             else:
-                r = self.client.get_object_info(
+                r = None if self['object_version'] else (
+                    self.client.get_indexed_object_info(self.path))
+                r = r or self.client.get_object_info(
                     self.path, version=self['object_version'])
         except ClientError as ce:
             if ce.status in (404, ):
@@ -285,8 +297,8 @@ class file_list(_PithosContainer, OptionalOutput, NameFilter):
 
     @errors.Pithos.container
     def _container_info(self):
-        r = self.client.container_get(
-            limit=False if self['more'] else self['limit'],
+        objects = self.client.iter_objects(
+            limit=None if self['more'] else self['limit'],
             marker=self['marker'],
             prefix=self.path,
             delimiter=self['delimiter'],
@@ -297,15 +309,26 @@ class file_list(_PithosContainer, OptionalOutput, NameFilter):
             if_unmodified_since=self['if_unmodified_since'],
             until=self['until'],
             meta=self['meta'])
-        files = list(r.json or [])
-        return files
+        try:
+            return chain([next(objects)], objects)
+        except StopIteration:
+            return []
+
+    def _object_count(self):
+        """The max number of listed objects, without consuming the listing"""
+        if not self['enum']:
+            return None
+        if self['limit'] and not self['more']:
+            return self['limit']
+        info = self.client.get_container_info(until=self['until'])
+        return int(info.get('x-container-object-count', 0))
 
     @errors.Generic.all
     @errors.Pithos.connection
     @errors.Pithos.object_path
     def _run(self):
-        r = self._container_info()
-        if not r:
+        objects = self._container_info()
+        if not objects:
             if self.path:
                 obj_path = '/%s/%s' % (self.container, self.path)
                 obj_info = self.client.get_object_info(self.path)
@@ -328,14 +351,15 @@ class file_list(_PithosContainer, OptionalOutput, NameFilter):
             else:
                 self.error('Container "%s" is empty' % self.client.container)
 
-        files = self._filter_by_name(r)
+        files = (obj for obj in objects if (
+            self._filter_by_name([obj])))
         if self['more']:
             outbu, self._out = self._out, StringIO()
         try:
             if self['output_format']:
-                self.print_(files)
+                self.print_(list(files))
             else:
-                self.print_objects(files)
+                self.print_objects(files, self._object_count())
         finally:
             if self['more']:
                 pager(self._out.getvalue())
@@ -563,7 +587,9 @@ class _PithosFromTo(_PithosContainer):
         force=FlagArgument(
             'Overwrite destination objects, if needed', ('-f', '--force')),
         source_version=ValueArgument(
-            'The version of the source object', '--source-version')
+            'The version of the source object', '--source-version'),
+        max_threads=IntArgument(
+            'default: 5 (concurrent transfers with --recursive)', '--threads')
     )
 
     def __init__(self, arguments={}, astakos=None, cloud=None):
@@ -590,6 +616,44 @@ class _PithosFromTo(_PithosContainer):
         else:
             self.error('  mkdir %s' % full_dest_path)
 
+    def _transfer_objects(self, transfer_name):
+        """Transfer all the objects under the source path at once. Objects
+        which exist in the destination with the same hash are skipped, so a
+        partial transfer is resumed by running it again"""
+        self.client.MAX_THREADS = int(self['max_threads'] or 5)
+        failed, transferred, size, start = [], 0, 0, time()
+        for obj, dst, action, error in self.client.copy_objects(
+                self.dst_client.container,
+                prefix=self.path,
+                dst_prefix=self.dst_path or self.path,
+                dst_account=self.dst_client.account,
+                move=transfer_name in ('move', ),
+                overwrite=self['force'],
+                public=self['public'],
+                content_type=self['content_type']):
+            if error:
+                failed.append('%s: %s' % (obj['name'], error))
+                self.error('  %s %s failed: %s' % (
+                    transfer_name, obj['name'], error))
+            elif action in ('skip', ):
+                self.error('  %s %s (already transferred)' % (
+                    'delete' if transfer_name in ('move', ) else 'skip',
+                    obj['name']))
+            else:
+                self._report_transfer(obj['name'], dst, transfer_name)
+                transferred += 1
+                size += int(obj.get('bytes') or 0)
+        elapsed = max(time() - start, 0.001)
+        self.error('%s objects (%s) transferred in %.2f seconds (%s/s)' % (
+            transferred, format_size(size), elapsed,
+            format_size(int(size / elapsed))))
+        if failed:
+            raise CLIError(
+                'Failed to %s %s objects' % (transfer_name, len(failed)),
+                details=failed[:10] + [
+                    'To overwrite destination objects, use %s' % (
+                        self.arguments['force'].lvalue)])
+
     @errors.Generic.all
     @errors.Pithos.account
     def _src_dst(self, version=None):
@@ -721,6 +785,8 @@ class file_copy(_PithosFromTo):
     @errors.Pithos.container
     @errors.Pithos.account
     def _run(self):
+        if self['source_prefix'] and not self['source_version']:
+            return self._transfer_objects('copy')
         for src, dst in self._src_dst(self['source_version']):
             self._report_transfer(src, dst, 'copy')
             if src and dst:
@@ -757,6 +823,8 @@ class file_move(_PithosFromTo):
     @errors.Pithos.container
     @errors.Pithos.account
     def _run(self):
+        if self['source_prefix'] and not self['source_version']:
+            return self._transfer_objects('move')
         for src, dst in self._src_dst():
             self._report_transfer(src, dst, 'move')
             if src and dst:
@@ -926,6 +994,14 @@ class file_upload(_PithosContainer):
             'Confirm upload with a custom checksum (MD5)', '--etag'),
         use_hashes=FlagArgument(
             'Source file contains hashmap not data', '--source-is-hashmap'),
+        pipeline=IntArgument(
+            'Upload blocks while hashing them, keeping up to N blocks in '
+            'memory (faster for large new files, not resumable)',
+            '--pipeline'),
+        max_files=IntArgument(
+            'With -r, upload up to N files at the same time, sharing the '
+            '--threads connections (default: as many as --threads)',
+            '--parallel-files'),
     )
 
     def _sharing(self):
@@ -938,11 +1014,12 @@ class file_upload(_PithosContainer):
             sharing['write'] = self['uuid_for_write_permission']
         return sharing or None
 
-    def _check_container_limit(self, path):
-        cl_dict = self.client.get_container_limit()
-        container_limit = int(cl_dict['x-container-policy-quota'])
-        r = self.client.container_get()
-        used_bytes = sum(int(o['bytes']) for o in r.json)
+    def _check_container_limit(self, path, container_info_cache=None):
+        info = self.client.get_container_info()
+        if isinstance(container_info_cache, dict):
+            container_info_cache[self.client.container] = info
+        container_limit = int(info.get('x-container-policy-quota', 0))
+        used_bytes = int(info.get('x-container-bytes-used', 0))
         path_size = get_path_size(path)
         if container_limit and path_size > (container_limit - used_bytes):
             raise CLIError(
@@ -960,7 +1037,11 @@ class file_upload(_PithosContainer):
                     '\t/file containerlimit set <new limit> %s' % (
                         self.client.container)])
 
-    def _src_dst(self, local_path, remote_path, objlist=None):
+    def _src_dst(self, local_path, remote_path, container_info_cache=None):
+        """:returns: (list, list) the remote directories to create and the
+            (local file path, remote object path) pairs to upload
+        """
+        dirs, files = [], []
         lpath = path.abspath(local_path)
         short_path = path.basename(path.abspath(local_path))
         rpath = remote_path or short_path
@@ -989,24 +1070,19 @@ class file_upload(_PithosContainer):
                     except ClientError as ce:
                         if ce.status not in (404, ):
                             raise
-            self._check_container_limit(lpath)
-            prev = ''
-            for top, subdirs, files in walk(lpath):
-                if top != prev:
-                    prev = top
-                    try:
-                        rel_path = rpath + top.split(lpath)[1]
-                    except IndexError:
-                        rel_path = rpath
-                    self.error('mkdir /%s/%s' % (
-                        self.client.container, rel_path))
-                    self.client.create_directory(rel_path)
-                for f in files:
+            self._check_container_limit(lpath, container_info_cache)
+            for top, subdirs, fnames in walk(lpath):
+                try:
+                    rel_path = rpath + top.split(lpath)[1]
+                except IndexError:
+                    rel_path = rpath
+                dirs.append(rel_path)
+                for f in fnames:
                     fpath = path.join(top, f)
                     if path.isfile(fpath):
                         rel_path = rel_path.replace(path.sep, '/')
                         pathfix = f.replace(path.sep, '/')
-                        yield open(fpath, 'rb'), '%s/%s' % (rel_path, pathfix)
+                        files.append((fpath, '%s/%s' % (rel_path, pathfix)))
                     else:
                         self.error('%s not a regular file' % fpath)
         else:
@@ -1028,8 +1104,75 @@ class file_upload(_PithosContainer):
                     self._container_exists()
                 else:
                     raise
-            self._check_container_limit(lpath)
-            yield open(lpath, 'rb'), rpath
+            self._check_container_limit(lpath, container_info_cache)
+            files.append((lpath, rpath))
+        return dirs, files
+
+    def _file_params(self, fpath, params):
+        if self['content_type'] and self['content_encoding']:
+            return params
+        ctype, cenc = guess_mime_type(fpath)
+        return dict(
+            params,
+            content_type=self['content_type'] or ctype,
+            content_encoding=self['content_encoding'] or cenc)
+
+    def _cancel(self):
+        self.client.executor.shutdown()
+        timeout = 0.5
+        msg = '\n'
+        while activeCount() > 1:
+            msg += 'Wait for %s threads: ' % (activeCount() - 1)
+            self._err.write(msg)
+            for thread in activethreads():
+                try:
+                    thread.join(timeout)
+                    self._err.write('.' if thread.isAlive() else '*')
+                    self._err.flush()
+                except RuntimeError:
+                    continue
+                finally:
+                    timeout += 0.1
+                    self._err.flush()
+                    msg = '\b' * len(msg)
+        raise CLIError('Upload canceled by user')
+
+    def _upload_files(self, files, params, rpref, **kwargs):
+        """Upload many files at once, report each file as it completes"""
+        failed = []
+        progress_bar, upload_cb = self._safe_progress_bar(
+            'Uploading %s files' % len(files))
+        if upload_cb:
+            upload_gen = upload_cb(len(files))
+            upload_gen.next()
+        uploads = [(fpath, rpath, self._file_params(fpath, params)) for (
+            fpath, rpath) in files]
+        try:
+            for fpath, rpath, headers, error in self.client.upload_objects(
+                    uploads, max_files=self['max_files'], **kwargs):
+                if error:
+                    failed.append('%s: %s' % (fpath, error))
+                    self.error('%s --> failed: %s' % (fpath, error))
+                    continue
+                self.error('%s --> %s/%s/%s' % (
+                    fpath, rpref, self.client.container, rpath))
+                if upload_cb:
+                    try:
+                        upload_gen.next()
+                    except Exception:
+                        pass
+                if self['public']:
+                    obj = self.client.get_object_info(rpath)
+                    self.write('%s\n' % obj.get('x-object-public', ''))
+        except KeyboardInterrupt:
+            self._safe_progress_bar_finish(progress_bar)
+            self._cancel()
+        finally:
+            self._safe_progress_bar_finish(progress_bar)
+        if failed:
+            raise CLIError(
+                'Failed to upload %s of %s files' % (len(failed), len(files)),
+                details=failed[:10])
 
     def _run(self, local_path, remote_path):
         self.client.MAX_THREADS = int(self['max_threads'] or 5)
@@ -1040,14 +1183,34 @@ class file_upload(_PithosContainer):
             sharing=self._sharing(),
             public=self['public'])
         container_info_cache = dict()
+        hash_index = self._get_block_hash_index()
+        journal = self._get_upload_journal()
         rpref = 'pithos://%s' if self['account'] else ''
-        for f, rpath in self._src_dst(local_path, remote_path):
+        dirs, files = self._src_dst(
+            local_path, remote_path, container_info_cache)
+        for rpath in dirs:
+            self.error('mkdir /%s/%s' % (self.client.container, rpath))
+        if dirs:
+            errors = self.client.create_directories(dirs)[1]
+            if errors:
+                raise CLIError(
+                    'Failed to create %s directories' % len(errors),
+                    details=['%s: %s' % (rpath, e) for rpath, e in sorted(
+                        errors.items())][:10])
+        if dirs and not self['unchunked']:
+            self._upload_files(
+                files, params, rpref,
+                container_info_cache=container_info_cache,
+                hash_index=hash_index,
+                pipeline=self['pipeline'],
+                journal=journal)
+            self.error('Upload completed')
+            return
+        for fpath, rpath in files:
+            f = open(fpath, 'rb')
             self.error('%s --> %s/%s/%s' % (
                 f.name, rpref, self.client.container, rpath))
-            if not (self['content_type'] and self['content_encoding']):
-                ctype, cenc = guess_mime_type(f.name)
-                params['content_type'] = self['content_type'] or ctype
-                params['content_encoding'] = self['content_encoding'] or cenc
+            params = self._file_params(f.name, params)
             if self['unchunked']:
                 self.client.upload_object_unchunked(
                     rpath, f,
@@ -1068,26 +1231,12 @@ class file_upload(_PithosContainer):
                         hash_cb=hash_cb,
                         upload_cb=upload_cb,
                         container_info_cache=container_info_cache,
+                        hash_index=hash_index,
+                        pipeline=self['pipeline'],
+                        journal=journal,
                         **params)
                 except KeyboardInterrupt:
-                    timeout = 0.5
-                    msg = '\n'
-                    while activeCount() > 1:
-                        msg += 'Wait for %s threads: ' % (activeCount() - 1)
-                        self._err.write(msg)
-                        for thread in activethreads():
-                            try:
-                                thread.join(timeout)
-                                self._err.write(
-                                    '.' if thread.isAlive() else '*')
-                                self._err.flush()
-                            except RuntimeError:
-                                continue
-                            finally:
-                                timeout += 0.1
-                                self._err.flush()
-                                msg = '\b' * len(msg)
-                    raise CLIError('Upload canceled by user')
+                    self._cancel()
                 except Exception:
                     self._safe_progress_bar_finish(progress_bar)
                     raise
@@ -1216,10 +1365,10 @@ class file_download(_PithosContainer):
         )
 
     def _src_dst(self, local_path):
-        """Create a list of (src, dst) where src is a remote location and dst
-        is an open file descriptor. Directories are denoted as (None, dirpath)
-        and they are pretended to other objects in a very strict order (shorter
-        to longer path)."""
+        """Create a list of (src, dst, resume, size) where src is a remote
+        location and dst a local path. Directories are denoted as
+        (None, dirpath, None, None) and they are pretended to other objects in
+        a very strict order (shorter to longer path)."""
         ret, obj = [], None
         try:
             if self.path:
@@ -1258,17 +1407,20 @@ class file_download(_PithosContainer):
                     local_path = '%s/' % (local_path or self.container)
                 obj = obj or dict(
                     name='', content_type='application/directory')
+                #  Keep only names and sizes, the listing can be huge
                 dirs, files = [], []
-                objects = self.client.container_get(
-                    prefix=rpath,
-                    if_modified_since=self['modified_since_date'],
-                    if_unmodified_since=self['unmodified_since_date'])
-                for o in objects.json:
-                    (dirs if self.object_is_dir(o) else files).append(o)
+                for o in self.client.iter_objects(
+                        prefix=rpath,
+                        if_modified_since=self['modified_since_date'],
+                        if_unmodified_since=self['unmodified_since_date']):
+                    if self.object_is_dir(o):
+                        dirs.append(o['name'])
+                    else:
+                        files.append((o['name'], o.get('bytes')))
 
                 #  Put the directories on top of the list
                 for dpath in sorted(['%s%s' % (
-                        local_path, d['name'][len(rpath):]) for d in dirs]):
+                        local_path, d[len(rpath):]) for d in dirs]):
                     if path.exists(dpath):
                         if path.isdir(dpath):
                             continue
@@ -1278,10 +1430,10 @@ class file_download(_PithosContainer):
                             details=[
                                 'Either remove the file or specify a'
                                 'different target location'])
-                    ret.append((None, dpath, None))
+                    ret.append((None, dpath, None, None))
 
                 #  Append the file objects
-                for opath in [o['name'] for o in files]:
+                for opath, size in files:
                     lpath = '%s%s' % (local_path, opath[len(rpath):])
                     if self['resume']:
                         fxists = path.exists(lpath)
@@ -1292,14 +1444,14 @@ class file_download(_PithosContainer):
                                 details=[
                                     'Either remove the file or specify a'
                                     'different target location'])
-                        ret.append((opath, lpath, fxists))
+                        ret.append((opath, lpath, fxists, size))
                     elif path.exists(lpath):
                         raise CLIError(
                             'Cannot overwrite %s' % lpath,
                             details=['To overwrite/resume, use  %s' % (
                                 self.arguments['resume'].lvalue)])
                     else:
-                        ret.append((opath, lpath, None))
+                        ret.append((opath, lpath, None, size))
             elif self.path:
                 raise CLIError(
                     'Remote object /%s/%s is a directory' % (
@@ -1328,7 +1480,7 @@ class file_download(_PithosContainer):
                 for d in dirs[:-1]:
                     pref += d
                     if not path.exists(pref):
-                        ret.append((None, d, None))
+                        ret.append((None, d, None, None))
                     elif not path.isdir(pref):
                         raise CLIError(
                             'Failed to use %s as a destination' % local_path,
@@ -1339,14 +1491,63 @@ class file_download(_PithosContainer):
                                 'directories or non-existing names',
                                 'Either remove the file, or choose another '
                                 'destination'])
-            ret.append((rpath, local_path, self['resume']))
-        for r, l, resume in ret:
+            ret.append((rpath, local_path, self['resume'], None))
+        return ret
+
+    def _open_dst(self, src_dst):
+        """Open each local file before its object is downloaded"""
+        for r, l, resume, size in src_dst:
             if r:
                 with open(l, 'rwb+' if resume else 'wb+') as f:
                     yield (r, f)
             else:
                 yield (r, l)
 
+    def _parallel(self):
+        """Trees are downloaded as a whole, unless the objects must be
+        downloaded one by one (e.g., to resume or to check their ETags or
+        modification dates)"""
+        return self['recursive'] and not any([self[term] for term in (
+            'resume', 'range', 'object_version',
+            'matching_etag', 'non_matching_etag',
+            'modified_since_date', 'unmodified_since_date')])
+
+    def _download_objects(self, src_dst):
+        """Download many objects at once, report each file as it completes"""
+        files = []
+        for rpath, lpath, resume, size in src_dst:
+            if rpath:
+                files.append((rpath, lpath, size))
+            else:
+                self.error('Create local directory %s' % lpath)
+                makedirs(lpath)
+        failed = []
+        progress_bar, download_cb = self._safe_progress_bar(
+            'Downloading %s files' % len(files))
+        if download_cb:
+            download_gen = download_cb(len(files))
+            download_gen.next()
+        try:
+            for rpath, lpath, error in self.client.download_objects(files):
+                if error:
+                    failed.append('%s: %s' % (rpath, error))
+                    self.error('/%s/%s --> failed: %s' % (
+                        self.container, rpath, error))
+                    continue
+                self.error('/%s/%s --> %s' % (self.container, rpath, lpath))
+                if download_cb:
+                    try:
+                        download_gen.next()
+                    except Exception:
+                        pass
+        finally:
+            self._safe_progress_bar_finish(progress_bar)
+        if failed:
+            raise CLIError(
+                'Failed to download %s of %s files' % (
+                    len(failed), len(files)),
+                details=failed[:10])
+
     @errors.Generic.all
     @errors.Pithos.connection
     @errors.Pithos.container
@@ -1357,7 +1558,11 @@ class file_download(_PithosContainer):
         self.client.MAX_THREADS = int(self['max_threads'] or 5)
         progress_bar = None
         try:
-            for rpath, output_file in self._src_dst(local_path):
+            src_dst = self._src_dst(local_path)
+            if self._parallel():
+                self._download_objects(src_dst)
+                src_dst = []
+            for rpath, output_file in self._open_dst(src_dst):
                 if not rpath:
                     self.error('Create local directory %s' % output_file)
                     makedirs(output_file)
@@ -1377,6 +1582,7 @@ class file_download(_PithosContainer):
                     if_modified_since=self['modified_since_date'],
                     if_unmodified_since=self['unmodified_since_date'])
         except KeyboardInterrupt:
+            self.client.executor.shutdown()
             timeout = 0.5
             msg = '\n'
             while activeCount() > 1:
@@ -1708,7 +1914,7 @@ class container_empty(_PithosAccount):
     def _run(self):
         if self['yes'] or self.ask_user(
                 'Empty container %s ?' % self.container):
-            self.client.del_container(delimiter='/')
+            self.client.empty_container()
 
     def main(self, container):
         super(self.__class__, self)._run()
@@ -58,6 +58,7 @@ log = getLogger(__name__)
 # Path to the file that stores the configuration
 CONFIG_PATH = os.path.expanduser('~/.kamakirc')
 HISTORY_PATH = os.path.expanduser('~/.kamaki.history')
+CACHE_PATH = os.path.expanduser('~/.kamaki')
 CLOUD_PREFIX = 'cloud'
 
 # Name of a shell variable to bypass the CONFIG_PATH value
@@ -88,6 +89,9 @@ DEFAULTS = {
         'log_pid': 'off',
         'history_file': HISTORY_PATH,
         'history_limit': 0,
+        'cache_dir': CACHE_PATH,
+        'cache_responses': 'off',
+        'listing_index': 'off',
         'user_cli': 'astakos',
         'quota_cli': 'astakos',
         'resource_cli': 'astakos',
@@ -32,14 +32,18 @@
 
 from urllib2 import quote, unquote
 from urlparse import urlparse
-from threading import Thread
+from threading import Thread, Condition, Lock, local, current_thread
+from Queue import Queue, Empty, Full
 from json import dumps, loads
 from time import time
 from httplib import ResponseNotReady, HTTPException
+from socket import error as SocketError
 from time import sleep
 from random import random
-from logging import getLogger
+from logging import getLogger, INFO
 import ssl
+import sys
+import zlib
 
 from kamaki.clients.utils import https
 
@@ -104,6 +108,63 @@ class KamakiSSLError(ClientError):
     """SSL Connection Error"""
 
 
+class DeadlineExceeded(ClientError):
+    """The operation did not finish before its deadline"""
+
+
+_deadlines = local()
+
+
+def get_deadline():
+    """:returns: (float) the time (epoch) by which the operations of the
+        current thread must finish, or None if there is no deadline
+    """
+    return getattr(_deadlines, 'value', None)
+
+
+def time_left():
+    """:returns: (float) seconds until the deadline, or None
+
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return None
+    left = deadline - time()
+    if left <= 0:
+        raise DeadlineExceeded('Operation exceeded its deadline by %.3fs' % (
+            -left))
+    return left
+
+
+class Deadline(object):
+    """Limit the total duration of the client operations in a with block
+
+    The requests of the block (and of the threads it runs jobs on) fail with
+    DeadlineExceeded when the deadline passes, their socket timeouts are
+    capped to the time left, and parallel operations stop queuing work.
+
+        with Deadline(600):
+            pithos.download_object('obj', f)
+
+    An inner deadline cannot extend an outer one.
+    """
+
+    def __init__(self, seconds):
+        """:param seconds: (float) the maximum duration of the block"""
+        self.seconds = seconds
+
+    def __enter__(self):
+        self._outer = get_deadline()
+        deadline = time() + self.seconds
+        _deadlines.value = deadline if self._outer is None else min(
+            deadline, self._outer)
+        return self
+
+    def __exit__(self, *exc_info):
+        _deadlines.value = self._outer
+
+
 class Logged(object):
 
     LOG_TOKEN = False
@@ -115,6 +176,8 @@ class Logged(object):
 class RequestManager(Logged):
     """Handle http request information"""
 
+    connect_timeout, read_timeout = None, None
+
     def _connection_info(self, url, path, params={}):
         """ Set self.url to scheme://netloc/?params
         :param url: (str or unicode) The service url
@@ -163,8 +226,9 @@ class RequestManager(Logged):
         if self.data:
             sendlog.info('data size: %s%s' % (len(self.data), plog))
             if self.LOG_DATA:
-                sendlog.info(utils.escape_ctrl_chars(self.data.replace(
-                    self._token, '...') if self._token else self.data))
+                data = '%s' % self.data
+                sendlog.info(utils.escape_ctrl_chars(data.replace(
+                    self._token, '...') if self._token else data))
         else:
             sendlog.info('data size: 0%s' % plog)
 
@@ -186,7 +250,13 @@ class RequestManager(Logged):
         :returns: (HTTPResponse)
         """
         self._encode_headers()
-        self.dump_log()
+        if sendlog.isEnabledFor(INFO):
+            self.dump_log()
+        #  Pooled connections are shared, so timeouts are set per request
+        conn.timeout, conn.read_timeout = (
+            self.connect_timeout, self.read_timeout)
+        if conn.sock is not None:
+            conn.sock.settimeout(self.read_timeout)
         try:
             conn.request(
                 method=self.method.upper(),
@@ -231,30 +301,104 @@ class RequestManager(Logged):
 class ResponseManager(Logged):
     """Manage the http request and handle the response data, headers, etc."""
 
-    def __init__(self, request, poolsize=None, connection_retry_limit=0):
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(
+            self, request,
+            poolsize=None, connection_retry_limit=0, stream=False):
         """
         :param request: (RequestManager)
 
         :param poolsize: (int) the size of the connection pool
 
         :param connection_retry_limit: (int)
+
+        :param stream: (bool) if set, the response body is not read in
+            advance. It is streamed with iter_content instead, while the
+            connection is kept out of the pool until the body is consumed or
+            the response is closed
         """
         self.CONNECTION_TRY_LIMIT = 1 + connection_retry_limit
         self.request = request
         self._request_performed = False
         self.poolsize = poolsize
+        self.stream = stream
+        self._stream, self._pooled, self._content = None, None, None
+        self._status, self._headers = None, None
         self._headers_to_decode, self._header_prefices = [], []
+        self.trace_hooks, self.trace_tags, self._trace = [], dict(), None
+        self._decompressor = None
+
+    def _decode_headers(self, headers):
+        decode, prefices = set(self.headers_to_decode), tuple(
+            self.header_prefices)
+        decoded = dict()
+        for k, v in headers:
+            key = k.lower()
+            decoded[k] = unquote(v).decode('utf-8') if (
+                key in decode or key.startswith(prefices)) else v
+        return decoded
+
+    def _log_response(self, plog):
+        recvlog.info('%d %s%s' % (self.status_code, self.status, plog))
+        for k, v in self._raw_headers:
+            recvlog.info('  %s: %s%s' % (k, v, plog))
+        if self.stream:
+            recvlog.info('data: streamed%s' % plog)
+        else:
+            recvlog.info('data size: %s%s' % (
+                len(self._content) if self._content else 0, plog))
+        if self.LOG_DATA and self._content:
+            data = '%s%s' % (self._content, plog)
+            data = utils.escape_ctrl_chars(data)
+            if self._token:
+                data = data.replace(self._token, '...')
+            recvlog.info(data)
+
+    def _start_trace(self, connection, start, acquired, responded):
+        """Keep the timing breakdown of a request to trace it later"""
+        timings = getattr(connection, 'timings', None) or dict()
+        #  A reused connection reports no setup time
+        connection.timings = None
+        setup = sum(timings.values())
+        timings.update(
+            wait=acquired - start, ttfb=responded - acquired - setup)
+        self._trace = dict(
+            self.trace_tags,
+            method=self.request.method, url=self.request.url,
+            start=start, bytes_out=len(self.request.data or ''),
+            bytes_in=0, timings=timings)
+
+    def _end_trace(self, body_start, bytes_in):
+        """Send the trace event of this request to all trace hooks"""
+        event, self._trace = self._trace, None
+        if not event:
+            return
+        event['timings']['body'] = time() - body_start
+        event.update(status=self._status_code, bytes_in=bytes_in)
+        for hook in self.trace_hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                log.debug('Trace hook %s failed: %s' % (hook, e))
 
-    def _get_headers_to_decode(self, headers):
-        keys = set([k.lower() for k, v in headers])
-        encodable = list(keys.intersection(self.headers_to_decode))
-
-        def has_prefix(s):
-            for k in self.header_prefices:
-                if s.startswith(k):
-                    return True
+    def _is_gzipped(self):
+        """:returns: (bool) if the body is compressed, as the request asked"""
+        if 'gzip' not in self.request.headers.get('Accept-Encoding', ''):
             return False
-        return encodable + filter(has_prefix, keys.difference(encodable))
+        for k, v in self._raw_headers:
+            if k.lower() == 'content-encoding':
+                return v.strip().lower() == 'gzip'
+        return False
+
+    def _load_cached(self, entry):
+        """Replace a 304 (Not Modified) response with the cached one
+
+        :param entry: (dict) a ResponseCache entry
+        """
+        self._status_code, self._reason = entry['status'], entry['reason']
+        self._status, self._headers = None, None
+        self._raw_headers, self._content = entry['headers'], entry['content']
 
     def _get_response(self):
         if self._request_performed:
@@ -263,40 +407,45 @@ class ResponseManager(Logged):
         pool_kw = dict(size=self.poolsize) if self.poolsize else dict()
         for retries in range(1, self.CONNECTION_TRY_LIMIT + 1):
             try:
-                with https.PooledHTTPConnection(
-                        self.request.netloc, self.request.scheme,
-                        **pool_kw) as connection:
+                pooled = https.PooledHTTPConnection(
+                    self.request.netloc, self.request.scheme, **pool_kw)
+                start = time()
+                connection = pooled.acquire()
+                acquired = time()
+                try:
                     self.request.LOG_TOKEN = self.LOG_TOKEN
                     self.request.LOG_DATA = self.LOG_DATA
                     self.request.LOG_PID = self.LOG_PID
                     r = self.request.perform(connection)
+                    if self.trace_hooks:
+                        self._start_trace(
+                            connection, start, acquired, time())
                     plog = ''
                     if self.LOG_PID:
                         recvlog.info('\n%s <-- %s <-- [req: %s]\n' % (
                             self, r, self.request))
                         plog = '\t[%s]' % self
                     self._request_performed = True
-                    self._status_code, self._status = r.status, unquote(
-                        r.reason)
-                    recvlog.info(
-                        '%d %s%s' % (self.status_code, self.status, plog))
-                    self._headers = dict()
-
-                    r_headers = r.getheaders()
-                    enc_headers = self._get_headers_to_decode(r_headers)
-                    for k, v in r_headers:
-                        self._headers[k] = unquote(v).decode('utf-8') if (
-                            k.lower()) in enc_headers else v
-                        recvlog.info('  %s: %s%s' % (k, v, plog))
-                    self._content = r.read()
-                    recvlog.info('data size: %s%s' % (
-                        len(self._content) if self._content else 0, plog))
-                    if self.LOG_DATA and self._content:
-                        data = '%s%s' % (self._content, plog)
-                        data = utils.escape_ctrl_chars(data)
-                        if self._token:
-                            data = data.replace(self._token, '...')
-                        recvlog.info(data)
+                    self._status_code, self._reason = r.status, r.reason
+                    #  Headers are decoded when they are first read
+                    self._raw_headers, self._headers = r.getheaders(), None
+                    self._body_start, self._bytes_in = time(), 0
+                    if self._is_gzipped():
+                        self._decompressor = zlib.decompressobj(
+                            16 + zlib.MAX_WBITS)
+                    if self.stream:
+                        self._stream, self._pooled = r, pooled
+                    else:
+                        self._content = r.read()
+                        self._end_trace(self._body_start, len(self._content))
+                        if self._decompressor:
+                            self._content = self._decompressor.decompress(
+                                self._content) + self._decompressor.flush()
+                    if recvlog.isEnabledFor(INFO):
+                        self._log_response(plog)
+                finally:
+                    if not self._pooled:
+                        pooled.release()
                 break
             except Exception as err:
                 if isinstance(err, HTTPException):
@@ -318,16 +467,23 @@ class ResponseManager(Logged):
     @property
     def status(self):
         self._get_response()
+        if self._status is None:
+            self._status = unquote(self._reason)
         return self._status
 
     @property
     def headers(self):
         self._get_response()
+        if self._headers is None:
+            self._headers = self._decode_headers(self._raw_headers)
         return self._headers
 
     @property
     def content(self):
+        """In stream mode, the rest of the body is consumed and stored"""
         self._get_response()
+        if self._stream:
+            self._content = ''.join(self.iter_content())
         return self._content
 
     @property
@@ -335,8 +491,56 @@ class ResponseManager(Logged):
         """
         :returns: (str) content
         """
+        return '%s' % self.content
+
+    def iter_content(self, chunk_size=None):
+        """Iterate over the response body in chunks
+
+        In stream mode, chunks are read from the connection, which is
+        released when the body is consumed
+
+        :param chunk_size: (int) the max size of each chunk in bytes, as
+            transferred (compressed bodies are decompressed on the fly)
+
+        :returns: (generator of str)
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
         self._get_response()
-        return '%s' % self._content
+        if not self._stream:
+            content = self._content or ''
+            for start in xrange(0, len(content), chunk_size):
+                yield content[start:start + chunk_size]
+            return
+        try:
+            while True:
+                chunk = self._stream.read(chunk_size)
+                if not chunk:
+                    break
+                self._bytes_in += len(chunk)
+                if self._decompressor:
+                    chunk = self._decompressor.decompress(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+            if self._decompressor:
+                chunk = self._decompressor.flush()
+                if chunk:
+                    yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        """Release the connection of a streamed response
+        If the body is not consumed, the connection is closed, so that it will
+        not be reused with unread data on it
+        """
+        if self._pooled:
+            self._end_trace(self._body_start, self._bytes_in)
+            stream, pooled = self._stream, self._pooled
+            self._stream, self._pooled = None, None
+            if not getattr(stream, 'isclosed', lambda: True)():
+                pooled.obj.close()
+            pooled.release()
 
     @property
     def headers_to_decode(self):
@@ -361,9 +565,8 @@ class ResponseManager(Logged):
         """
         :returns: (dict) squeezed from json-formated content
         """
-        self._get_response()
         try:
-            return loads(self._content)
+            return loads(self.content)
         except ValueError as err:
             raise ClientError('Response not formated in JSON - %s' % err)
 
@@ -392,11 +595,494 @@ class SilentEvent(Thread):
             self._exception = e
 
 
+class Job(object):
+    """A method(*args, **kwargs) call, to be run by an Executor"""
+
+    def __init__(self, method, *args, **kwargs):
+        self.method, self.args, self.kwargs = method, args, kwargs
+        self.index = None
+        #  Jobs run under the deadline of the thread which created them
+        self.deadline = get_deadline()
+
+    @property
+    def exception(self):
+        return getattr(self, '_exception', False)
+
+    @property
+    def value(self):
+        return getattr(self, '_value', None)
+
+    def run(self):
+        outer, _deadlines.value = get_deadline(), self.deadline
+        try:
+            time_left()
+            self._value = self.method(*(self.args), **(self.kwargs))
+        except Exception as e:
+            estatus = e.status if isinstance(e, ClientError) else ''
+            recvlog.debug('Job %s got exception %s\n<%s %s' % (
+                self, type(e), estatus, e))
+            self._exception = e
+        finally:
+            _deadlines.value = outer
+
+
+class ConcurrencyController(object):
+    """Adapt the number of concurrent jobs to throughput and errors (AIMD)
+
+    The limit grows by one while the throughput of the jobs improves and it
+    is halved when a job fails because the server is overloaded or the
+    connection fails. The throughput is measured in bytes per second, over
+    windows of as many jobs as the current limit.
+    """
+
+    BACKOFF_STATUSES = (502, 503, 504)
+    TOLERANCE = 0.05
+    DECAY = 0.9
+
+    def __init__(self, max_limit, limit=1):
+        """
+        :param max_limit: (int) the limit never exceeds this value
+
+        :param limit: (int) the initial limit
+        """
+        assert isinstance(max_limit, int) and max_limit > 0, (
+            'Max limit not a +int')
+        self.max_limit = max_limit
+        self.limit = max(1, min(limit, max_limit))
+        self.running = 0
+        self._condition = Condition()
+        self._best_throughput = 0.0
+        self._new_window()
+
+    def _new_window(self):
+        self._window_start, self._window_bytes, self._window_jobs = (
+            time(), 0, 0)
+
+    def _set_limit(self, limit, reason):
+        limit = max(1, min(limit, self.max_limit))
+        if limit != self.limit:
+            sendlog.info('Concurrency limit %s -> %s (%s)' % (
+                self.limit, limit, reason))
+            self.limit = limit
+
+    def is_congestion(self, error):
+        """:returns: (bool) whether error indicates server or net overload"""
+        if isinstance(error, ClientError):
+            return error.status in self.BACKOFF_STATUSES
+        return isinstance(error, (HTTPException, SocketError))
+
+    def acquire(self):
+        """Wait until a job can run within the limit"""
+        with self._condition:
+            while self.running >= self.limit:
+                self._condition.wait()
+            self.running += 1
+
+    def release(self, size=0, error=None):
+        """Account a finished job and adapt the limit
+
+        :param size: (int) the bytes transferred by the job
+
+        :param error: (Exception) the job failure, if any
+        """
+        with self._condition:
+            self.running -= 1
+            if error and self.is_congestion(error):
+                self._set_limit(self.limit // 2, 'backoff on %s' % (
+                    getattr(error, 'status', None) or type(error).__name__))
+                self._best_throughput = 0.0
+                self._new_window()
+            elif not error:
+                self._window_bytes += size
+                self._window_jobs += 1
+                if self._window_jobs >= self.limit:
+                    self._adapt()
+            self._condition.notify_all()
+
+    def _adapt(self):
+        elapsed = time() - self._window_start
+        throughput = self._window_bytes / elapsed if elapsed > 0 else 0.0
+        recvlog.debug('Throughput %.0f bytes/s with %s concurrent jobs' % (
+            throughput, self.limit))
+        if throughput > self._best_throughput * (1 + self.TOLERANCE):
+            self._best_throughput = throughput
+            self._set_limit(self.limit + 1, 'throughput improves')
+        else:
+            #  Let the best throughput decay, so that probing resumes
+            self._best_throughput *= self.DECAY
+        self._new_window()
+
+
+class RetryPolicy(object):
+    """Retry failed requests, with exponential backoff and full jitter
+
+    Requests are retried on server errors, timeouts and connection failures,
+    if they are idempotent (e.g., GET, PUT) or marked as such by the caller
+    (e.g., block uploads, which are addressed by the block hash)
+    """
+
+    RETRY_STATUSES = (500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30.0):
+        """
+        :param retries: (int) the max number of retries per request
+
+        :param backoff: (float) seconds, the max wait before the first retry,
+            which doubles on every retry
+
+        :param max_backoff: (float) seconds, the max wait before any retry
+        """
+        assert isinstance(retries, int) and retries >= 0, (
+            'Retries not a non-negative int')
+        self.retries, self.backoff, self.max_backoff = (
+            retries, backoff, max_backoff)
+
+    def can_retry(self, method, idempotent=None):
+        """:returns: (bool) whether requests of this kind can be repeated"""
+        if idempotent is not None:
+            return bool(idempotent)
+        return method.upper() in self.IDEMPOTENT_METHODS
+
+    def is_transient(self, error):
+        """:returns: (bool) whether a request failure may not happen again"""
+        if isinstance(error, (KamakiSSLError, DeadlineExceeded)):
+            return False
+        if isinstance(error, ClientError):
+            #  Status 0: the connection failed or the response timed out
+            return error.status in self.RETRY_STATUSES or not error.status
+        return isinstance(error, (HTTPException, SocketError))
+
+    def delay(self, attempt):
+        """:returns: (float) seconds to wait before retry number attempt + 1
+        """
+        return random() * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def should_retry(self, attempt, error):
+        """:param attempt: (int) the number of retries so far"""
+        return attempt < self.retries and self.is_transient(error)
+
+    def run(self, method, *args, **kwargs):
+        """Call method(*args, **kwargs), retry it on transient errors
+        Use it for operations which are safe to repeat as a whole (e.g., to
+        upload a block and verify its hash)
+        """
+        attempt = 0
+        while True:
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(attempt, e):
+                    raise
+                wait = self.delay(attempt)
+                left = time_left()
+                if left is not None and wait >= left:
+                    raise
+                log.debug('Retry in %.3f seconds (%s)' % (wait, e))
+            sleep(wait)
+            attempt += 1
+
+
+def _job_size(job):
+    """:returns: (int) the bytes sent or received by a job, or 1 if unknown
+    """
+    data = job.kwargs.get('data')
+    if data is None:
+        data = getattr(job.value, 'content', None)
+    try:
+        return len(data) or 1
+    except TypeError:
+        return 1
+
+
+class Executor(object):
+    """Run jobs on a fixed set of worker threads
+
+    Jobs are fed to the workers through a bounded queue, so that submitting
+    blocks while all workers are busy and the queue is full. Finished jobs
+    are collected in completion order.
+    Submitting and collecting jobs should happen in a single thread.
+    """
+
+    POLL_TIMEOUT = 0.1
+
+    def __init__(self, size=1, queue_size=None, controller=None):
+        """
+        :param size: (int) the number of worker threads
+
+        :param queue_size: (int) the max number of jobs waiting for a worker,
+            by default as many as the workers. If 0, submitting waits until
+            a worker takes the job
+
+        :param controller: (ConcurrencyController) if given, it limits how
+            many of the workers run jobs at the same time
+        """
+        assert isinstance(size, int) and size > 0, 'Executor size not a +int'
+        self.size = size
+        self.controller = controller
+        self.closed = False
+        self._handoff = queue_size == 0
+        self._todo = Queue(size if queue_size is None else (
+            queue_size or 1))
+        self._done, self._taken = Queue(), Condition()
+        self._workers, self._pending = [], 0
+
+    def _work(self):
+        while True:
+            job = self._todo.get()
+            if self._handoff:
+                with self._taken:
+                    self._taken.notify_all()
+            if job is None:
+                break
+            if self.controller:
+                self.controller.acquire()
+                try:
+                    job.run()
+                finally:
+                    self.controller.release(
+                        0 if job.exception else _job_size(job), job.exception)
+            else:
+                job.run()
+            self._done.put(job)
+
+    def _start_workers(self):
+        assert not self.closed, 'Executor is shut down'
+        while len(self._workers) < self.size:
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, method, *args, **kwargs):
+        """Queue a method call, wait while the queue is full
+
+        :returns: (Job)
+        """
+        self._start_workers()
+        job = Job(method, *args, **kwargs)
+        while True:
+            #  Poll, to stay responsive to KeyboardInterrupt and deadlines
+            try:
+                self._todo.put(job, True, self.POLL_TIMEOUT)
+                break
+            except Full:
+                time_left()
+        self._pending += 1
+        if self._handoff:
+            with self._taken:
+                while not self._todo.empty():
+                    self._taken.wait(self.POLL_TIMEOUT)
+                    time_left()
+        return job
+
+    def finished(self, wait=False):
+        """Yield finished jobs in completion order
+
+        :param wait: (bool) if set, wait for all submitted jobs to finish,
+            otherwise, yield only the jobs that are already finished
+        """
+        while self._pending:
+            try:
+                job = self._done.get(wait, self.POLL_TIMEOUT) if (
+                    wait) else self._done.get_nowait()
+            except Empty:
+                if wait:
+                    time_left()
+                    continue
+                return
+            self._pending -= 1
+            yield job
+
+    def imap(self, method, kwarg_list):
+        """Run method(**kwargs) for each kwargs in kwarg_list
+
+        Jobs are submitted while the finished ones are yielded, so that
+        kwarg_list can be a generator (e.g., of data blocks) and memory stays
+        bounded. If the iteration is interrupted (e.g., by an exception or a
+        KeyboardInterrupt), the queued jobs are dropped and the executor is
+        shut down, after the running jobs are finished.
+        When the Deadline of the calling thread passes, DeadlineExceeded is
+        raised.
+
+        :param kwarg_list: (iterable of dicts)
+
+        :returns: (generator of Job) in completion order, Job.index is the
+            position of the respective kwargs in kwarg_list
+        """
+        completed = False
+        try:
+            for index, kwargs in enumerate(kwarg_list):
+                time_left()
+                job = self.submit(method, **kwargs)
+                job.index = index
+                for job in self.finished():
+                    yield job
+            for job in self.finished(wait=True):
+                yield job
+            completed = True
+        finally:
+            if not completed:
+                self.shutdown(wait=True)
+
+    def shutdown(self, wait=False):
+        """Drop queued jobs and stop the workers after their running jobs
+
+        :param wait: (bool) if set, wait for the workers to stop
+        """
+        self.closed = True
+        while True:
+            try:
+                self._todo.get_nowait()
+            except Empty:
+                break
+        for worker in self._workers:
+            self._todo.put(None)
+        while wait and any([w.isAlive() for w in self._workers]):
+            for worker in self._workers:
+                worker.join(self.POLL_TIMEOUT)
+        self._workers, self._pending = [], 0
+
+
+def iter_pages(get_page, page_size, marker=None, limit=None):
+    """Yield the items of a listing, paging with limit and marker
+
+    While the caller handles the items of a page, the next page is fetched
+    by a background thread, so that at most two pages are kept in memory,
+    regardless of the size of the listing.
+
+    :param get_page: (callable) get_page(limit, marker) returns a list of
+        dicts, sorted by name, where each name comes after marker. The marker
+        of the next page is the "name" (or "subdir") of the last item
+
+    :param page_size: (int) the max number of items per page
+
+    :param marker: (str) yield only the items after this name
+
+    :param limit: (int) stop after that many items (default: all)
+
+    :returns: (generator of dicts)
+    """
+    assert page_size > 0, 'Page size not a +int'
+
+    def fetch(marker, count):
+        job = Job(get_page, count, marker)
+        thread = Thread(target=job.run)
+        thread.daemon = True
+        thread.start()
+        return thread, job
+
+    left = limit or None
+    count = min(page_size, left) if left else page_size
+    pending = fetch(marker, count)
+    try:
+        while pending:
+            thread, job = pending
+            while thread.isAlive():
+                thread.join(Executor.POLL_TIMEOUT)
+            pending = None
+            if job.exception:
+                raise job.exception
+            page = job.value or []
+            if left:
+                page = page[:left]
+                left -= len(page)
+            if len(page) >= count and (left is None or left > 0):
+                last = page[-1]
+                count = min(page_size, left) if left else page_size
+                pending = fetch(last.get('name', last.get('subdir')), count)
+            for item in page:
+                yield item
+    finally:
+        #  Do not let an abandoned listing run in the background
+        if pending:
+            pending[0].join()
+
+
+class PerThread(object):
+    """A Client attribute with a separate value in each thread
+
+    Request state (e.g., headers set with Client.set_header) is kept per
+    thread, so that a client can be shared by many threads.
+    """
+
+    def __init__(self, name, shared=False):
+        """
+        :param name: (str) the name of the attribute
+
+        :param shared: (bool) if set, threads which have not set a value get
+            the one set by the thread that created the client (e.g., in
+            __init__), otherwise they get an empty dict
+        """
+        self.name, self.shared = name, shared
+
+    def __get__(self, client, owner=None):
+        if client is None:
+            return self
+        try:
+            return getattr(client._thread_state, self.name)
+        except AttributeError:
+            if self.shared:
+                return client._shared_state.get(self.name)
+            value = dict()
+            setattr(client._thread_state, self.name, value)
+            return value
+
+    def __set__(self, client, value):
+        setattr(client._thread_state, self.name, value)
+        if self.shared and current_thread().ident == client._creator:
+            client._shared_state[self.name] = value
+
+
+_trace_hooks = []
+
+
+def add_trace_hook(hook):
+    """Trace the requests of all clients
+
+    :param hook: (callable) called with a dict for each completed request:
+        service, operation, method, url, status, start (epoch time),
+        bytes_out, bytes_in and timings, which are durations in seconds:
+        wait (for a pooled connection), dns, connect, tls (only on new
+        connections), ttfb (time to first byte) and body (to read the body)
+    """
+    if hook not in _trace_hooks:
+        _trace_hooks.append(hook)
+
+
+def remove_trace_hook(hook):
+    if hook in _trace_hooks:
+        _trace_hooks.remove(hook)
+
+
+class TraceFile(object):
+    """A trace hook which appends each event as a JSON line to a file"""
+
+    def __init__(self, path):
+        self.path, self._lock = path, Lock()
+
+    def __call__(self, event):
+        line = '%s\n' % dumps(event, sort_keys=True)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
 class Client(Logged):
     service_type = ''
     MAX_THREADS = 1
     DATE_FORMATS = ['%a %b %d %H:%M:%S %Y', ]
     CONNECTION_RETRY_LIMIT = 0
+    CONNECT_TIMEOUT, READ_TIMEOUT = 30.0, 300.0  # seconds, None for no limit
+    retry_policy = RetryPolicy()
+    #  (kamaki.clients.utils.cache.ResponseCache) if set, GET responses are
+    #  cached and revalidated with the server
+    response_cache = None
+
+    headers, params = PerThread('headers'), PerThread('params')
+    response_headers = PerThread('response_headers', shared=True)
+    response_header_prefices = PerThread(
+        'response_header_prefices', shared=True)
 
     def __init__(self, endpoint_url, token, base_url=None):
         #  BW compatibility - keep base_url for some time
@@ -404,12 +1090,15 @@ class Client(Logged):
         assert endpoint_url, 'No endpoint_url for client %s' % self
         self.endpoint_url, self.base_url = endpoint_url, endpoint_url
         self.token = token
+        self._thread_state, self._shared_state = local(), dict()
+        self._creator = current_thread().ident
         self.headers, self.params = dict(), dict()
         self.poolsize = None
         self.request_headers_to_quote = []
         self.request_header_prefices_to_quote = []
         self.response_headers = []
         self.response_header_prefices = []
+        self.trace_hooks = []
 
         # If no CA certificates are set, get the defaults from kamaki.defaults
         if https.HTTPSClientAuthConnection.ca_file is None:
@@ -438,36 +1127,25 @@ class Client(Logged):
         for old, new in new_keys.items():
             headers[new] = headers.pop(old)
 
-    def _init_thread_limit(self, limit=1):
-        assert isinstance(limit, int) and limit > 0, 'Thread limit not a +int'
-        self._thread_limit = limit
-        self._elapsed_old = 0.0
-        self._elapsed_new = 0.0
-
-    def _watch_thread_limit(self, threadlist):
-        self._thread_limit = getattr(self, '_thread_limit', 1)
-        self._elapsed_new = getattr(self, '_elapsed_new', 0.0)
-        self._elapsed_old = getattr(self, '_elapsed_old', 0.0)
-        recvlog.debug('# running threads: %s' % len(threadlist))
-        if self._elapsed_old and self._elapsed_old >= self._elapsed_new and (
-                self._thread_limit < self.MAX_THREADS):
-            self._thread_limit += 1
-        elif self._elapsed_old <= self._elapsed_new and self._thread_limit > 1:
-            self._thread_limit -= 1
-
-        self._elapsed_old = self._elapsed_new
-        if len(threadlist) >= self._thread_limit:
-            self._elapsed_new = 0.0
-            for thread in threadlist:
-                begin_time = time()
-                thread.join()
-                self._elapsed_new += time() - begin_time
-            self._elapsed_new = self._elapsed_new / len(threadlist)
-            return []
-        return threadlist
+    @property
+    def executor(self):
+        """The Executor that runs the parallel operations of this client
+        It is created on demand, with MAX_THREADS workers. Each thread gets
+        its own executor, so that many threads can run parallel operations
+        """
+        size = max(1, int(self.MAX_THREADS or 1))
+        executor = getattr(self._thread_state, 'executor', None)
+        if not executor or executor.closed or executor.size != size:
+            if executor:
+                executor.shutdown()
+            executor = self._thread_state.executor = self._new_executor(size)
+        return executor
+
+    def _new_executor(self, size):
+        return Executor(size)
 
     def async_run(self, method, kwarg_list):
-        """Fire threads of operations
+        """Run operations in parallel
 
         :param method: the method to run in each thread
 
@@ -477,29 +1155,75 @@ class Client(Logged):
         :returns: (list) the results of each method call w.r. to the order of
             kwarg_list
         """
-        flying, results = {}, {}
-        self._init_thread_limit()
-        for index, kwargs in enumerate(kwarg_list):
-            self._watch_thread_limit(flying.values())
-            flying[index] = SilentEvent(method=method, **kwargs)
-            flying[index].start()
-            unfinished = {}
-            for key, thread in flying.items():
-                if thread.isAlive():
-                    unfinished[key] = thread
-                elif thread.exception:
-                    raise thread.exception
+        results = {}
+        for job in self.executor.imap(method, kwarg_list):
+            if job.exception:
+                raise job.exception
+            results[job.index] = job.value
+        return [results[index] for index in sorted(results)]
+
+    def batch(self, requests, max_threads=None):
+        """Perform many independent requests concurrently
+
+        Requests run on a separate pool of worker threads, so that batches
+        can be used while the client executor is busy. A failed request does
+        not abort the batch, its error is collected instead.
+
+        :param requests: (dict) {key: (method, path[, params[, kwargs]])}
+            where params is a dict of url parameters and kwargs are passed to
+            request (e.g., success, async_headers, data). A list of tuples
+            is keyed by the position of each tuple
+
+        :param max_threads: (int) the max number of concurrent requests
+            (default: MAX_THREADS)
+
+        :returns: (dict, dict) the responses and the errors, keyed by request
+        """
+        if not isinstance(requests, dict):
+            requests = dict(enumerate(requests))
+
+        keys, results, errors = list(requests), dict(), dict()
+
+        def kwarg_list():
+            for key in keys:
+                args = requests[key]
+                params = args[2] if len(args) > 2 else None
+                kwargs = dict(args[3]) if len(args) > 3 else dict()
+                kwargs['async_params'] = dict(
+                    kwargs.get('async_params', {}), **(params or {}))
+                yield dict(args=args[:2], kwargs=kwargs)
+
+        def perform(args, kwargs):
+            return self.request(*args, **kwargs)
+
+        size = max(1, int(max_threads or self.MAX_THREADS or 1))
+        executor = Executor(max(1, min(size, len(keys))))
+        try:
+            for job in executor.imap(perform, kwarg_list()):
+                if job.exception:
+                    errors[keys[job.index]] = job.exception
                 else:
-                    results[key] = thread.value
-            flying = unfinished
-        sendlog.info('- - - wait for threads to finish')
-        for key, thread in flying.items():
-            if thread.isAlive():
-                thread.join()
-            if thread.exception:
-                raise thread.exception
-            results[key] = thread.value
-        return results.values()
+                    results[keys[job.index]] = job.value
+        finally:
+            executor.shutdown()
+        return results, errors
+
+    _request_methods = set([
+        'request', 'delete', 'get', 'head', 'post', 'put', 'copy', 'move'])
+
+    def _operation(self):
+        """:returns: (str) the name of the client method which called request
+        """
+        frame = sys._getframe(1)
+        while frame:
+            code = frame.f_code
+            if code.co_argcount and code.co_varnames[0] == 'self' and (
+                    frame.f_locals.get('self') is self) and not (
+                        code.co_name.startswith('_') or (
+                            code.co_name in self._request_methods)):
+                return code.co_name
+            frame = frame.f_back
+        return ''
 
     def set_header(self, name, value, iff=True):
         """Set a header 'name':'value'"""
@@ -518,7 +1242,17 @@ class Client(Logged):
         Requests are commited to and performed by Request/ResponseManager
         These classes perform a lazy http request. Present method, by default,
         enforces them to perform the http call. Hint: call present method with
-        success=None to get a non-performed ResponseManager object.
+        success=None to get a non-performed ResponseManager object, or with
+        stream=True to consume the response body with iter_content.
+        Performed requests which fail on transient errors are retried, as
+        decided by retry_policy. Call with idempotent=True or False to
+        override whether the request can be repeated safely.
+        Connections time out after CONNECT_TIMEOUT, and reads (or writes)
+        after READ_TIMEOUT, or when the current Deadline passes.
+        GET responses are gzip-compressed, if the server supports it, unless
+        the caller sets another Accept-Encoding. If there is a
+        response_cache, performed GET responses (not streamed, not ranged)
+        are cached and revalidated on later requests, unless cached=False.
         """
         assert isinstance(method, str) or isinstance(method, unicode)
         assert method
@@ -529,8 +1263,13 @@ class Client(Logged):
             params = dict(self.params)
             params.update(async_params)
             success = kwargs.pop('success', 200)
+            stream = kwargs.pop('stream', False)
+            idempotent = kwargs.pop('idempotent', None)
+            cached = kwargs.pop('cached', True)
             data = kwargs.pop('data', None)
             headers.setdefault('X-Auth-Token', self.token)
+            if method.upper() == 'GET':
+                headers.setdefault('Accept-Encoding', 'gzip')
             if 'json' in kwargs:
                 data = dumps(kwargs.pop('json'))
                 headers.setdefault('Content-Type', 'application/json')
@@ -538,38 +1277,120 @@ class Client(Logged):
                 headers.setdefault('Content-Length', '%s' % len(data))
             plog = ('\t[%s]' % self) if self.LOG_PID else ''
             sendlog.debug('\n\nCMT %s@%s%s', method, self.endpoint_url, plog)
+            trace_hooks = _trace_hooks + self.trace_hooks
+            trace_tags = dict(
+                service=self.service_type,
+                operation=self._operation()) if trace_hooks else None
+        finally:
+            self.headers = dict()
+            self.params = dict()
+
+        #  Ranged and conditional requests are left to the caller
+        cache = self.response_cache if (
+            cached and method.upper() == 'GET' and success is not None and (
+                not stream) and not self._uncacheable_headers.intersection(
+                    [k.lower() for k in headers])) else None
+        retry = self.retry_policy
+        if success is None or not (
+                retry and retry.can_retry(method, idempotent)):
+            retry = None
+        attempt = 0
+        while True:
+            left = time_left()
             req = RequestManager(
                 method, self.endpoint_url, path,
                 data=data, headers=headers, params=params)
             req.headers_to_quote = self.request_headers_to_quote
             req.header_prefices = self.request_header_prefices_to_quote
+            req.connect_timeout, req.read_timeout = [
+                t if left is None else min(t or left, left) for t in (
+                    self.CONNECT_TIMEOUT, self.READ_TIMEOUT)]
             #  req.log()
             r = ResponseManager(
                 req,
-                poolsize=self.poolsize,
-                connection_retry_limit=self.CONNECTION_RETRY_LIMIT)
+                poolsize=max(self.poolsize or 0, self.MAX_THREADS or 0),
+                connection_retry_limit=0 if idempotent is False else (
+                    self.CONNECTION_RETRY_LIMIT),
+                stream=stream)
             r.headers_to_decode = self.response_headers
             r.header_prefices = self.response_header_prefices
             r.LOG_TOKEN, r.LOG_DATA, r.LOG_PID = (
                 self.LOG_TOKEN, self.LOG_DATA, self.LOG_PID)
             r._token = headers['X-Auth-Token']
-        finally:
-            self.headers = dict()
-            self.params = dict()
+            if trace_hooks:
+                r.trace_hooks, r.trace_tags = trace_hooks, trace_tags
+            entry = self._revalidate(req) if cache else None
 
-        if success is not None:
-            # Success can either be an int or a collection
-            success = (success,) if isinstance(success, int) else success
-            if r.status_code not in success:
-                log.debug(u'Client caught error %s (%s)' % (r, type(r)))
-                status_msg = getattr(r, 'status', '')
+            if success is None:
+                return r
+            try:
+                if cache:
+                    self._update_cache(r, entry)
+                self._assert_status(r, success)
+                return r
+            except Exception as e:
+                if not (retry and retry.should_retry(attempt, e)):
+                    raise
+                wait = retry.delay(attempt)
+                left = time_left()
+                if left is not None and wait >= left:
+                    raise
+                log.debug('Retry %s %s in %.3f seconds (%s)' % (
+                    method, path, wait, e))
+            r.close()
+            sleep(wait)
+            attempt += 1
+
+    _uncacheable_headers = set(['range', 'if-none-match', 'if-modified-since'])
+
+    def _revalidate(self, req):
+        """Make a request conditional on the cached response, if any
+
+        :returns: (dict) the cached response or None
+        """
+        try:
+            entry = self.response_cache.get(req.url, self.token)
+        except Exception as e:
+            log.debug('Response cache lookup failed: %s' % e)
+            return None
+        if entry and entry['etag']:
+            req.headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            req.headers['If-Modified-Since'] = entry['last_modified']
+        return entry
+
+    def _update_cache(self, r, entry):
+        """Use the cached response on 304, cache the response on 200"""
+        if entry and r.status_code == 304:
+            sendlog.info('Use cached response of %s' % r.request.url)
+            r._load_cached(entry)
+        elif r.status_code == 200:
+            headers = dict((k.lower(), v) for k, v in r._raw_headers)
+            etag, last_modified = (
+                headers.get('etag'), headers.get('last-modified'))
+            if (etag or last_modified) and len(r.content) <= (
+                    self.response_cache.MAX_CONTENT_SIZE):
                 try:
-                    message = u'%s %s\n' % (status_msg, r.text)
-                except:
-                    message = u'%s %s\n' % (status_msg, r)
-                status = getattr(r, 'status_code', getattr(r, 'status', 0))
-                raise ClientError(message, status=status)
-        return r
+                    self.response_cache.set(
+                        r.request.url, self.token, etag, last_modified,
+                        r.status_code, r._reason, r._raw_headers, r.content)
+                except Exception as e:
+                    log.debug('Response cache update failed: %s' % e)
+
+    @staticmethod
+    def _assert_status(r, success):
+        """:raises ClientError: if the response status is not a success"""
+        # Success can either be an int or a collection
+        success = (success,) if isinstance(success, int) else success
+        if r.status_code not in success:
+            log.debug(u'Client caught error %s (%s)' % (r, type(r)))
+            status_msg = getattr(r, 'status', '')
+            try:
+                message = u'%s %s\n' % (status_msg, r.text)
+            except:
+                message = u'%s %s\n' % (status_msg, r)
+            status = getattr(r, 'status_code', getattr(r, 'status', 0))
+            raise ClientError(message, status=status)
 
     def delete(self, path, **kwargs):
         return self.request('delete', path, **kwargs)
@@ -32,16 +32,21 @@
 # or implied, of GRNET S.A.
 
 from logging import getLogger
+from json import dumps, loads
+from calendar import timegm
+from time import time
 import inspect
 import ssl
 
+import dateutil.parser
+
 from astakosclient import AstakosClientException, parse_endpoints
 import astakosclient
 
 from kamaki.clients import (
     Client, ClientError, KamakiSSLError, RequestManager, recvlog)
 
-from kamaki.clients.utils import https
+from kamaki.clients.utils import https, write_private_file
 
 
 log = getLogger(__name__)
@@ -171,18 +176,98 @@ class LoggedAstakosClient(AstakosClient):
             return r
 
 
+def _token_expiration(auth_info):
+    """
+    :param auth_info: (dict) as returned by authenticate
+
+    :returns: (float) the token expiration timestamp, 0 if not provided
+    """
+    try:
+        expires = auth_info['access']['token']['expires']
+        return float(timegm(dateutil.parser.parse(expires).utctimetuple()))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return 0.0
+
+
 class CachedAstakosClient(Client):
     """Synnefo Astakos cached client wraper"""
     service_type = 'identity'
 
     @_astakos_error
-    def __init__(self, endpoint_url, token=None):
+    def __init__(self, endpoint_url, token=None, cache_file=None):
+        """
+        :param cache_file: (str) if set, authentication information is also
+            stored in this file and reused by other client instances, until
+            each token expires
+        """
         super(CachedAstakosClient, self).__init__(endpoint_url, token)
         self._astakos = dict()
         self._uuids = dict()
         self._cache = dict()
         self._uuids2usernames = dict()
         self._usernames2uuids = dict()
+        self.cache_file = cache_file
+
+    def _read_cache_file(self):
+        """
+        :returns: (dict) {endpoint_url: {token: cached entry}} or {} if the
+            cache file is not set, missing or corrupted
+        """
+        if not self.cache_file:
+            return dict()
+        try:
+            with open(self.cache_file) as f:
+                return loads(f.read())
+        except (IOError, ValueError) as e:
+            log.debug('Astakos cache %s not loaded: %s' % (self.cache_file, e))
+            return dict()
+
+    def _write_cache_file(self, removed=()):
+        """Store the cached information of this instance's tokens, don't
+        touch the tokens cached by other instances or endpoints
+
+        :param removed: (list) tokens to delete from the cache file
+        """
+        if not self.cache_file:
+            return
+        disk_cache = self._read_cache_file()
+        entries = disk_cache.setdefault(self.endpoint_url, dict())
+        for token in removed:
+            entries.pop(token, None)
+        for token, uuid in self._uuids.items():
+            auth_info = self._cache[uuid]
+            entries[token] = dict(
+                expires=_token_expiration(auth_info),
+                auth=auth_info,
+                uuids2usernames=self._uuids2usernames[uuid],
+                usernames2uuids=self._usernames2uuids[uuid])
+        try:
+            write_private_file(self.cache_file, dumps(disk_cache))
+        except (IOError, OSError) as e:
+            log.debug('Astakos cache %s not saved: %s' % (self.cache_file, e))
+
+    def _load_from_cache_file(self, token):
+        """
+        :returns: (dict) the cached authentication information of token or
+            None if it is not cached or it has expired
+        """
+        entry = self._read_cache_file().get(self.endpoint_url, {}).get(token)
+        if not entry or entry.get('expires', 0) <= time():
+            return None
+        auth_info = entry['auth']
+        uuid = auth_info['access']['user']['id']
+        self._uuids[token] = uuid
+        self._cache[uuid] = auth_info
+        self._astakos[uuid] = self._new_astakos(token)
+        self._uuids2usernames[uuid] = entry.get('uuids2usernames', dict())
+        self._usernames2uuids[uuid] = entry.get('usernames2uuids', dict())
+        return auth_info
+
+    def _new_astakos(self, token):
+        astakos = LoggedAstakosClient(self.endpoint_url, token, logger=log)
+        astakos.LOG_TOKEN = getattr(self, 'LOG_TOKEN', False)
+        astakos.LOG_DATA = getattr(self, 'LOG_DATA', False)
+        return astakos
 
     def _resolve_token(self, token):
         """
@@ -202,17 +287,23 @@ class CachedAstakosClient(Client):
         return self._astakos[self._uuids[token]]
 
     @_astakos_error
-    def authenticate(self, token=None):
+    def authenticate(self, token=None, refresh=False):
         """Get authentication information and store it in this client
         As long as the CachedAstakosClient instance is alive, the latest
         authentication information for this token will be available
+        If a cache_file is set, information is loaded from there, as long as
+        the token has not expired
 
         :param token: (str) custom token to authenticate
+
+        :param refresh: (bool) ignore the cache file and contact the server
         """
         token = self._resolve_token(token)
-        astakos = LoggedAstakosClient(self.endpoint_url, token, logger=log)
-        astakos.LOG_TOKEN = getattr(self, 'LOG_TOKEN', False)
-        astakos.LOG_DATA = getattr(self, 'LOG_DATA', False)
+        if not refresh:
+            r = self._load_from_cache_file(token)
+            if r:
+                return r
+        astakos = self._new_astakos(token)
         r = astakos.authenticate()
         uuid = r['access']['user']['id']
         self._uuids[token] = uuid
@@ -220,14 +311,27 @@ class CachedAstakosClient(Client):
         self._astakos[uuid] = astakos
         self._uuids2usernames[uuid] = dict()
         self._usernames2uuids[uuid] = dict()
+        self._write_cache_file()
         return self._cache[uuid]
 
     def remove_user(self, uuid):
-        self._uuids.pop(self.get_token(uuid))
+        token = self.get_token(uuid)
+        self._uuids.pop(token)
         self._cache.pop(uuid)
         self._astakos.pop(uuid)
         self._uuids2usernames.pop(uuid)
         self._usernames2uuids.pop(uuid)
+        self._write_cache_file(removed=[token])
+
+    def expire_token(self, token=None):
+        """Forget the cached information of a token (e.g., after a 401), so
+        that the next authentication will contact the server"""
+        token = self._resolve_token(token)
+        uuid = self._uuids.get(token)
+        if uuid:
+            self.remove_user(uuid)
+        else:
+            self._write_cache_file(removed=[token])
 
     def get_token(self, uuid):
         return self._cache[uuid]['access']['token']['id']
@@ -330,14 +434,29 @@ class CachedAstakosClient(Client):
         return self.uuids2usernames(uuids, token) if (
             uuids) else self.usernames2uuids(displaynames, token)
 
+    def _call_with_fresh_token(self, token, method_name, *args):
+        """Call an AstakosClient method, if it fails with 401 and the token
+        info was loaded from the cache file, refresh it and try once more"""
+        astakos = self._astakos[self._uuids[token]]
+        try:
+            return getattr(astakos, method_name)(*args)
+        except AstakosClientException as ace:
+            if not (self.cache_file and getattr(ace, 'status', 0) == 401):
+                raise
+        self.expire_token(token)
+        self.authenticate(token, refresh=True)
+        return getattr(self._astakos[self._uuids[token]], method_name)(*args)
+
     @_astakos_error
     def uuids2usernames(self, uuids, token=None):
         token = self._resolve_token(token)
         self._validate_token(token)
         uuid = self._uuids[token]
-        astakos = self._astakos[uuid]
         if set(uuids or []).difference(self._uuids2usernames[uuid]):
-            self._uuids2usernames[uuid].update(astakos.get_usernames(uuids))
+            names = self._call_with_fresh_token(token, 'get_usernames', uuids)
+            uuid = self._uuids[token]
+            self._uuids2usernames[uuid].update(names)
+            self._write_cache_file()
         return self._uuids2usernames[uuid]
 
     @_astakos_error
@@ -345,7 +464,9 @@ class CachedAstakosClient(Client):
         token = self._resolve_token(token)
         self._validate_token(token)
         uuid = self._uuids[token]
-        astakos = self._astakos[uuid]
         if set(usernames or []).difference(self._usernames2uuids[uuid]):
-            self._usernames2uuids[uuid].update(astakos.get_uuids(usernames))
+            uuids = self._call_with_fresh_token(token, 'get_uuids', usernames)
+            uuid = self._uuids[token]
+            self._usernames2uuids[uuid].update(uuids)
+            self._write_cache_file()
         return self._usernames2uuids[uuid]
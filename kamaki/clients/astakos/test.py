@@ -445,6 +445,102 @@ class CachedAstakosClient(TestCase):
         validate.assert_called_once_with('t1')
         get_uuids.assert_called_once_with(['name1', 'name2'])
 
+    @patch('%s.LoggedAstakosClient.__init__' % astakos_pkg, return_value=None)
+    @patch('%s.LoggedAstakosClient.authenticate' % astakos_pkg)
+    def test_authenticate_with_cache_file(self, authenticate, super_init):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from os import path, stat
+        from copy import deepcopy
+        tmp_dir = mkdtemp()
+        try:
+            cache_file = path.join(tmp_dir, 'cache_dir', 'astakos.cache')
+            valid = deepcopy(example)
+            valid['access']['token']['expires'] = '2999-01-01T00:00:00+00:00'
+            authenticate.return_value = valid
+            c1 = astakos.CachedAstakosClient(
+                self.url, self.token, cache_file=cache_file)
+            self.assertEqual(valid, c1.authenticate())
+            self.assertEqual(len(authenticate.mock_calls), 1)
+            self.assertEqual(stat(cache_file).st_mode & 0777, 0600)
+
+            #  A new client loads the information from the cache file
+            c2 = astakos.CachedAstakosClient(
+                self.url, self.token, cache_file=cache_file)
+            self.assertEqual(valid, c2.authenticate())
+            self.assertEqual(len(authenticate.mock_calls), 1)
+            uuid = valid['access']['user']['id']
+            self.assertEqual(c2._uuids[self.token], uuid)
+            self.assertTrue(isinstance(
+                c2._astakos[uuid], astakos.LoggedAstakosClient))
+
+            #  ... unless asked to refresh, or the token is expired
+            c2.authenticate(refresh=True)
+            self.assertEqual(len(authenticate.mock_calls), 2)
+            c2.expire_token()
+            c3 = astakos.CachedAstakosClient(
+                self.url, self.token, cache_file=cache_file)
+            c3.authenticate()
+            self.assertEqual(len(authenticate.mock_calls), 3)
+            authenticate.return_value = example
+            c3.authenticate(refresh=True)
+            c4 = astakos.CachedAstakosClient(
+                self.url, self.token, cache_file=cache_file)
+            c4.authenticate()
+            self.assertEqual(len(authenticate.mock_calls), 5)
+
+            #  Other endpoints are not affected
+            c5 = astakos.CachedAstakosClient(
+                'http://other.example.com', self.token, cache_file=cache_file)
+            c5.authenticate()
+            self.assertEqual(len(authenticate.mock_calls), 6)
+        finally:
+            rmtree(tmp_dir)
+
+    @patch('%s.LoggedAstakosClient.__init__' % astakos_pkg, return_value=None)
+    @patch('%s.LoggedAstakosClient.authenticate' % astakos_pkg)
+    def test_cache_file_shared_tokens(self, authenticate, super_init):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from os import path
+        from copy import deepcopy
+        tmp_dir = mkdtemp()
+        try:
+            cache_file = path.join(tmp_dir, 'astakos.cache')
+            infos = dict()
+            for token in ('t1', 't2'):
+                infos[token] = deepcopy(example)
+                infos[token]['access']['token']['id'] = token
+                infos[token]['access']['token']['expires'] = (
+                    '2999-01-01T00:00:00+00:00')
+                infos[token]['access']['user']['id'] = 'uuid-%s' % token
+            c1 = astakos.CachedAstakosClient(
+                self.url, 't1', cache_file=cache_file)
+            c2 = astakos.CachedAstakosClient(
+                self.url, 't2', cache_file=cache_file)
+            authenticate.return_value = infos['t1']
+            c1.authenticate()
+            authenticate.return_value = infos['t2']
+            c2.authenticate()
+            self.assertEqual(len(authenticate.mock_calls), 2)
+
+            #  Each instance keeps the tokens cached by the other one
+            c1.remove_user('uuid-t1')
+            c3 = astakos.CachedAstakosClient(
+                self.url, 't2', cache_file=cache_file)
+            self.assertEqual(infos['t2'], c3.authenticate())
+            self.assertEqual(len(authenticate.mock_calls), 2)
+            c3.expire_token('t1')
+            c4 = astakos.CachedAstakosClient(
+                self.url, 't2', cache_file=cache_file)
+            self.assertEqual(infos['t2'], c4.authenticate())
+            self.assertEqual(len(authenticate.mock_calls), 2)
+            authenticate.return_value = infos['t1']
+            c4.authenticate('t1')
+            self.assertEqual(len(authenticate.mock_calls), 3)
+        finally:
+            rmtree(tmp_dir)
+
 
 if __name__ == '__main__':
     from sys import argv
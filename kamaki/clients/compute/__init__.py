@@ -32,6 +32,7 @@
 # or implied, of GRNET S.A.
 
 from kamaki.clients import ClientError
+from kamaki.clients.utils import path4url
 from kamaki.clients.compute.rest_api import ComputeRestClient
 
 
@@ -184,6 +185,21 @@ class ComputeClient(ComputeRestClient):
         r = self.servers_delete(server_id)
         return r.headers
 
+    def delete_servers(self, server_ids, max_threads=None):
+        """Submit deletion requests for many servers concurrently
+
+        :param server_ids: (list) integers (str or int)
+
+        :param max_threads: (int) concurrent requests (default: MAX_THREADS)
+
+        :returns: (dict, dict) {server_id: response headers} of the deleted
+            servers and {server_id: ClientError} of the failed deletions
+        """
+        results, errors = self.batch(dict([(server_id, (
+            'delete', path4url('servers', server_id), None, dict(
+                success=204))) for server_id in server_ids]), max_threads)
+        return dict([(k, r.headers) for k, r in results.items()]), errors
+
     def change_admin_password(self, server_id, new_password):
         """
         :param server_id: (int)
@@ -692,6 +692,22 @@ class ComputeClient(TestCase):
         self.client.delete_server(vm_id)
         SD.assert_called_once_with(vm_id)
 
+    @patch('kamaki.clients.Client.request', return_value=FR())
+    def test_delete_servers(self, request):
+        def delete(method, path, **kwargs):
+            if path.endswith('/2'):
+                raise ClientError('Not found', status=404)
+            return FR()
+        request.side_effect = delete
+        deleted, failed = self.client.delete_servers([1, 2, 3], 2)
+        self.assertEqual(sorted(deleted), [1, 3])
+        self.assertEqual(failed.keys(), [2])
+        self.assertEqual(failed[2].status, 404)
+        self.assertEqual(len(request.mock_calls), 3)
+        self.assertTrue(call(
+            'delete', '/servers/1', async_params={}, success=204) in (
+                request.mock_calls))
+
     @patch('%s.images_delete' % compute_pkg, return_value=FR())
     def test_delete_image(self, ID):
         self.client.delete_image(img_ref)
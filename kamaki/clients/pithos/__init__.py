@@ -31,27 +31,58 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from threading import enumerate as activethreads
-
 from os import fstat
+from os.path import abspath
 from hashlib import new as newhashlib
 from time import time
 from StringIO import StringIO
+from tempfile import TemporaryFile
+from threading import Lock
 
-from binascii import hexlify
+from multiprocessing import cpu_count
 
-from kamaki.clients import SilentEvent, sendlog
+from kamaki.clients import (
+    Executor, ConcurrencyController, sendlog, iter_pages)
 from kamaki.clients.pithos.rest_api import PithosRestClient
 from kamaki.clients.storage import ClientError
-from kamaki.clients.utils import path4url, filter_in, readall
+from kamaki.clients.utils import path4url, filter_in, readall, BlockReader
 
 
 def _pithos_hash(block, blockhash):
     h = newhashlib(blockhash)
-    h.update(block.rstrip('\x00'))
+    h.update(buffer(block, 0, _rstripped_length(block)))
     return h.hexdigest()
 
 
+def _rstripped_length(block, chunk_size=4096):
+    """The length of a block (str or buffer) without trailing null bytes
+    Only the null tail of the block is copied, in chunks
+    """
+    end = len(block)
+    while end > 0:
+        start = max(0, end - chunk_size)
+        chunk = str(buffer(block, start, end - start)).rstrip('\x00')
+        if chunk:
+            return start + len(chunk)
+        end = start
+    return 0
+
+
+def _cpu_count():
+    try:
+        return cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _is_seekable(fileobj):
+    try:
+        fileobj.tell()
+        return True
+    except (IOError, AttributeError):
+        return False
+
+
 def _range_up(start, end, max_value, a_range):
     """
     :param start: (int) the window bottom
@@ -102,10 +133,31 @@ def _range_up(start, end, max_value, a_range):
 class PithosClient(PithosRestClient):
     """Synnefo Pithos+ API client"""
 
+    HASH_THREADS = _cpu_count()
+    #  (hashindex.ListingIndex) if set, iter_objects lists containers from
+    #  this local index, which is synced when a container changes
+    listing_index = None
+    _indexed_listing_args = ('prefix', 'meta')
+    _controller_lock = Lock()
+    #  Bytes of local blocks kept aside while a resumed download moves
+    #  blocks in cycles (e.g., swapped blocks), the rest are downloaded
+    DELTA_STAGING_LIMIT = 64 * 1024 * 1024
+
     def __init__(self, endpoint_url, token, account=None, container=None):
         super(PithosClient, self).__init__(
             endpoint_url, token, account, container)
 
+    def _new_executor(self, size):
+        """Block transfers adapt their concurrency, up to MAX_THREADS
+        The executors of all threads share a controller, so that parallel
+        operations (e.g., upload_objects) stay within MAX_THREADS in total
+        """
+        with self._controller_lock:
+            controller = getattr(self, '_controller', None)
+            if not controller or controller.max_limit != size:
+                controller = self._controller = ConcurrencyController(size)
+        return Executor(size, controller=controller)
+
     def create_container(
             self,
             container=None, sizelimit=None, versioning=None, metadata=None,
@@ -243,13 +295,10 @@ class PithosClient(PithosRestClient):
         return r.headers
 
     # upload_* auxiliary methods
-    def _put_block_async(self, data, hash):
-        event = SilentEvent(method=self._put_block, data=data, hash=hash)
-        event.start()
-        return event
-
     def _put_block(self, data, hash):
-        r = self.container_post(
+        #  Blocks are addressed by hash, so a repeated upload is harmless
+        r = self.retry_policy.run(
+            self.container_post,
             update=True,
             content_type='application/octet-stream',
             content_length=len(data),
@@ -308,70 +357,228 @@ class PithosClient(PithosRestClient):
             success=success)
         return (None if r.status_code == 201 else r.json), r.headers
 
+    def _lookup_hash_index(
+            self, hash_index, fileobj, blocksize, blockhash, size):
+        """Get the hashes of the leading blocks of a file from an index
+        If the file is unchanged, all its hashes are known. Otherwise, the
+        file is hashed again, unless the index is append_only and the file
+        has grown since it was indexed: then the hashes of the old complete
+        blocks are used, as long as the last of them still matches the file
+        contents.
+
+        :returns: (key, hashes) the key is (path, inode, mtime) for updating
+            the index, or None if the file cannot be indexed
+        """
+        try:
+            path = abspath(fileobj.name)
+            stat = fstat(fileobj.fileno())
+            if size != stat.st_size or fileobj.tell():
+                return None, []
+            key = (path, stat.st_ino, stat.st_mtime)
+            entry = hash_index.get(path, blocksize, blockhash)
+        except Exception as e:
+            sendlog.debug('Block hash index lookup failed: %s' % e)
+            return None, []
+        if not entry or entry['inode'] != stat.st_ino:
+            return key, []
+        if entry['size'] == size and entry['mtime'] == stat.st_mtime:
+            sendlog.info('Block hashes of %s are indexed' % path)
+            return key, entry['hashes']
+        if not getattr(hash_index, 'append_only', False):
+            return key, []
+        known = entry['hashes'][:entry['size'] // blocksize]
+        if entry['size'] < size and known:
+            fileobj.seek((len(known) - 1) * blocksize)
+            block = readall(fileobj, blocksize)
+            fileobj.seek(0)
+            if _pithos_hash(block, blockhash) == known[-1]:
+                sendlog.info('Reuse %s indexed block hashes of %s' % (
+                    len(known), path))
+                return key, known
+        return key, []
+
+    def _lookup_upload_journal(
+            self, journal, fileobj, obj, blocksize, blockhash, size):
+        """Get the journal of an unfinished upload of a file to obj
+        The journal is only valid if neither the file nor the block size and
+        hash algorithm of the container have changed since.
+
+        :returns: (key, entry) the key is (path, target, inode, mtime) for
+            updating the journal, or None if the upload cannot be journaled
+        """
+        try:
+            path = abspath(fileobj.name)
+            stat = fstat(fileobj.fileno())
+            if size != stat.st_size or fileobj.tell():
+                return None, None
+            target = self.endpoint_url + path4url(
+                self.account, self.container, obj)
+            key = (path, target, stat.st_ino, stat.st_mtime)
+            entry = journal.get(path, target)
+        except Exception as e:
+            sendlog.debug('Upload journal lookup failed: %s' % e)
+            return None, None
+        if entry and (
+                entry['inode'], entry['size'], entry['mtime'],
+                entry['block_size'], entry['block_hash']) == (
+                    stat.st_ino, size, stat.st_mtime, blocksize, blockhash):
+            return key, entry
+        return key, None
+
     def _calculate_blocks_for_upload(
             self, blocksize, blockhash, size, nblocks, hashes, hmap, fileobj,
-            hash_cb=None):
+            hash_cb=None, hash_index=None):
         offset = 0
         if hash_cb:
             hash_gen = hash_cb(nblocks)
             hash_gen.next()
 
-        for i in xrange(nblocks):
-            block = readall(fileobj, min(blocksize, size - offset))
-            bytes = len(block)
-            if bytes <= 0:
-                break
-            hash = _pithos_hash(block, blockhash)
+        index_key, known_hashes = self._lookup_hash_index(
+            hash_index, fileobj, blocksize, blockhash, size) if (
+                hash_index) else (None, [])
+        for hash in known_hashes:
+            bytes = min(blocksize, size - offset)
             hashes.append(hash)
             hmap[hash] = (offset, bytes)
             offset += bytes
             if hash_cb:
                 hash_gen.next()
+
+        def blocks(offset):
+            for i in xrange(len(known_hashes), nblocks):
+                block = reader.read(offset, min(blocksize, size - offset))
+                if not block:
+                    break
+                offset += len(block)
+                yield dict(block=block, blockhash=blockhash)
+
+        #  hashlib releases the GIL, so hashing threads run in parallel
+        executor, hashed = Executor(max(1, min(
+            self.HASH_THREADS, nblocks - len(known_hashes)))), {}
+        reader = BlockReader(fileobj)
+        try:
+            for job in executor.imap(_pithos_hash, blocks(offset)):
+                if job.exception:
+                    raise job.exception
+                hashed[job.index] = job
+                while len(hashes) - len(known_hashes) in hashed:
+                    job = hashed.pop(len(hashes) - len(known_hashes))
+                    bytes = len(job.kwargs['block'])
+                    hashes.append(job.value)
+                    hmap[job.value] = (offset, bytes)
+                    offset += bytes
+                    if hash_cb:
+                        hash_gen.next()
+        finally:
+            executor.shutdown(wait=True)
+            reader.close()
         msg = ('Failed to calculate uploading blocks: '
                'read bytes(%s) != requested size (%s)' % (offset, size))
         assert offset == size, msg
 
-    def _upload_missing_blocks(self, missing, hmap, fileobj, upload_gen=None):
-        """upload missing blocks asynchronously"""
+        if index_key:
+            path, inode, mtime = index_key
+            try:
+                hash_index.set(
+                    path, blocksize, blockhash, inode, size, mtime, hashes)
+            except Exception as e:
+                sendlog.debug('Block hash index update failed: %s' % e)
+
+    def _hash_and_put_block(self, block, blockhash):
+        hash = _pithos_hash(block, blockhash)
+        self._put_block(block, hash)
+        return hash
+
+    def _upload_blocks_pipelined(
+            self, blocksize, blockhash, size, nblocks, hashes, hmap, fileobj,
+            pipeline, hash_cb=None, upload_cb=None):
+        """Hash and upload blocks at the same time, in block order
+
+        :param pipeline: (int) the max number of blocks in memory, not
+            counting the one being read
+        """
+        gens = [cb(nblocks) for cb in (hash_cb, upload_cb) if cb]
+        for gen in gens:
+            gen.next()
+        #  Running and queued blocks are at most pipeline, so when there are
+        #  as many workers as blocks, blocks are handed to them (no queue)
+        workers = max(1, min(self.MAX_THREADS, pipeline))
+        executor = Executor(
+            workers, max(0, pipeline - workers),
+            controller=self.executor.controller)
+        reader = BlockReader(fileobj)
+
+        def blocks(nblocks):
+            for index in xrange(nblocks):
+                offset = index * blocksize
+                block = reader.read(offset, min(blocksize, size - offset))
+                yield dict(block=block, blockhash=blockhash)
+
+        #  Each block is retried by self.retry_policy
+        finished, failures = dict(), []
+        try:
+            jobs = executor.imap(self._hash_and_put_block, blocks(nblocks))
+            for job in jobs:
+                if job.exception:
+                    sendlog.debug('Block %s: %s' % (job.index, job.exception))
+                    failures.append(job.exception)
+                    continue
+                finished[job.index] = (job.value, len(job.kwargs['block']))
+                for gen in gens:
+                    try:
+                        gen.next()
+                    except Exception:
+                        pass
+        finally:
+            executor.shutdown(wait=True)
+            reader.close()
+        if failures:
+            raise ClientError(
+                '%s blocks failed to upload' % len(failures),
+                details=['%s' % e for e in failures[:10]])
+
+        offset = 0
+        for index in range(nblocks):
+            hash, bytes = finished[index]
+            hashes.append(hash)
+            hmap[hash] = (offset, bytes)
+            offset += bytes
+        msg = ('Failed to upload blocks: '
+               'read bytes(%s) != requested size (%s)' % (offset, size))
+        assert offset == size, msg
+
+    def _upload_missing_blocks(
+            self, missing, hmap, fileobj, upload_gen=None, uploaded_cb=None):
+        """upload missing blocks asynchronously
+
+        :param uploaded_cb: if given, called with the hash of every block
+            the server acknowledges
+
+        :returns: (list of Job) the failed block uploads
+        """
 
-        self._init_thread_limit()
+        def blocks():
+            for hash in missing:
+                offset, bytes = hmap[hash]
+                yield dict(data=reader.read(offset, bytes), hash=hash)
 
-        flying = []
         failures = []
-        for hash in missing:
-            offset, bytes = hmap[hash]
-            fileobj.seek(offset)
-            data = readall(fileobj, bytes)
-            r = self._put_block_async(data, hash)
-            flying.append(r)
-            unfinished = self._watch_thread_limit(flying)
-            for thread in set(flying).difference(unfinished):
-                if thread.exception:
-                    failures.append(thread)
-                    if isinstance(
-                            thread.exception,
-                            ClientError) and thread.exception.status == 502:
-                        self.POOLSIZE = self._thread_limit
-                elif thread.isAlive():
-                    flying.append(thread)
-                elif upload_gen:
+        with BlockReader(fileobj) as reader:
+            for job in self.executor.imap(self._put_block, blocks()):
+                if job.exception:
+                    sendlog.debug('Block %s: %s' % (
+                        job.kwargs['hash'], job.exception))
+                    failures.append(job)
+                    continue
+                if uploaded_cb:
+                    uploaded_cb(job.kwargs['hash'])
+                if upload_gen:
                     try:
                         upload_gen.next()
                     except:
                         pass
-            flying = unfinished
-
-        for thread in flying:
-            thread.join()
-            if thread.exception:
-                failures.append(thread)
-            elif upload_gen:
-                try:
-                    upload_gen.next()
-                except:
-                    pass
 
-        return [failure.kwargs['hash'] for failure in failures]
+        return failures
 
     def upload_object(
             self, obj, f,
@@ -386,7 +593,10 @@ class PithosClient(PithosRestClient):
             content_type=None,
             sharing=None,
             public=None,
-            container_info_cache=None):
+            container_info_cache=None,
+            hash_index=None,
+            pipeline=None,
+            journal=None):
         """Upload an object using multiple connections (threads)
 
         :param obj: (str) remote object path
@@ -420,6 +630,18 @@ class PithosClient(PithosRestClient):
 
         :param container_info_cache: (dict) if given, avoid redundant calls to
             server for container info (block size and hash information)
+
+        :param hash_index: (hashindex.BlockHashIndex) if given, skip hashing
+            the blocks of f that are known from previous uploads
+
+        :param pipeline: (int) if set, upload the blocks while hashing them,
+            without asking the server which ones are missing, and keep up to
+            this many blocks in memory. Suits large, new files
+
+        :param journal: (hashindex.UploadJournal) if given, record the
+            progress of the upload, so that an interrupted upload of f to obj
+            is resumed without rehashing f or uploading blocks again. The
+            blocks uploaded in pipeline mode are not journaled
         """
         self._assert_container()
 
@@ -429,27 +651,77 @@ class PithosClient(PithosRestClient):
         (hashes, hmap, offset) = ([], {}, 0)
         content_type = content_type or 'application/octet-stream'
 
-        self._calculate_blocks_for_upload(
-            *block_info,
-            hashes=hashes,
-            hmap=hmap,
-            fileobj=f,
-            hash_cb=hash_cb)
+        journal_key, entry = self._lookup_upload_journal(
+            journal, f, obj, blocksize, blockhash, size) if (
+                journal) else (None, None)
+        if entry:
+            sendlog.info('Resume upload of %s' % journal_key[0])
+            if hash_cb:
+                hash_gen = hash_cb(nblocks)
+                hash_gen.next()
+            for hash in entry['hashes']:
+                bytes = min(blocksize, size - offset)
+                hashes.append(hash)
+                hmap[hash] = (offset, bytes)
+                offset += bytes
+                if hash_cb:
+                    hash_gen.next()
+        elif pipeline:
+            self._upload_blocks_pipelined(
+                *block_info,
+                hashes=hashes,
+                hmap=hmap,
+                fileobj=f,
+                pipeline=pipeline,
+                hash_cb=hash_cb,
+                upload_cb=upload_cb)
+        else:
+            self._calculate_blocks_for_upload(
+                *block_info,
+                hashes=hashes,
+                hmap=hmap,
+                fileobj=f,
+                hash_cb=hash_cb,
+                hash_index=hash_index)
 
         hashmap = dict(bytes=size, hashes=hashes)
-        missing, obj_headers = self._create_object_or_get_missing_hashes(
-            obj, hashmap,
-            content_type=content_type,
-            size=size,
-            if_etag_match=if_etag_match,
-            if_etag_not_match='*' if if_not_exist else None,
-            content_encoding=content_encoding,
-            content_disposition=content_disposition,
-            permissions=sharing,
-            public=public)
-
-        if missing is None:
-            return obj_headers
+        if entry:
+            missing = [h for h in set(hashes) if h not in entry['uploaded']]
+        else:
+            missing, obj_headers = self._create_object_or_get_missing_hashes(
+                obj, hashmap,
+                content_type=content_type,
+                size=size,
+                if_etag_match=if_etag_match,
+                if_etag_not_match='*' if if_not_exist else None,
+                content_encoding=content_encoding,
+                content_disposition=content_disposition,
+                permissions=sharing,
+                public=public)
+
+            if missing is None:
+                if journal_key:
+                    self._remove_upload_journal(journal, journal_key)
+                return obj_headers
+
+        uploaded_cb, recorder = None, None
+        if journal_key:
+            path, target, inode, mtime = journal_key
+            try:
+                if not entry:
+                    journal.start(
+                        path, target, inode, size, mtime, blocksize,
+                        blockhash, hashes, set(hashes).difference(missing))
+                recorder = journal.uploaded_blocks(path, target)
+            except Exception as e:
+                sendlog.debug('Upload journal update failed: %s' % e)
+
+            def uploaded_cb(hash):
+                try:
+                    if recorder:
+                        recorder.add(hash)
+                except Exception as e:
+                    sendlog.debug('Upload journal update failed: %s' % e)
 
         if upload_cb:
             upload_gen = upload_cb(len(hashmap['hashes']))
@@ -462,43 +734,134 @@ class PithosClient(PithosRestClient):
         else:
             upload_gen = None
 
-        retries = 7
-        while retries:
-            sendlog.info('%s blocks missing' % len(missing))
-            num_of_blocks = len(missing)
-            missing = self._upload_missing_blocks(
-                missing, hmap, f, upload_gen)
-            if missing:
-                if num_of_blocks == len(missing):
-                    retries -= 1
-                else:
-                    num_of_blocks = len(missing)
-            else:
-                break
-        if missing:
+        #  Each block is retried by self.retry_policy
+        sendlog.info('%s blocks missing' % len(missing))
+        try:
+            failures = self._upload_missing_blocks(
+                missing, hmap, f, upload_gen, uploaded_cb)
+        finally:
             try:
-                details = ['%s' % thread.exception for thread in missing]
-            except Exception:
-                details = ['Also, failed to read thread exceptions']
+                if recorder:
+                    recorder.close()
+            except Exception as e:
+                sendlog.debug('Upload journal update failed: %s' % e)
+        if failures:
             raise ClientError(
-                '%s blocks failed to upload' % len(missing),
-                details=details)
+                '%s blocks failed to upload' % len(failures),
+                details=['%s' % job.exception for job in failures[:10]])
 
-        r = self.object_put(
-            obj,
-            format='json',
-            hashmap=True,
-            content_type=content_type,
-            content_encoding=content_encoding,
-            if_etag_match=if_etag_match,
-            if_etag_not_match='*' if if_not_exist else None,
-            etag=etag,
-            json=hashmap,
-            permissions=sharing,
-            public=public,
-            success=201)
+        try:
+            r = self.object_put(
+                obj,
+                format='json',
+                hashmap=True,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                if_etag_match=if_etag_match,
+                if_etag_not_match='*' if if_not_exist else None,
+                etag=etag,
+                json=hashmap,
+                permissions=sharing,
+                public=public,
+                success=201)
+        except ClientError as ce:
+            #  409: the server misses blocks, the journal cannot be trusted
+            if journal_key and ce.status == 409:
+                self._remove_upload_journal(journal, journal_key)
+            raise
+        if journal_key:
+            self._remove_upload_journal(journal, journal_key)
         return r.headers
 
+    def upload_objects(
+            self, uploads,
+            max_files=None,
+            container_info_cache=None,
+            **kwargs):
+        """Upload many files concurrently
+
+        Up to max_files files are uploaded at the same time, each of them
+        with upload_object. The block transfers of all files share the
+        concurrency limit of the client (MAX_THREADS), so that many small
+        files are uploaded in parallel and a few large ones still use all the
+        connections they are allowed to.
+
+        :param uploads: (iterable) of (local file path, remote object path,
+            dict of upload_object arguments for this file, or None). It is
+            consumed while files are uploaded, so it can be a generator
+
+        :param max_files: (int) the max number of files uploaded at the same
+            time (default: MAX_THREADS)
+
+        :param container_info_cache: (dict) see upload_object
+
+        :param kwargs: upload_object arguments for all files (e.g., sharing,
+            public, hash_index, journal), except the progress callbacks
+
+        :returns: (generator) of (local file path, remote object path,
+            response headers, error), in completion order, where error is
+            None if the file was uploaded, otherwise headers is None
+        """
+        self._assert_container()
+        max_files = max(1, int(max_files or self.MAX_THREADS or 1))
+        cache = {} if container_info_cache is None else container_info_cache
+        executors, poolsize = set(), self.poolsize
+
+        def upload(path, obj, file_kwargs):
+            #  The block executor of this thread, shut down at the end
+            executors.add(self.executor)
+            with open(path, 'rb') as f:
+                return self.upload_object(
+                    obj, f, container_info_cache=cache,
+                    **dict(kwargs, **(file_kwargs or {})))
+
+        def file_jobs():
+            for path, obj, file_kwargs in uploads:
+                yield dict(path=path, obj=obj, file_kwargs=file_kwargs)
+
+        self.poolsize = max(poolsize or 0, int(self.MAX_THREADS or 1)) + (
+            max_files)
+        files = Executor(max_files)
+        try:
+            for job in files.imap(upload, file_jobs()):
+                error = job.exception or None
+                if error:
+                    sendlog.debug('Upload of %s failed: %s' % (
+                        job.kwargs['path'], error))
+                yield (
+                    job.kwargs['path'], job.kwargs['obj'],
+                    None if error else job.value, error)
+        finally:
+            files.shutdown(wait=True)
+            for executor in executors:
+                executor.shutdown()
+            self.poolsize = poolsize
+
+    def create_directories(self, names, max_threads=None):
+        """Create many directory objects concurrently
+
+        :param names: (list) the remote directory paths
+
+        :param max_threads: (int) concurrent requests (default: MAX_THREADS)
+
+        :returns: (dict, dict) {name: response headers} of the created
+            directories and {name: ClientError} of the failed ones
+        """
+        self._assert_container()
+        results, errors = self.batch(dict([(name, (
+            'put', path4url(self.account, self.container, name), None, dict(
+                success=201, async_headers={
+                    'Content-Type': 'application/directory',
+                    'Content-Length': '0'}))) for name in names]),
+            max_threads)
+        return dict([(k, r.headers) for k, r in results.items()]), errors
+
+    def _remove_upload_journal(self, journal, key):
+        try:
+            journal.remove(*key[:2])
+        except Exception as e:
+            sendlog.debug('Upload journal update failed: %s' % e)
+
     def upload_from_string(
             self, obj, input_str,
             hash_cb=None,
@@ -582,40 +945,20 @@ class PithosClient(PithosRestClient):
             for i in range(nblocks + 1 - num_of_missing):
                 self._cb_next()
 
-        tries = 7
-        old_failures = 0
+        #  Each block is retried by self.retry_policy
         try:
-            while tries and missing:
-                flying = []
-                failures = []
-                for hash in missing:
-                    offset, block = hmap[hash]
-                    bird = self._put_block_async(block, hash)
-                    flying.append(bird)
-                    unfinished = self._watch_thread_limit(flying)
-                    for thread in set(flying).difference(unfinished):
-                        if thread.exception:
-                            failures.append(thread.kwargs['hash'])
-                        if thread.isAlive():
-                            flying.append(thread)
-                        else:
-                            self._cb_next()
-                    flying = unfinished
-                for thread in flying:
-                    thread.join()
-                    if thread.exception:
-                        failures.append(thread.kwargs['hash'])
-                    self._cb_next()
-                missing = failures
-                if missing and len(missing) == old_failures:
-                    tries -= 1
-                old_failures = len(missing)
-            if missing:
-                raise ClientError('%s blocks failed to upload' % len(missing))
+            failures = []
+            blocks = [dict(data=hmap[h][1], hash=h) for h in missing]
+            for job in self.executor.imap(self._put_block, blocks):
+                if job.exception:
+                    failures.append(job.exception)
+                self._cb_next()
+            if failures:
+                raise ClientError(
+                    '%s blocks failed to upload' % len(failures),
+                    details=['%s' % e for e in failures[:10]])
         except KeyboardInterrupt:
-            sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
+            sendlog.info('- - - threads stopped')
             raise
         self._cb_next()
 
@@ -668,82 +1011,205 @@ class PithosClient(PithosRestClient):
                     self._cb_next()
                     continue
                 args['data_range'] = 'bytes=%s' % data_range
-                r = self.object_get(obj, success=(200, 206), **args)
+                r = self.object_get(
+                    obj, success=(200, 206), stream=True, **args)
+                for chunk in r.iter_content():
+                    dst.write(chunk)
                 self._cb_next()
-                dst.write(r.content)
                 dst.flush()
 
-    def _get_block_async(self, obj, **args):
-        event = SilentEvent(self.object_get, obj, success=(200, 206), **args)
-        event.start()
-        return event
+    def _get_block(self, obj, **args):
+        return self.object_get(obj, success=(200, 206), **args)
 
-    def _hash_from_file(self, fp, start, size, blockhash):
-        fp.seek(start)
-        block = readall(fp, size)
-        h = newhashlib(blockhash)
-        h.update(block.strip('\x00'))
-        return hexlify(h.digest())
+    def _hash_from_file(self, reader, start, size, blockhash):
+        return _pithos_hash(reader.read(start, size), blockhash)
 
-    def _thread2file(self, flying, blockids, local_file, offset=0, **restargs):
-        """write the results of a greenleted rest call to a file
+    def _job2file(self, job, blockids, local_file, offset=0):
+        """write the results of a finished block download job to a file
 
         :param offset: the offset of the file up to blocksize
         - e.g. if the range is 10-100, all blocks will be written to
         normal_position - 10
         """
-        for key, g in flying.items():
-            if g.isAlive():
-                continue
-            if g.exception:
-                raise g.exception
-            block = g.value.content
-            for block_start in blockids[key]:
-                local_file.seek(block_start + offset)
-                local_file.write(block)
+        if job.exception:
+            raise job.exception
+        block = job.value.content
+        for block_start in blockids:
+            local_file.seek(block_start + offset)
+            local_file.write(block)
+            self._cb_next()
+
+    def _hash_local_blocks(self, reader, size, blocksize, blockhash):
+        """:returns: (list) the hashes of the blocks of a local file"""
+        hashes, hashed = [], {}
+
+        def blocks():
+            for offset in xrange(0, size, blocksize):
+                yield dict(
+                    block=reader.read(offset, min(blocksize, size - offset)),
+                    blockhash=blockhash)
+
+        executor = Executor(self.HASH_THREADS)
+        try:
+            for job in executor.imap(_pithos_hash, blocks()):
+                if job.exception:
+                    raise job.exception
+                hashed[job.index] = job.value
+                while len(hashes) in hashed:
+                    hashes.append(hashed.pop(len(hashes)))
+        finally:
+            executor.shutdown(wait=True)
+        return hashes
+
+    def _relocate_blocks(self, local_file, moves, blocksize, total_size):
+        """Copy blocks of a file to other positions of the same file
+
+        Every block is copied to its new positions before they are
+        overwritten, so that blocks are not staged elsewhere, unless they
+        form cycles (e.g., swapped blocks). A block of a cycle is staged in
+        a temporary file, up to DELTA_STAGING_LIMIT bytes in total.
+
+        :param moves: (dict) {destination offset: source offset}
+
+        :returns: (list) the destination offsets which were not written,
+            because the staging limit was reached
+        """
+        readers, remaining, skipped = dict(), set(moves), []
+        for dst, src in moves.items():
+            readers.setdefault(src, []).append(dst)
+        #  pending: the copies which still have to read from an offset
+        pending = dict([(src, len(dsts)) for src, dsts in readers.items()])
+        ready = [dst for dst in moves if not pending.get(dst)]
+        staging, staged = None, dict()
+
+        def read(f, offset):
+            f.seek(offset)
+            block = readall(f, blocksize)
+            return block + '\x00' * (blocksize - len(block))
+
+        try:
+            while remaining:
+                if not ready:
+                    #  A cycle: keep the block of an offset, then overwrite it
+                    offset = min(remaining)
+                    cycle = [dst for dst in readers[offset] if (
+                        dst in remaining)]
+                    if len(staged) * blocksize < self.DELTA_STAGING_LIMIT:
+                        staging = staging or TemporaryFile()
+                        staging.seek(0, 2)
+                        staged[offset] = staging.tell()
+                        staging.write(read(local_file, offset))
+                    else:
+                        remaining.difference_update(cycle)
+                        skipped += cycle
+                    pending[offset] = 0
+                    ready.append(offset)
+                    continue
+                dst = ready.pop()
+                if dst not in remaining:
+                    continue
+                remaining.remove(dst)
+                src = moves[dst]
+                if src in staged:
+                    block = read(staging, staged[src])
+                else:
+                    block = read(local_file, src)
+                    pending[src] -= 1
+                    if not pending[src] and src in remaining:
+                        ready.append(src)
+                local_file.seek(dst)
+                local_file.write(block[:total_size - dst])
                 self._cb_next()
-            flying.pop(key)
-            blockids.pop(key)
+        finally:
+            if staging:
+                staging.close()
         local_file.flush()
+        return skipped
+
+    def _dump_blocks_delta(
+            self, obj, remote_hashes, blocksize, total_size, local_file,
+            blockhash, **restargs):
+        """Update a local file to match a remote object, downloading only
+        the blocks that are not found anywhere in the local file
+
+        Local blocks are indexed by hash, not by position, and are copied to
+        the positions they are needed at (see _relocate_blocks) before the
+        missing blocks are downloaded.
+        """
+        file_size = fstat(local_file.fileno()).st_size
+        reader = BlockReader(local_file) if file_size else None
+        try:
+            local_hashes = self._hash_local_blocks(
+                reader, file_size, blocksize, blockhash) if reader else []
+        finally:
+            if reader:
+                reader.close()
+        sources, moves, fetched = dict(), dict(), dict()
+        for blockid, block_hash in reversed(list(enumerate(local_hashes))):
+            sources[block_hash] = blockid * blocksize
+        for block_hash, blockids in remote_hashes.items():
+            unsaved = [blk * blocksize for blk in blockids if (
+                blk >= len(local_hashes) or (
+                    local_hashes[blk] != block_hash))]
+            self._cb_next(len(blockids) - len(unsaved))
+            if not unsaved:
+                continue
+            if block_hash in sources:
+                for start in unsaved:
+                    moves[start] = sources[block_hash]
+            else:
+                fetched[block_hash] = [blk // blocksize for blk in unsaved]
+
+        sendlog.info('%s blocks found locally, %s blocks to download' % (
+            len(moves), sum([len(blks) for blks in fetched.values()])))
+        for start in self._relocate_blocks(
+                local_file, moves, blocksize, total_size):
+            #  Staging is full, download the block instead
+            block_hash = local_hashes[moves[start] // blocksize]
+            fetched.setdefault(block_hash, []).append(start // blocksize)
+        self._dump_blocks_async(
+            obj, fetched, blocksize, total_size, local_file, **restargs)
 
     def _dump_blocks_async(
             self, obj, remote_hashes, blocksize, total_size, local_file,
             blockhash=None, resume=False, filerange=None, **restargs):
         file_size = fstat(local_file.fileno()).st_size if resume else 0
-        flying = dict()
-        blockid_dict = dict()
+        blockid_list = []
         offset = 0
 
-        self._init_thread_limit()
-        for block_hash, blockids in remote_hashes.items():
-            blockids = [blk * blocksize for blk in blockids]
-            unsaved = [blk for blk in blockids if not (
-                blk < file_size and block_hash == self._hash_from_file(
-                        local_file, blk, blocksize, blockhash))]
-            self._cb_next(len(blockids) - len(unsaved))
-            if unsaved:
-                key = unsaved[0]
-                self._watch_thread_limit(flying.values())
-                self._thread2file(
-                    flying, blockid_dict, local_file, offset,
-                    **restargs)
-                end = total_size - 1 if (
-                    key + blocksize > total_size) else key + blocksize - 1
-                if end < key:
-                    self._cb_next()
-                    continue
-                data_range = _range_up(key, end, total_size, filerange)
-                if not data_range:
-                    self._cb_next()
-                    continue
-                restargs[
-                    'async_headers'] = {'Range': 'bytes=%s' % data_range}
-                flying[key] = self._get_block_async(obj, **restargs)
-                blockid_dict[key] = unsaved
+        def block_requests():
+            for block_hash, blockids in remote_hashes.items():
+                blockids = [blk * blocksize for blk in blockids]
+                unsaved = [blk for blk in blockids if not (
+                    blk < file_size and block_hash == self._hash_from_file(
+                            reader, blk, blocksize, blockhash))]
+                self._cb_next(len(blockids) - len(unsaved))
+                if unsaved:
+                    key = unsaved[0]
+                    end = total_size - 1 if (
+                        key + blocksize > total_size) else key + blocksize - 1
+                    if end < key:
+                        self._cb_next()
+                        continue
+                    data_range = _range_up(key, end, total_size, filerange)
+                    if not data_range:
+                        self._cb_next()
+                        continue
+                    kwargs = dict(restargs, obj=obj)
+                    kwargs['async_headers'] = {
+                        'Range': 'bytes=%s' % data_range}
+                    blockid_list.append(unsaved)
+                    yield kwargs
 
-        for thread in flying.values():
-            thread.join()
-        self._thread2file(flying, blockid_dict, local_file, offset, **restargs)
+        reader = BlockReader(local_file) if file_size else None
+        try:
+            for job in self.executor.imap(self._get_block, block_requests()):
+                self._job2file(
+                    job, blockid_list[job.index], local_file, offset)
+        finally:
+            if reader:
+                reader.close()
+        local_file.flush()
 
     def download_object(
             self, obj, dst,
@@ -759,13 +1225,16 @@ class PithosClient(PithosRestClient):
 
         :param obj: (str) remote object path
 
-        :param dst: open file descriptor (wb+)
+        :param dst: open file descriptor (wb+). If it is a tty or it cannot
+            seek (e.g., a pipe), blocks are streamed to it sequentially
 
         :param download_cb: optional progress.bar object for downloading
 
         :param version: (str) file version
 
-        :param resume: (bool) if set, preserve already downloaded file parts
+        :param resume: (bool) if set, preserve already downloaded file parts.
+            Unless a range is given, blocks found anywhere in dst (e.g., in an
+            older version of the object) are copied instead of downloaded
 
         :param range_str: (str) from, to are file positions (int) in bytes
 
@@ -796,7 +1265,7 @@ class PithosClient(PithosRestClient):
             self.progress_bar_gen = download_cb(len(hash_list))
             self._cb_next()
 
-        if dst.isatty():
+        if dst.isatty() or not _is_seekable(dst):
             self._dump_blocks_sync(
                 obj,
                 hash_list,
@@ -805,6 +1274,16 @@ class PithosClient(PithosRestClient):
                 dst,
                 range_str,
                 **restargs)
+        elif resume and not range_str:
+            self._dump_blocks_delta(
+                obj,
+                remote_hashes,
+                blocksize,
+                total_size,
+                dst,
+                blockhash,
+                **restargs)
+            dst.truncate(total_size)
         else:
             self._dump_blocks_async(
                 obj,
@@ -821,6 +1300,158 @@ class PithosClient(PithosRestClient):
 
         self._complete_cb()
 
+    def _fetch(self, obj, path=None, data_range=None, block_hash=None):
+        """Download a whole object to a local path, or a range of it
+
+        :returns: the response, with its content read
+        """
+        r = self.object_get(
+            obj, success=(200, 206) if data_range else 200,
+            data_range=data_range)
+        content = r.content
+        if path:
+            with open(path, 'wb') as f:
+                f.write(content)
+        return r
+
+    def download_objects(self, downloads, container_info_cache=None):
+        """Download many objects concurrently, over one pool of connections
+
+        Objects that fit in a block are downloaded whole, the others block by
+        block, and all the downloads share the executor of the client (up to
+        MAX_THREADS requests at a time). A block which appears in more than
+        one place (e.g., in many objects) is downloaded only once: it is
+        written to every place that needs it, or copied from a place it is
+        already written to.
+
+        :param downloads: (iterable) of (remote object path, local file path,
+            object size in bytes or None). It is consumed while objects are
+            downloaded, so it can be a generator. Local files are overwritten
+
+        :param container_info_cache: (dict) see upload_object
+
+        :returns: (generator) of (remote object path, local file path, error)
+            in completion order, where error is None if the object was
+            downloaded
+        """
+        self._assert_container()
+        blocksize = self._get_file_block_info(
+            None, 0, container_info_cache)[0]
+        #  stored: {hash: (local path, offset, length)} of written blocks
+        #  inflight: {hash: [(object entry, offset), ...]} of pending blocks
+        #  opened: {id(entry): entry} of objects with blocks still missing
+        stored, inflight, opened, completed = {}, {}, {}, []
+
+        def finish(entry, error=None):
+            if entry['file'].closed:
+                return
+            try:
+                if not error:
+                    entry['file'].truncate(entry['size'])
+            except IOError as e:
+                error = e
+            finally:
+                entry['file'].close()
+                opened.pop(id(entry), None)
+            if error:
+                sendlog.debug('Download of %s failed: %s' % (
+                    entry['obj'], error))
+            completed.append((entry['obj'], entry['path'], error or None))
+
+        def write(entry, offset, block):
+            if entry['file'].closed:
+                return
+            try:
+                entry['file'].seek(offset)
+                entry['file'].write(block)
+                entry['file'].flush()
+            except IOError as e:
+                return finish(entry, e)
+            entry['remaining'] -= 1
+            if not entry['remaining']:
+                finish(entry)
+
+        def copy(entry, offset, length, block_hash):
+            #  Pad or cut, since hashes ignore trailing zeros
+            path, start, stored_length = stored[block_hash]
+            with open(path, 'rb') as f:
+                f.seek(start)
+                block = readall(f, min(stored_length, length))
+            write(entry, offset, block + '\x00' * (length - len(block)))
+
+        def jobs():
+            for obj, path, size in downloads:
+                if size is not None and size <= blocksize:
+                    if size:
+                        yield dict(obj=obj, path=path)
+                        continue
+                    try:
+                        open(path, 'wb').close()
+                        completed.append((obj, path, None))
+                    except IOError as e:
+                        completed.append((obj, path, e))
+                    continue
+                try:
+                    hashmap = self.get_object_hashmap(obj)
+                    entry = dict(
+                        obj=obj, path=path, file=open(path, 'wb'),
+                        size=int(hashmap['bytes']),
+                        remaining=len(hashmap['hashes']))
+                except (ClientError, IOError) as e:
+                    sendlog.debug('Download of %s failed: %s' % (obj, e))
+                    completed.append((obj, path, e))
+                    continue
+                opened[id(entry)] = entry
+                if not entry['remaining']:
+                    finish(entry)
+                obj_blocksize = int(hashmap['block_size'])
+                for index, block_hash in enumerate(hashmap['hashes']):
+                    offset = index * obj_blocksize
+                    length = min(obj_blocksize, entry['size'] - offset)
+                    if entry['file'].closed:
+                        break
+                    elif length <= 0:
+                        write(entry, offset, '')
+                    elif block_hash in stored:
+                        copy(entry, offset, length, block_hash)
+                    elif block_hash in inflight:
+                        inflight[block_hash].append((entry, offset))
+                    else:
+                        inflight[block_hash] = [(entry, offset)]
+                        yield dict(
+                            obj=obj, block_hash=block_hash,
+                            data_range='bytes=%s-%s' % (
+                                offset, offset + length - 1))
+
+        try:
+            for job in self.executor.imap(self._fetch, jobs()):
+                block_hash = job.kwargs.get('block_hash')
+                if not block_hash:
+                    error = job.exception or None
+                    if error:
+                        sendlog.debug('Download of %s failed: %s' % (
+                            job.kwargs['obj'], error))
+                    completed.append(
+                        (job.kwargs['obj'], job.kwargs['path'], error))
+                else:
+                    for entry, offset in inflight.pop(block_hash):
+                        if job.exception:
+                            finish(entry, job.exception)
+                            continue
+                        block = job.value.content
+                        write(entry, offset, block)
+                        if block_hash not in stored and not (
+                                entry['file'].closed and entry['remaining']):
+                            stored[block_hash] = (
+                                entry['path'], offset, len(block))
+                while completed:
+                    yield completed.pop(0)
+            while completed:
+                yield completed.pop(0)
+        finally:
+            for entry in opened.values():
+                entry['file'].close()
+
     def download_to_string(
             self, obj,
             download_cb=None,
@@ -871,35 +1502,31 @@ class PithosClient(PithosRestClient):
             self.progress_bar_gen = download_cb(len(hash_list))
             self._cb_next()
 
-        num_of_blocks = len(remote_hashes)
+        num_of_blocks = len(hash_list)
         ret = [''] * num_of_blocks
-        self._init_thread_limit()
-        flying = dict()
-        try:
-            for blockid, blockhash in enumerate(remote_hashes):
+        requested = []
+
+        def block_requests():
+            for blockid in range(num_of_blocks):
                 start = blocksize * blockid
                 is_last = start + blocksize > total_size
                 end = (total_size - 1) if is_last else (start + blocksize - 1)
                 data_range_str = _range_up(start, end, end, range_str)
                 if data_range_str:
-                    self._watch_thread_limit(flying.values())
-                    restargs['data_range'] = 'bytes=%s' % data_range_str
-                    flying[blockid] = self._get_block_async(obj, **restargs)
-                for runid, thread in flying.items():
-                    if (blockid + 1) == num_of_blocks:
-                        thread.join()
-                    elif thread.isAlive():
-                        continue
-                    if thread.exception:
-                        raise thread.exception
-                    ret[runid] = thread.value.content
-                    self._cb_next()
-                    flying.pop(runid)
+                    requested.append(blockid)
+                    yield dict(
+                        restargs,
+                        obj=obj, data_range='bytes=%s' % data_range_str)
+
+        try:
+            for job in self.executor.imap(self._get_block, block_requests()):
+                if job.exception:
+                    raise job.exception
+                ret[requested[job.index]] = job.value.content
+                self._cb_next()
             return ''.join(ret)
         except KeyboardInterrupt:
-            sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
+            sendlog.info('- - - threads stopped')
 
     #Command Progress Bar method
     def _cb_next(self, step=1):
@@ -1070,6 +1697,114 @@ class PithosClient(PithosRestClient):
                 r.status_code)
         return r.headers
 
+    def _listing_url(self):
+        return '%s%s' % (
+            self.endpoint_url.rstrip('/'),
+            path4url(self.account, self.container))
+
+    def sync_listing_index(self, page_size=None):
+        """List the container again into listing_index, if it has changed
+        since it was last listed. A container is assumed unchanged if its
+        Last-Modified header, object count and bytes used are the same.
+
+        :param page_size: (int) the objects requested per page
+
+        :returns: (bool) True if the container was listed again
+        """
+        self._assert_container()
+        index, url = self.listing_index, self._listing_url()
+        if index.is_fresh(url):
+            return False
+        headers = self.container_head().headers
+        version = '%s %s %s' % tuple([headers.get(k) for k in (
+            'last-modified', 'x-container-object-count',
+            'x-container-bytes-used')])
+        state = index.get_state(url)
+        if state and state['version'] == version:
+            index.touch(url)
+            return False
+        index.update(url, version, self.iter_objects(
+            page_size=page_size, indexed=False))
+        return True
+
+    def iter_objects(
+            self, limit=None, marker=None, page_size=None, indexed=True,
+            **kwargs):
+        """Iterate over the objects of the container, page by page
+        The next page is fetched in the background, while the current one is
+        consumed, so memory does not grow with the size of the container.
+        The container should not change while iterating.
+        If listing_index is set, queries on prefix and meta are answered by
+        the index, which is synced first (see sync_listing_index).
+
+        :param limit: (int) the max number of objects (default: all)
+
+        :param marker: (str) list only objects with names after marker
+
+        :param page_size: (int) the objects requested per page
+            (default: LISTING_PAGE_SIZE)
+
+        :param indexed: (bool) if not set, do not use listing_index
+
+        :param kwargs: passed to container_get (e.g., prefix, delimiter,
+            path, meta, show_only_shared, public, until, if_modified_since)
+
+        :returns: (generator of dicts)
+        """
+        self._assert_container()
+        query = dict([(k, v) for k, v in kwargs.items() if v])
+        if indexed and self.listing_index and not (
+                set(query).difference(self._indexed_listing_args)):
+            self.sync_listing_index(page_size)
+            return self.listing_index.list(
+                self._listing_url(), limit=limit, marker=marker, **query)
+        kwargs['success'] = (200, 204)
+
+        def get_page(limit, marker):
+            r = self.container_get(limit=limit, marker=marker, **kwargs)
+            return r.json if r.status_code == 200 else []
+
+        return iter_pages(
+            get_page, page_size or self.LISTING_PAGE_SIZE, marker, limit)
+
+    def empty_container(self, page_size=None, max_threads=None):
+        """Delete the objects of the container, page by page
+        Instead of a single request which deletes the whole container, the
+        objects of each page are deleted with concurrent requests, so that no
+        request grows with the size of the container.
+
+        :param page_size: (int) the objects deleted per page
+            (default: LISTING_PAGE_SIZE)
+
+        :param max_threads: (int) concurrent requests (default: MAX_THREADS)
+
+        :returns: (int) the number of deleted objects
+
+        :raises ClientError: if some objects could not be deleted
+        """
+        page_size = page_size or self.LISTING_PAGE_SIZE
+        deleted, names = [0], []
+
+        def delete_page():
+            results, errors = self.batch([(
+                'delete', path4url(self.account, self.container, name), None,
+                dict(success=(204, 404))) for name in names], max_threads)
+            deleted[0] += len(results)
+            if errors:
+                raise ClientError(
+                    'Failed to delete %s objects' % len(errors),
+                    details=['%s: %s' % (names[i], e) for i, e in sorted(
+                        errors.items())])
+            del names[:]
+
+        for obj in self.iter_objects(page_size=page_size, indexed=False):
+            names.append(obj['name'])
+            if len(names) >= page_size:
+                delete_page()
+        if names:
+            delete_page()
+        return deleted[0]
+
     def get_container_versioning(self, container=None):
         """
         :param container: (str)
@@ -1236,6 +1971,26 @@ class PithosClient(PithosRestClient):
                 raise ClientError('Object %s not found' % obj, status=404)
             raise
 
+    def get_indexed_object_info(self, obj):
+        """Get the properties of an object from listing_index, as headers,
+        if the index is fresh (see hashindex.ListingIndex.max_age)
+
+        :param obj: (str) remote object path
+
+        :returns: (dict) or None if the object cannot be found in the index
+        """
+        url = self._listing_url()
+        if not (self.listing_index and self.listing_index.is_fresh(url)):
+            return None
+        listed = self.listing_index.get(url, obj)
+        if not listed:
+            return None
+        info = dict([(k.replace('_', '-'), v) for k, v in listed.items()])
+        info.pop('name', None)
+        info['content-length'] = '%s' % info.pop('bytes', 0)
+        info.setdefault('x-object-hash', info.pop('hash', None))
+        return info
+
     def get_object_meta(self, obj, version=None):
         """
         :param obj: (str) remote object path
@@ -1316,45 +2071,30 @@ class PithosClient(PithosRestClient):
         if upload_cb:
             self.progress_bar_gen = upload_cb(nblocks)
             self._cb_next()
-        flying = {}
-        self._init_thread_limit()
-        try:
+
+        def blocks(offset):
             for i in range(nblocks):
                 block = source_file.read(min(blocksize, filesize - offset))
                 offset += len(block)
-
-                self._watch_thread_limit(flying.values())
-                unfinished = {}
-                flying[i] = SilentEvent(
-                    method=self.object_post,
+                yield dict(
                     obj=obj,
                     update=True,
                     content_range='bytes */*',
                     content_type='application/octet-stream',
                     content_length=len(block),
                     data=block)
-                flying[i].start()
 
-                for key, thread in flying.items():
-                    if thread.isAlive():
-                        if i < (nblocks - 1):
-                            unfinished[key] = thread
-                            continue
-                        thread.join()
-                    if thread.exception:
-                        raise thread.exception
-                    headers[key] = thread.value.headers
-                    self._cb_next()
-                flying = unfinished
+        try:
+            for job in self.executor.imap(self.object_post, blocks(offset)):
+                if job.exception:
+                    raise job.exception
+                headers[job.index] = job.value.headers
+                self._cb_next()
         except KeyboardInterrupt:
-            sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
+            sendlog.info('- - - threads stopped')
         finally:
-            from time import sleep
-            sleep(2 * len(activethreads()))
             self._cb_next()
-        return headers.values()
+        return [headers[key] for key in sorted(headers)]
 
     def truncate_object(self, obj, upto_bytes):
         """
@@ -1517,6 +2257,147 @@ class PithosClient(PithosRestClient):
             delimiter=delimiter)
         return r.headers
 
+    def copy_objects(
+            self, dst_container,
+            prefix='',
+            dst_prefix=None,
+            dst_account=None,
+            move=False,
+            overwrite=True,
+            public=None,
+            content_type=None,
+            max_threads=None,
+            page_size=None):
+        """Copy or move the objects under a prefix, on the server side
+
+        The source container is listed page by page, and a copy (or move)
+        request is sent for each object, up to max_threads at a time. The
+        destination is listed along, so that objects which already exist
+        there with the same hash are skipped (and, if moved, only deleted
+        from the source). Thus, an interrupted transfer is resumed by running
+        it again.
+
+        :param dst_container: (str) destination container
+
+        :param prefix: (str) transfer the objects whose names start with it
+
+        :param dst_prefix: (str) replaces prefix in destination object names
+            (default: prefix)
+
+        :param dst_account: (str) destination account (default: self.account)
+
+        :param move: (bool) move instead of copy
+
+        :param overwrite: (bool) if not set, destination objects with other
+            contents are not replaced, and a ClientError (409) is reported
+
+        :param public: (bool)
+
+        :param content_type: (str)
+
+        :param max_threads: (int) concurrent requests (default: MAX_THREADS)
+
+        :param page_size: (int) the objects listed per page
+            (default: LISTING_PAGE_SIZE)
+
+        :returns: (generator) of (source object info, destination object path,
+            action, error) in completion order, where action is "copy",
+            "move" or "skip", and error is None if the action succeeded
+        """
+        self._assert_container()
+        dst_account = dst_account or self.account
+        dst_prefix = prefix if dst_prefix is None else dst_prefix
+        in_place = (dst_account, dst_container) == (
+            self.account, self.container)
+        sources = self.iter_objects(
+            prefix=prefix, page_size=page_size, indexed=False)
+        if in_place and dst_prefix.startswith(prefix) and (
+                dst_prefix != prefix):
+            #  Otherwise, new objects would show up in the source listing
+            sources = list(sources)
+        dst_client = PithosClient(
+            self.endpoint_url, self.token, dst_account, dst_container)
+        for setting in (
+                'CONNECT_TIMEOUT', 'READ_TIMEOUT', 'CONNECTION_RETRY_LIMIT',
+                'MAX_THREADS', 'retry_policy', 'response_cache', 'poolsize',
+                'LOG_TOKEN', 'LOG_DATA', 'LOG_PID'):
+            setattr(dst_client, setting, getattr(self, setting))
+        dst_client.trace_hooks = list(self.trace_hooks)
+        dst_objects = dst_client.iter_objects(
+            prefix=dst_prefix, page_size=page_size, indexed=False)
+        current, skipped = [next(dst_objects, None)], []
+
+        def find(name):
+            """Both listings are sorted, so the destination listing is
+            consumed up to name"""
+            while current[0] and current[0]['name'] < name:
+                current[0] = next(dst_objects, None)
+            if current[0] and current[0]['name'] == name:
+                return current[0]
+
+        def transfer(http_method, path, headers, success, **report):
+            #  A move which succeeded, but its response was lost, fails if
+            #  it is repeated, so moves are never retried
+            return self.request(
+                http_method, path, success=success, async_headers=headers,
+                idempotent=False if 'X-Move-From' in headers else None)
+
+        def jobs():
+            for obj in sources:
+                name = obj['name']
+                dst_name = dst_prefix + name[len(prefix):]
+                dst_obj = find(dst_name)
+                report = dict(obj=obj, dst_name=dst_name)
+                if dst_obj and dst_obj.get('hash') == obj.get('hash') and (
+                        content_type in (None, dst_obj.get('content_type'))
+                        ) and public is None:
+                    if move and not (in_place and dst_name == name):
+                        yield dict(
+                            report, action='skip', http_method='delete',
+                            path=path4url(self.account, self.container, name),
+                            headers={}, success=(204, 404))
+                    else:
+                        skipped.append((obj, dst_name, 'skip', None))
+                    continue
+                if dst_obj and not overwrite:
+                    skipped.append((obj, dst_name, 'skip', ClientError(
+                        'Destination object exists', 409, details=[
+                            '/%s/%s' % (dst_container, dst_name)])))
+                    continue
+                headers = {
+                    'X-Move-From' if move else 'X-Copy-From': path4url(
+                        self.container, name),
+                    'X-Source-Account': self.account,
+                    'Content-Length': '0'}
+                if content_type:
+                    headers['Content-Type'] = content_type
+                if public is not None:
+                    headers['X-Object-Public'] = '%s' % public
+                yield dict(
+                    report, action='move' if move else 'copy',
+                    http_method='put',
+                    path=path4url(dst_account, dst_container, dst_name),
+                    headers=headers, success=201)
+
+        size = max(1, int(max_threads or self.MAX_THREADS or 1))
+        executor = Executor(size)
+        try:
+            for job in executor.imap(transfer, jobs()):
+                while skipped:
+                    yield skipped.pop(0)
+                error = job.exception or None
+                if error:
+                    sendlog.debug('Failed to %s %s: %s' % (
+                        job.kwargs['action'], job.kwargs['obj']['name'],
+                        error))
+                yield (
+                    job.kwargs['obj'], job.kwargs['dst_name'],
+                    job.kwargs['action'], error)
+            while skipped:
+                yield skipped.pop(0)
+        finally:
+            executor.shutdown()
+
     def get_sharing_accounts(self, limit=None, marker=None, *args, **kwargs):
         """Get accounts that share with self.account
 
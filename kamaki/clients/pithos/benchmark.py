@@ -0,0 +1,493 @@
+# Copyright 2015 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+"""A local Pithos stub server and a transfer benchmark
+
+Run a benchmark from the command line, e.g.:
+
+    python -m kamaki.clients.pithos.benchmark --sizes 4M,64M --threads 1,8
+
+The server keeps blocks and objects in memory and implements only the calls
+of the transfer methods: container info, block uploads, hashmap uploads,
+hashmap and ranged downloads and appends, as well as paginated container
+listings, server side copies and moves and object deletions.
+"""
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+from urllib2 import unquote
+from threading import Thread, Lock
+from multiprocessing import Process, Queue
+from tempfile import NamedTemporaryFile, TemporaryFile
+from json import dumps, loads
+from time import time
+from hashlib import new as newhashlib
+from itertools import product
+import os
+import resource
+
+from kamaki.clients.pithos import PithosClient, _pithos_hash
+
+
+OPERATIONS = (
+    'upload_object', 'download_object', 'download_to_string',
+    'append_object')
+
+
+class PithosStubHandler(BaseHTTPRequestHandler):
+    """Serve the Pithos calls of block transfers, from memory"""
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        parsed = urlparse(self.path)
+        names = [unquote(p) for p in parsed.path.split('/')[2:]]
+        params = parse_qs(parsed.query, keep_blank_values=True)
+        return names[0] if names else '', '/'.join(names[1:]), params
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _reply(self, status, body='', **headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key.replace('_', '-'), value)
+        self.send_header('Content-Length', '%s' % len(body))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        container, obj, params = self._parse()
+        if obj:
+            size, hashes = self.server.get_object(container, obj)
+            if hashes is None:
+                return self._reply(404)
+            return self._reply(200, Content_Type='application/octet-stream')
+        objects = self.server.list_objects(container, limit=None)
+        self._reply(
+            204,
+            X_Container_Block_Size='%s' % self.server.block_size,
+            X_Container_Block_Hash=self.server.block_hash,
+            X_Container_Object_Count='%s' % len(objects),
+            X_Container_Bytes_Used='%s' % sum([o[1] for o in objects]))
+
+    def do_GET(self):
+        container, obj, params = self._parse()
+        if not obj:
+            return self._list(container, params)
+        size, hashes = self.server.get_object(container, obj)
+        if hashes is None:
+            return self._reply(404)
+        if 'hashmap' in params:
+            return self._reply(200, dumps(dict(
+                block_size=self.server.block_size,
+                block_hash=self.server.block_hash,
+                bytes=size,
+                hashes=hashes)), Content_Type='application/json')
+        data_range = self.headers.get('Range')
+        if not data_range:
+            return self._reply(200, self.server.read(size, hashes, 0, size))
+        start, sep, end = data_range.split('=')[-1].partition('-')
+        if ',' in end:
+            return self._reply(416)
+        start, end = int(start or 0), min(int(end or size - 1), size - 1)
+        self._reply(
+            206, self.server.read(size, hashes, start, end + 1),
+            Content_Range='bytes %s-%s/%s' % (start, end, size))
+
+    def _list(self, container, params):
+        objects = self.server.list_objects(
+            container,
+            prefix=params.get('prefix', [''])[0],
+            marker=params.get('marker', [''])[0],
+            limit=int(params.get('limit', [10000])[0]))
+        if not objects:
+            return self._reply(204)
+        self._reply(200, dumps([dict(
+            name=name, bytes=size, content_type='application/octet-stream',
+            hash=self.server.object_hash(hashes)
+        ) for name, size, hashes in objects]), Content_Type='application/json')
+
+    def do_DELETE(self):
+        container, obj, params = self._parse()
+        self._reply(204 if self.server.delete_object(container, obj) else 404)
+
+    def do_PUT(self):
+        container, obj, params = self._parse()
+        body = self._read_body()
+        source = self.headers.get('X-Copy-From') or self.headers.get(
+            'X-Move-From')
+        if source:
+            src_container, sep, src_obj = unquote(source).strip(
+                '/').partition('/')
+            size, hashes = self.server.get_object(src_container, src_obj)
+            if hashes is None:
+                return self._reply(404)
+            self.server.set_object(container, obj, size, hashes)
+            if self.headers.get('X-Move-From') and (
+                    src_container, src_obj) != (container, obj):
+                self.server.delete_object(src_container, src_obj)
+            return self._reply(201)
+        if 'hashmap' not in params:
+            hashes = self.server.put_blocks(body)
+            self.server.set_object(container, obj, len(body), hashes)
+            return self._reply(201)
+        hashmap = loads(body)
+        missing = self.server.missing(hashmap['hashes'])
+        if missing:
+            return self._reply(
+                409, dumps(missing), Content_Type='application/json')
+        self.server.set_object(
+            container, obj, hashmap['bytes'], hashmap['hashes'])
+        self._reply(201, ETag=self.server.block_hash)
+
+    def do_POST(self):
+        container, obj, params = self._parse()
+        body = self._read_body()
+        if not obj:
+            hashes = self.server.put_blocks(body)
+            return self._reply(
+                202, dumps(hashes), Content_Type='application/json')
+        if self.server.append(container, obj, body):
+            return self._reply(204)
+        self._reply(404)
+
+
+class PithosStubServer(ThreadingMixIn, HTTPServer):
+    """An in-memory Pithos server, for tests and benchmarks
+
+    Objects are kept as lists of block hashes, as in Pithos. Block data are
+    kept without trailing null bytes, as they are hashed.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+            self, address=('127.0.0.1', 0), block_size=4 * 1024 * 1024,
+            block_hash='sha256'):
+        HTTPServer.__init__(self, address, PithosStubHandler)
+        self.block_size, self.block_hash = block_size, block_hash
+        self.blocks, self.objects, self.lock = dict(), dict(), Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def start(self):
+        """Serve requests in a daemon thread"""
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def put_blocks(self, data):
+        """Store data in blocks
+
+        :returns: (list) the block hashes
+        """
+        hashes = []
+        for start in xrange(0, len(data), self.block_size):
+            block = data[start:start + self.block_size]
+            hash = _pithos_hash(block, self.block_hash)
+            with self.lock:
+                self.blocks[hash] = block.rstrip('\x00')
+            hashes.append(hash)
+        return hashes
+
+    def object_hash(self, hashes):
+        """A hash of the object contents, as in listings (not a Merkle root)
+        """
+        return newhashlib(self.block_hash, ''.join(hashes)).hexdigest()
+
+    def missing(self, hashes):
+        with self.lock:
+            return [h for h in set(hashes) if h not in self.blocks]
+
+    def get_object(self, container, obj):
+        """:returns: (size, hashes) or (0, None) if not found"""
+        with self.lock:
+            return self.objects.get((container, obj), (0, None))
+
+    def set_object(self, container, obj, size, hashes):
+        with self.lock:
+            self.objects[(container, obj)] = (size, list(hashes))
+
+    def list_objects(self, container, prefix='', marker='', limit=10000):
+        """:returns: (list) (name, size, hashes) of the objects after marker
+        """
+        with self.lock:
+            names = sorted([name for cnt, name in self.objects if (
+                cnt == container and name.startswith(prefix) and (
+                    name > marker))])[:limit]
+            return [(name, ) + self.objects[(container, name)] for name in (
+                names)]
+
+    def delete_object(self, container, obj):
+        """:returns: (bool) False if the object was not found"""
+        with self.lock:
+            return self.objects.pop((container, obj), None) is not None
+
+    def read(self, size, hashes, start, end):
+        """:returns: (str) the object bytes from start up to end"""
+        data, first = [], start // self.block_size
+        for index in range(first, 1 + (end - 1) // self.block_size):
+            length = min(self.block_size, size - index * self.block_size)
+            with self.lock:
+                block = self.blocks[hashes[index]]
+            data.append(block + '\x00' * (length - len(block)))
+        offset = start - first * self.block_size
+        return ''.join(data)[offset:offset + end - start]
+
+    def append(self, container, obj, data):
+        """Append data to an object, rewriting its last block"""
+        size, hashes = self.get_object(container, obj)
+        if hashes is None:
+            return False
+        tail = size - size % self.block_size if (
+            size % self.block_size) else size
+        head = hashes[:tail // self.block_size]
+        data = self.read(size, hashes, tail, size) + data
+        self.set_object(
+            container, obj, tail + len(data), head + self.put_blocks(data))
+        return True
+
+
+class TimedPithosClient(PithosClient):
+    """A PithosClient which records the latency of each block transfer"""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedPithosClient, self).__init__(*args, **kwargs)
+        self.latencies, self._latencies_lock = [], Lock()
+
+    def _timed(self, method, *args, **kwargs):
+        start = time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            with self._latencies_lock:
+                self.latencies.append(time() - start)
+
+    def _put_block(self, *args, **kwargs):
+        return self._timed(
+            super(TimedPithosClient, self)._put_block, *args, **kwargs)
+
+    def _get_block(self, *args, **kwargs):
+        return self._timed(
+            super(TimedPithosClient, self)._get_block, *args, **kwargs)
+
+    def object_post(self, *args, **kwargs):
+        return self._timed(
+            super(TimedPithosClient, self).object_post, *args, **kwargs)
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def measure(url, operation, path, size, threads, container='bench'):
+    """Run a transfer operation against a Pithos server
+
+    :param operation: (str) one of OPERATIONS
+
+    :param path: (str) the local file to upload or append
+
+    :param size: (int) the bytes of the file
+
+    :returns: (dict) throughput (bytes/sec), p50 and p99 block latency
+        (sec), peak RSS of the process (KB) and number of block transfers
+    """
+    client = TimedPithosClient(url, 'token', 'account', container)
+    client.MAX_THREADS = threads
+    if operation == 'append_object':
+        client.object_put('appended', data='')
+    start = time()
+    if operation == 'upload_object':
+        with open(path, 'rb') as f:
+            client.upload_object('object', f)
+    elif operation == 'download_object':
+        with TemporaryFile() as f:
+            client.download_object('object', f)
+    elif operation == 'download_to_string':
+        client.download_to_string('object')
+    elif operation == 'append_object':
+        with open(path, 'rb') as f:
+            client.append_object('appended', f)
+    else:
+        raise ValueError('Unknown operation %s' % operation)
+    elapsed = time() - start
+    client.executor.shutdown(wait=True)
+    return dict(
+        throughput=size / elapsed if elapsed else 0.0,
+        p50=_percentile(client.latencies, 50),
+        p99=_percentile(client.latencies, 99),
+        rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        blocks=len(client.latencies))
+
+
+def _serve(block_size, addresses):
+    server = PithosStubServer(block_size=block_size)
+    addresses.put(server.server_address)
+    server.serve_forever()
+
+
+def _measure_in_process(results, *args):
+    try:
+        results.put(measure(*args))
+    except Exception as e:
+        results.put(e)
+
+
+def _isolated(target, *args):
+    """Run target(queue, *args) in a new process, return what it queues"""
+    queue = Queue()
+    process = Process(target=target, args=(queue, ) + args)
+    process.start()
+    try:
+        return queue.get()
+    finally:
+        process.join()
+
+
+def run(sizes, block_sizes, threads, operations=OPERATIONS, out=None):
+    """Benchmark the operations over a matrix of settings
+
+    The server and each measurement run in separate processes, so that they
+    do not compete for the interpreter lock and the peak RSS of each
+    measurement is its own.
+
+    :param sizes: (list of int) file sizes in bytes
+
+    :param block_sizes: (list of int) server block sizes in bytes
+
+    :param threads: (list of int) MAX_THREADS values
+
+    :param out: (file) if given, print a line per measurement
+
+    :returns: (list of dicts) the settings and results of each measurement
+    """
+    results = []
+    if out:
+        out.write('%-18s %10s %10s %7s %10s %9s %9s %9s\n' % (
+            'operation', 'size', 'block', 'threads', 'MB/s', 'p50 ms',
+            'p99 ms', 'RSS MB'))
+    for block_size in block_sizes:
+        addresses = Queue()
+        server = Process(target=_serve, args=(block_size, addresses))
+        server.daemon = True
+        server.start()
+        try:
+            url = 'http://%s:%s' % addresses.get()
+            for size, thread_count in product(sizes, threads):
+                #  New data for each upload, or the server has all blocks
+                with NamedTemporaryFile() as f:
+                    for written in xrange(0, size, 1024 * 1024):
+                        f.write(os.urandom(min(1024 * 1024, size - written)))
+                    f.flush()
+                    if 'upload_object' not in operations:
+                        _isolated(
+                            _measure_in_process, url, 'upload_object', f.name,
+                            size, thread_count)
+                    for operation in operations:
+                        r = _isolated(
+                            _measure_in_process, url, operation, f.name, size,
+                            thread_count)
+                        if isinstance(r, Exception):
+                            raise r
+                        r.update(
+                            operation=operation, size=size,
+                            block_size=block_size, threads=thread_count)
+                        results.append(r)
+                        if out:
+                            out.write(
+                                '%-18s %10s %10s %7s %10.2f %9.2f %9.2f '
+                                '%9.1f\n' % (
+                                    operation, size, block_size, thread_count,
+                                    r['throughput'] / 1048576.0,
+                                    r['p50'] * 1000, r['p99'] * 1000,
+                                    r['rss'] / 1024.0))
+                            out.flush()
+        finally:
+            server.terminate()
+            server.join()
+    return results
+
+
+def _parse_size(value):
+    value = value.strip().upper()
+    for suffix, factor in (('K', 1024), ('M', 1024 ** 2), ('G', 1024 ** 3)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    from sys import stdout
+    parser = ArgumentParser(description='Benchmark Pithos transfers against '
+                                        'a local stub server')
+    parser.add_argument(
+        '--sizes', default='1M,16M', help='file sizes, e.g., 512K,4M,1G')
+    parser.add_argument(
+        '--block-sizes', default='4M', help='server block sizes')
+    parser.add_argument(
+        '--threads', default='1,4,8', help='MAX_THREADS values')
+    parser.add_argument(
+        '--operations', default=','.join(OPERATIONS),
+        help='any of %s' % ', '.join(OPERATIONS))
+    args = parser.parse_args(argv)
+    operations = args.operations.split(',')
+    for operation in operations:
+        if operation not in OPERATIONS:
+            parser.error('Unknown operation %s' % operation)
+    run(
+        [_parse_size(s) for s in args.sizes.split(',')],
+        [_parse_size(s) for s in args.block_sizes.split(',')],
+        [int(t) for t in args.threads.split(',')],
+        operations,
+        out=stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+# Copyright 2015 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from contextlib import closing
+from json import dumps, loads
+from time import time
+
+from kamaki.clients.utils import open_private_db as _connect
+
+
+class BlockHashIndex(object):
+    """A local index of the block hashes of files, in an sqlite database
+
+    Each entry is keyed by the file path, the block size and the block hash
+    algorithm and stores the inode, size and modification time of the file
+    at the time it was hashed, as well as its block hash list.
+    """
+
+    TIMEOUT = 30
+
+    def __init__(self, path, append_only=False):
+        """
+        :param path: (str) the database file, created if it does not exist
+
+        :param append_only: (bool) if set, files which have grown since they
+            were indexed are trusted to have only been appended to, so the
+            hashes of their old blocks are reused without rehashing them
+        """
+        self.path, self.append_only = path, append_only
+
+    def _connect(self):
+        return _connect(
+            self.path, self.TIMEOUT,
+            'CREATE TABLE IF NOT EXISTS block_hashes ('
+            'path TEXT, block_size INTEGER, block_hash TEXT, '
+            'inode INTEGER, size INTEGER, mtime REAL, hashes TEXT, '
+            'PRIMARY KEY (path, block_size, block_hash))')
+
+    def get(self, path, blocksize, blockhash):
+        """
+        :param path: (str) the absolute path of the file
+
+        :param blocksize: (int)
+
+        :param blockhash: (str) the block hash algorithm
+
+        :returns: (dict) with keys inode, size, mtime and hashes, or None if
+            the file is not indexed
+        """
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'SELECT inode, size, mtime, hashes FROM block_hashes '
+                'WHERE path = ? AND block_size = ? AND block_hash = ?',
+                (path, blocksize, blockhash)).fetchone()
+        if row:
+            inode, size, mtime, hashes = row
+            return dict(
+                inode=inode, size=size, mtime=mtime,
+                hashes=hashes.split() if hashes else [])
+        return None
+
+    def set(self, path, blocksize, blockhash, inode, size, mtime, hashes):
+        """Add or replace the entry of a file
+
+        :param hashes: (list) the block hashes of the file
+        """
+        with closing(self._connect()) as db:
+            with db:
+                db.execute(
+                    'INSERT OR REPLACE INTO block_hashes VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        path, blocksize, blockhash, inode, size, mtime,
+                        ' '.join(hashes)))
+
+    def remove(self, path):
+        """Remove all entries of a file"""
+        with closing(self._connect()) as db:
+            with db:
+                db.execute(
+                    'DELETE FROM block_hashes WHERE path = ?', (path, ))
+
+
+class UploadJournal(object):
+    """A journal of unfinished uploads, in an sqlite database
+
+    Each upload is keyed by the path of the local file and the remote
+    object it is uploaded to. It stores the inode, size and modification
+    time of the file, its block size, block hash algorithm and block hash
+    list, as well as the hashes of the blocks the server is known to have.
+    An upload is journaled after the server is asked for the missing blocks
+    and is removed when the remote object is created.
+    """
+
+    TIMEOUT = 30
+    #  UploadedBlocks commit after that many blocks
+    COMMIT_INTERVAL = 64
+
+    def __init__(self, path):
+        """:param path: (str) the database file, created if it does not exist
+        """
+        self.path = path
+
+    def _connect(self):
+        return _connect(
+            self.path, self.TIMEOUT,
+            'CREATE TABLE IF NOT EXISTS uploads ('
+            'path TEXT, target TEXT, inode INTEGER, size INTEGER, '
+            'mtime REAL, block_size INTEGER, block_hash TEXT, hashes TEXT, '
+            'PRIMARY KEY (path, target))',
+            'CREATE TABLE IF NOT EXISTS uploaded_blocks ('
+            'path TEXT, target TEXT, hash TEXT, '
+            'PRIMARY KEY (path, target, hash))')
+
+    def get(self, path, target):
+        """
+        :param path: (str) the absolute path of the local file
+
+        :param target: (str) the URL of the remote object
+
+        :returns: (dict) with keys inode, size, mtime, block_size,
+            block_hash, hashes and uploaded (a set of block hashes), or None
+            if the upload is not journaled
+        """
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'SELECT inode, size, mtime, block_size, block_hash, hashes '
+                'FROM uploads WHERE path = ? AND target = ?',
+                (path, target)).fetchone()
+            if not row:
+                return None
+            uploaded = db.execute(
+                'SELECT hash FROM uploaded_blocks '
+                'WHERE path = ? AND target = ?', (path, target)).fetchall()
+        inode, size, mtime, blocksize, blockhash, hashes = row
+        return dict(
+            inode=inode, size=size, mtime=mtime,
+            block_size=blocksize, block_hash=blockhash,
+            hashes=hashes.split() if hashes else [],
+            uploaded=set(hash for (hash, ) in uploaded))
+
+    def start(
+            self, path, target, inode, size, mtime, blocksize, blockhash,
+            hashes, uploaded=()):
+        """Add or replace the journal of an upload
+
+        :param hashes: (list) the block hashes of the file
+
+        :param uploaded: (iterable) the hashes of the blocks the server has
+        """
+        with closing(self._connect()) as db:
+            with db:
+                db.execute(
+                    'DELETE FROM uploaded_blocks '
+                    'WHERE path = ? AND target = ?', (path, target))
+                db.execute(
+                    'INSERT OR REPLACE INTO uploads VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        path, target, inode, size, mtime, blocksize,
+                        blockhash, ' '.join(hashes)))
+                db.executemany(
+                    'INSERT OR IGNORE INTO uploaded_blocks VALUES (?, ?, ?)',
+                    [(path, target, hash) for hash in set(uploaded)])
+
+    def add_uploaded(self, path, target, hash):
+        """Record that the server has acknowledged a block
+        To record many blocks, use uploaded_blocks instead
+        """
+        with closing(self._connect()) as db:
+            with db:
+                db.execute(
+                    'INSERT OR IGNORE INTO uploaded_blocks VALUES (?, ?, ?)',
+                    (path, target, hash))
+
+    def uploaded_blocks(self, path, target):
+        """:returns: (UploadedBlocks) a recorder of the blocks the server
+            acknowledges during an upload, to be closed when it ends
+        """
+        return UploadedBlocks(self, path, target)
+
+    def remove(self, path, target):
+        """Remove the journal of an upload"""
+        with closing(self._connect()) as db:
+            with db:
+                db.execute(
+                    'DELETE FROM uploads WHERE path = ? AND target = ?',
+                    (path, target))
+                db.execute(
+                    'DELETE FROM uploaded_blocks '
+                    'WHERE path = ? AND target = ?', (path, target))
+
+
+class UploadedBlocks(object):
+    """Record the acknowledged blocks of an upload in an UploadJournal
+
+    A single connection is kept for the whole upload, and the records are
+    committed every COMMIT_INTERVAL blocks and on close, so that a block
+    costs neither a connection nor a commit.
+    """
+
+    def __init__(self, journal, path, target):
+        self.path, self.target = path, target
+        self.interval = journal.COMMIT_INTERVAL
+        self._db, self._pending = journal._connect(), 0
+
+    def add(self, hash):
+        """Record that the server has acknowledged a block"""
+        self._db.execute(
+            'INSERT OR IGNORE INTO uploaded_blocks VALUES (?, ?, ?)',
+            (self.path, self.target, hash))
+        self._pending += 1
+        if self._pending >= self.interval:
+            self.commit()
+
+    def commit(self):
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        """Commit the pending records and close the connection"""
+        try:
+            self.commit()
+        finally:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _match_meta(obj, queries):
+    """Evaluate Pithos metadata queries (<key>, !<key>, <key><op><value>,
+    where <op> is one of =, !=, <=, >=, <, >) on a listed object
+    """
+    meta = dict([(k[len('x_object_meta_'):].lower(), v) for k, v in (
+        obj.items()) if k.lower().startswith('x_object_meta_')])
+    for query in queries:
+        query = query.strip()
+        if not query:
+            continue
+        if query.startswith('!'):
+            if query[1:].lower() in meta:
+                return False
+            continue
+        for op in ('!=', '<=', '>=', '=', '<', '>'):
+            key, sep, value = query.partition(op)
+            if sep:
+                break
+        if key.lower() not in meta:
+            return False
+        if not sep:
+            continue
+        v = meta[key.lower()]
+        if not {
+                '=': v == value, '!=': v != value,
+                '<=': v <= value, '>=': v >= value,
+                '<': v < value, '>': v > value}[op]:
+            return False
+    return True
+
+
+class ListingIndex(object):
+    """A local mirror of container listings, in an sqlite database
+
+    Each container is keyed by its URL and stores the version of the
+    container it was listed at (a signature of its Last-Modified header,
+    object count and bytes used) and the name, size, hash, modification
+    time, content type and other listed properties (e.g., metadata) of its
+    objects.
+    """
+
+    TIMEOUT = 30
+    _columns = ('name', 'bytes', 'hash', 'last_modified', 'content_type')
+
+    def __init__(self, path, max_age=0):
+        """
+        :param path: (str) the database file, created if it does not exist
+
+        :param max_age: (float) seconds after a listing is synced, during
+            which it is used without asking the server if it has changed
+        """
+        self.path, self.max_age = path, max_age
+
+    def _connect(self):
+        return _connect(
+            self.path, self.TIMEOUT,
+            'CREATE TABLE IF NOT EXISTS listings ('
+            'url TEXT PRIMARY KEY, version TEXT, synced REAL)',
+            'CREATE TABLE IF NOT EXISTS listed_objects ('
+            'url TEXT, name TEXT, bytes INTEGER, hash TEXT, '
+            'last_modified TEXT, content_type TEXT, meta TEXT, '
+            'PRIMARY KEY (url, name))')
+
+    def _to_dict(self, row):
+        obj = loads(row[-1]) if row[-1] else dict()
+        obj.update(zip(self._columns, row[:-1]))
+        return obj
+
+    def get_state(self, url):
+        """:returns: (dict) with keys version and synced (a timestamp), or
+            None if the container is not indexed
+        """
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'SELECT version, synced FROM listings WHERE url = ?',
+                (url, )).fetchone()
+        return dict(version=row[0], synced=row[1]) if row else None
+
+    def is_fresh(self, url):
+        """:returns: (bool) if the listing was synced less than max_age ago
+        """
+        state = self.get_state(url)
+        return bool(state and time() - state['synced'] < self.max_age)
+
+    def touch(self, url):
+        """Mark the listing of a container as synced now"""
+        with closing(self._connect()) as db:
+            with db:
+                db.execute(
+                    'UPDATE listings SET synced = ? WHERE url = ?',
+                    (time(), url))
+
+    def update(self, url, version, objects):
+        """Replace the listing of a container
+
+        :param version: (str) the version of the container
+
+        :param objects: (iterable of dicts) as listed by the server, which
+            is consumed while the old listing is replaced, in a single
+            transaction
+        """
+        def rows():
+            for obj in objects:
+                obj = dict(obj)
+                values = [obj.pop(k, None) for k in self._columns]
+                yield tuple([url] + values + [dumps(obj) if obj else None])
+
+        with closing(self._connect()) as db:
+            with db:
+                db.execute(
+                    'DELETE FROM listed_objects WHERE url = ?', (url, ))
+                db.executemany(
+                    'INSERT OR REPLACE INTO listed_objects VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?)', rows())
+                db.execute(
+                    'INSERT OR REPLACE INTO listings VALUES (?, ?, ?)',
+                    (url, version, time()))
+
+    def list(self, url, prefix=None, marker=None, limit=None, meta=None):
+        """Yield the indexed objects of a container, ordered by name
+
+        :param prefix: (str) only objects starting with prefix
+
+        :param marker: (str) only objects with names after marker
+
+        :param limit: (int) the max number of objects
+
+        :param meta: (list or comma-separated str) metadata queries, as in
+            PithosRestClient.container_get
+
+        :returns: (generator of dicts)
+        """
+        if isinstance(meta, basestring):
+            meta = meta.split(',')
+        prefix, count = prefix or '', 0
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                'SELECT name, bytes, hash, last_modified, content_type, meta '
+                'FROM listed_objects WHERE url = ? AND name > ? '
+                'AND substr(name, 1, ?) = ? ORDER BY name',
+                (url, marker or '', len(prefix), prefix))
+            for row in rows:
+                obj = self._to_dict(row)
+                if meta and not _match_meta(obj, meta):
+                    continue
+                yield obj
+                count += 1
+                if limit and count >= limit:
+                    break
+
+    def get(self, url, name):
+        """:returns: (dict) the indexed object or None"""
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'SELECT name, bytes, hash, last_modified, content_type, meta '
+                'FROM listed_objects WHERE url = ? AND name = ?',
+                (url, name)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def remove(self, url):
+        """Remove the listing of a container"""
+        with closing(self._connect()) as db:
+            with db:
+                db.execute('DELETE FROM listings WHERE url = ?', (url, ))
+                db.execute(
+                    'DELETE FROM listed_objects WHERE url = ?', (url, ))
@@ -536,6 +536,8 @@ class PithosRestClient(StorageClient):
         self.set_param('hashmap', hashmap, iff=hashmap)
         self.set_param('version', version, iff=version)
 
+        #  Object data is transferred as stored, even if it is compressed
+        self.set_header('Accept-Encoding', 'identity')
         self.set_header('Range', data_range)
         self.set_header('If-Range', '', if_range and data_range)
         self.set_header('If-Match', if_etag_match, )
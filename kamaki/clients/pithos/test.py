@@ -38,7 +38,7 @@ from os import urandom
 from itertools import product
 from random import randint
 
-from kamaki.clients import pithos, ClientError
+from kamaki.clients import pithos, ClientError, RetryPolicy
 
 
 rest_pkg = 'kamaki.clients.pithos.rest_api.PithosRestClient'
@@ -150,6 +150,9 @@ class FR(object):
     status = None
     status_code = 200
 
+    def iter_content(self, chunk_size=None):
+        yield self.content
+
 
 class PithosRestClient(TestCase):
 
@@ -159,6 +162,7 @@ class PithosRestClient(TestCase):
         self.client = pithos.PithosRestClient(self.url, self.token)
         self.client.account = user_id
         self.client.container = 'c0nt@1n3r_i'
+        self.client.retry_policy = RetryPolicy(backoff=0.001)
 
     def tearDown(self):
         FR.headers = dict()
@@ -752,6 +756,17 @@ class PithosRestClient(TestCase):
 
 class PithosMethods(TestCase):
 
+    def test__pithos_hash(self):
+        from hashlib import sha256
+        from kamaki.clients.pithos import _pithos_hash
+        for block in (
+                '', '\x00' * 5000, 'data', 'data' + '\x00' * 9000,
+                '\x00' * 7 + urandom(5000) + '\x00' * 4097 + 'end'):
+            expected = sha256(block.rstrip('\x00')).hexdigest()
+            self.assertEqual(_pithos_hash(block, 'sha256'), expected)
+            self.assertEqual(
+                _pithos_hash(buffer(bytearray(block)), 'sha256'), expected)
+
     def test__range_up(self):
         from kamaki.clients.pithos import _range_up
         for args, expected in (
@@ -770,6 +785,383 @@ class PithosMethods(TestCase):
             self.assertEqual(_range_up(*args), expected)
 
 
+class BlockHashIndex(TestCase):
+
+    def setUp(self):
+        from tempfile import mkdtemp
+        from kamaki.clients.pithos.hashindex import BlockHashIndex
+        self.tmpdir = mkdtemp()
+        self.db_path = '%s/cache/blockhashes.db' % self.tmpdir
+        self.index = BlockHashIndex(self.db_path)
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.tmpdir)
+
+    def test_get_set_remove(self):
+        from os import stat
+        self.assertEqual(self.index.get('/a/file', 4, 'sha256'), None)
+        self.assertEqual(stat(self.db_path).st_mode & 0777, 0600)
+        self.index.set('/a/file', 4, 'sha256', 42, 10, 1.5, ['h1', 'h2'])
+        self.index.set('/a/file', 8, 'sha256', 42, 10, 1.5, ['h3'])
+        self.assertEqual(
+            self.index.get('/a/file', 4, 'sha256'),
+            dict(inode=42, size=10, mtime=1.5, hashes=['h1', 'h2']))
+        self.assertEqual(self.index.get('/a/file', 4, 'md5'), None)
+        self.index.set('/a/file', 4, 'sha256', 43, 0, 2.5, [])
+        self.assertEqual(
+            self.index.get('/a/file', 4, 'sha256'),
+            dict(inode=43, size=0, mtime=2.5, hashes=[]))
+        self.index.remove('/a/file')
+        self.assertEqual(self.index.get('/a/file', 8, 'sha256'), None)
+
+
+class UploadJournal(TestCase):
+
+    def setUp(self):
+        from tempfile import mkdtemp
+        from kamaki.clients.pithos.hashindex import UploadJournal
+        self.tmpdir = mkdtemp()
+        self.db_path = '%s/cache/uploads.db' % self.tmpdir
+        self.journal = UploadJournal(self.db_path)
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.tmpdir)
+
+    def test_start_add_uploaded_remove(self):
+        from os import stat
+        self.assertEqual(self.journal.get('/a/file', 'u/c/o'), None)
+        self.assertEqual(stat(self.db_path).st_mode & 0777, 0600)
+        self.journal.start(
+            '/a/file', 'u/c/o', 42, 10, 1.5, 4, 'sha256', ['h1', 'h2', 'h3'],
+            ['h2'])
+        self.journal.start(
+            '/a/file', 'u/c/o2', 42, 10, 1.5, 4, 'sha256', ['h1', 'h2', 'h3'])
+        self.journal.add_uploaded('/a/file', 'u/c/o', 'h3')
+        self.journal.add_uploaded('/a/file', 'u/c/o', 'h3')
+        self.assertEqual(self.journal.get('/a/file', 'u/c/o'), dict(
+            inode=42, size=10, mtime=1.5, block_size=4, block_hash='sha256',
+            hashes=['h1', 'h2', 'h3'], uploaded=set(['h2', 'h3'])))
+        self.assertEqual(
+            self.journal.get('/a/file', 'u/c/o2')['uploaded'], set())
+        self.journal.start(
+            '/a/file', 'u/c/o', 43, 4, 2.5, 4, 'sha256', ['h4'])
+        self.assertEqual(self.journal.get('/a/file', 'u/c/o'), dict(
+            inode=43, size=4, mtime=2.5, block_size=4, block_hash='sha256',
+            hashes=['h4'], uploaded=set()))
+        self.journal.remove('/a/file', 'u/c/o')
+        self.assertEqual(self.journal.get('/a/file', 'u/c/o'), None)
+
+        #  One connection per upload, commits in batches and on close
+        self.journal.COMMIT_INTERVAL = 2
+        blocks = self.journal.uploaded_blocks('/a/file', 'u/c/o2')
+        blocks.add('h1')
+        self.assertEqual(
+            self.journal.get('/a/file', 'u/c/o2')['uploaded'], set())
+        blocks.add('h2')
+        blocks.add('h3')
+        self.assertEqual(self.journal.get('/a/file', 'u/c/o2')['uploaded'], (
+            set(['h1', 'h2'])))
+        with blocks:
+            pass
+        self.assertEqual(self.journal.get('/a/file', 'u/c/o2')['uploaded'], (
+            set(['h1', 'h2', 'h3'])))
+        self.assertNotEqual(self.journal.get('/a/file', 'u/c/o2'), None)
+
+
+class ListingIndex(TestCase):
+
+    def setUp(self):
+        from tempfile import mkdtemp
+        from kamaki.clients.pithos.hashindex import ListingIndex
+        self.tmpdir = mkdtemp()
+        self.db_path = '%s/cache/listings.db' % self.tmpdir
+        self.index = ListingIndex(self.db_path)
+        self.objects = [dict(
+            name='o%s' % i, bytes=i, hash='h%s' % i, last_modified='t%s' % i,
+            content_type='text/plain',
+            x_object_meta_size=('%s' % i) * 2) for i in range(6)]
+        self.objects[0].pop('x_object_meta_size')
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.tmpdir)
+
+    def test_update_list_get(self):
+        from os import stat
+        url = 'http://example.com/u/c'
+        self.assertEqual(self.index.get_state(url), None)
+        self.assertEqual(stat(self.db_path).st_mode & 0777, 0600)
+        self.index.update(url, 'v1', iter(self.objects))
+        self.index.update('%s2' % url, 'v1', self.objects[:1])
+        self.assertEqual(self.index.get_state(url)['version'], 'v1')
+        self.assertEqual(list(self.index.list(url)), self.objects)
+        self.assertEqual(list(self.index.list(
+            url, prefix='o', marker='o1', limit=2)), self.objects[2:4])
+        self.assertEqual(list(self.index.list(url, prefix='x')), [])
+        for meta, expected in (
+                ('size', self.objects[1:]),
+                ('!size', self.objects[:1]),
+                ('size=22', self.objects[2:3]),
+                (['size>=33', 'size!=44'], [self.objects[3], self.objects[5]]),
+                ('size<22,other', [])):
+            self.assertEqual(list(self.index.list(url, meta=meta)), expected)
+        self.assertEqual(self.index.get(url, 'o3'), self.objects[3])
+        self.assertEqual(self.index.get(url, 'o9'), None)
+
+        self.index.update(url, 'v2', self.objects[4:])
+        self.assertEqual(list(self.index.list(url)), self.objects[4:])
+        self.index.remove(url)
+        self.assertEqual(self.index.get_state(url), None)
+        self.assertEqual(self.index.get(url, 'o4'), None)
+        self.assertEqual(len(list(self.index.list('%s2' % url))), 1)
+
+    def test_is_fresh(self):
+        url = 'http://example.com/u/c'
+        self.index.update(url, 'v1', [])
+        self.assertFalse(self.index.is_fresh(url))
+        self.index.max_age = 60
+        self.assertTrue(self.index.is_fresh(url))
+        self.assertFalse(self.index.is_fresh('%s2' % url))
+
+
+class PithosStubServer(TestCase):
+    """Transfer real data to the local Pithos stub server"""
+
+    def setUp(self):
+        from kamaki.clients.pithos.benchmark import PithosStubServer
+        self.server = PithosStubServer(block_size=1024)
+        self.server.start()
+        self.client = pithos.PithosClient(
+            self.server.url, 'token', user_id, 'container')
+        self.client.MAX_THREADS = 3
+
+    def tearDown(self):
+        self.client.executor.shutdown(wait=True)
+        self.server.stop()
+
+    def test_transfers(self):
+        from tempfile import TemporaryFile
+        data = urandom(5000) + '\x00' * 1500 + urandom(100)
+        src = NamedTemporaryFile()
+        src.write(data)
+        src.flush()
+        src.seek(0)
+        self.client.upload_object(obj, src)
+        self.assertEqual(self.server.get_object('container', obj)[0], 6600)
+        self.assertEqual(self.client.download_to_string(obj), data)
+        self.assertEqual(
+            self.client.download_to_string(obj, range_str='1000-2999'),
+            data[1000:3000])
+        dst = TemporaryFile()
+        self.client.download_object(obj, dst)
+        dst.seek(0)
+        self.assertEqual(dst.read(), data)
+
+        self.client.MAX_THREADS = 1
+        src.seek(0)
+        self.client.append_object(obj, src)
+        self.assertEqual(self.client.download_to_string(obj), data + data)
+
+    def test_iter_objects(self):
+        names = ['dir/o%02d' % i for i in range(12)] + ['other']
+        for name in names:
+            self.server.set_object('container', name, 0, [])
+        self.assertEqual(
+            [o['name'] for o in self.client.iter_objects(page_size=5)], names)
+        self.assertEqual([o['name'] for o in self.client.iter_objects(
+            page_size=5, prefix='dir/', marker='dir/o03', limit=6)],
+            names[4:10])
+        self.client.container = 'empty'
+        self.assertEqual(list(self.client.iter_objects()), [])
+
+    def test_upload_objects(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        tmpdir, data = mkdtemp(), dict()
+        try:
+            uploads = []
+            for i in range(8):
+                data['o%s' % i] = urandom(randint(0, 3000))
+                with open('%s/f%s' % (tmpdir, i), 'wb') as f:
+                    f.write(data['o%s' % i])
+                uploads.append(('%s/f%s' % (tmpdir, i), 'o%s' % i, None))
+            uploads.append(('%s/missing' % tmpdir, 'missing', None))
+            uploads[0] = uploads[0][:2] + (dict(content_type='text/x'), )
+            self.client.MAX_THREADS = 2
+            results = list(self.client.upload_objects(
+                iter(uploads), max_files=3))
+            self.assertEqual(len(results), 9)
+            failed = [r for r in results if r[3]]
+            self.assertEqual(len(failed), 1)
+            self.assertEqual(failed[0][:3], (
+                '%s/missing' % tmpdir, 'missing', None))
+            for name, content in data.items():
+                self.assertEqual(
+                    self.client.download_to_string(name), content)
+            #  The blocks of all files share one concurrency budget
+            self.assertTrue(self.client._new_executor(2).controller is (
+                self.client.executor.controller))
+            self.assertEqual(self.client.poolsize, None)
+        finally:
+            rmtree(tmpdir)
+
+    def test_create_directories(self):
+        results, errors = self.client.create_directories(['d1', 'd1/d2'])
+        self.assertEqual(sorted(results), ['d1', 'd1/d2'])
+        self.assertEqual(errors, {})
+        self.assertEqual(
+            self.server.get_object('container', 'd1/d2'), (0, []))
+
+    def test_download_objects(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        tmpdir, shared = mkdtemp(), urandom(1024)
+        data = dict(
+            small=urandom(700),
+            empty='',
+            large=urandom(1024) + shared + '\x00' * 1024 + urandom(300),
+            same=shared + urandom(1024) + shared + shared[:100],
+            padded=shared[:-1] + '\x00')
+        try:
+            for name, content in data.items():
+                self.client.upload_from_string(name, content)
+            downloads = [(name, '%s/%s' % (tmpdir, name), len(content)) for (
+                name, content) in sorted(data.items())]
+            downloads.append(('missing', '%s/missing' % tmpdir, None))
+            downloads.append(('large', '%s/unsized' % tmpdir, None))
+            results = list(self.client.download_objects(iter(downloads)))
+            self.assertEqual(len(results), 7)
+            failed = [r for r in results if r[2]]
+            self.assertEqual(len(failed), 1)
+            self.assertEqual(failed[0][:2], ('missing', '%s/missing' % tmpdir))
+            self.assertEqual(failed[0][2].status, 404)
+            for name, content in data.items():
+                with open('%s/%s' % (tmpdir, name), 'rb') as f:
+                    self.assertEqual(f.read(), content)
+            with open('%s/unsized' % tmpdir, 'rb') as f:
+                self.assertEqual(f.read(), data['large'])
+        finally:
+            rmtree(tmpdir)
+
+    def test_copy_objects(self):
+        data = dict([('dir/o%s' % i, urandom(i * 500)) for i in range(6)])
+        for name, content in data.items():
+            self.client.upload_from_string(name, content)
+        self.client.upload_from_string('other', 'other')
+        traced = []
+        self.client.trace_hooks.append(traced.append)
+        results = list(self.client.copy_objects(
+            'backup', prefix='dir/', dst_prefix='copies/', page_size=4))
+        self.assertEqual(len(results), 6)
+        #  The destination is listed with the settings of the client
+        self.assertTrue([e for e in traced if e['method'] == 'GET' and (
+            '/backup?' in e['url'])])
+        self.assertEqual(set([r[2:] for r in results]), set([
+            ('copy', None)]))
+        for name, content in data.items():
+            self.assertEqual(self.server.get_object(
+                'backup', 'copies/%s' % name[4:])[1], self.server.get_object(
+                    'container', name)[1])
+
+        #  Resume: the objects already copied are skipped
+        self.server.delete_object('backup', 'copies/o1')
+        self.server.set_object('backup', 'copies/o2', 0, [])
+        results = dict([(r[1], r[2:]) for r in self.client.copy_objects(
+            'backup', prefix='dir/', dst_prefix='copies/', overwrite=False)])
+        self.assertEqual(results.pop('copies/o1'), ('copy', None))
+        self.assertEqual(results.pop('copies/o2')[1].status, 409)
+        self.assertEqual(set(results.values()), set([('skip', None)]))
+
+        results = list(self.client.copy_objects(
+            'backup', prefix='dir/', dst_prefix='copies/', move=True))
+        self.assertEqual(sorted([r[2:] for r in results]), [
+            ('move', None)] + [('skip', None)] * 5)
+        self.assertEqual(
+            [o[0] for o in self.server.list_objects('container')], ['other'])
+        self.assertEqual(
+            self.server.get_object('backup', 'copies/o2')[0], 1000)
+
+    def test_move_response_lost(self):
+        from kamaki.clients.pithos.benchmark import PithosStubHandler
+        do_PUT, moves = PithosStubHandler.do_PUT, []
+
+        def lossy_PUT(handler):
+            if handler.headers.get('X-Move-From'):
+                moves.append(handler.path)
+                if len(moves) == 1:
+                    #  Move, but close the connection without a response
+                    handler._reply = lambda *args, **kwargs: setattr(
+                        handler, 'close_connection', 1)
+            do_PUT(handler)
+
+        self.server.set_object('container', 'dir/o', 0, [])
+        self.client.retry_policy = RetryPolicy(backoff=0.001)
+        with patch.object(PithosStubHandler, 'do_PUT', lossy_PUT):
+            results = list(self.client.copy_objects(
+                'backup', prefix='dir/', move=True))
+        self.assertEqual(len(moves), 1)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][2], 'move')
+        self.assertNotEqual(results[0][3].status, 404)
+        self.assertEqual(self.server.get_object('backup', 'dir/o'), (0, []))
+
+    def test_listing_index(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from kamaki.clients.pithos.hashindex import ListingIndex
+        tmpdir = mkdtemp()
+        try:
+            self.client.listing_index = ListingIndex('%s/listings.db' % (
+                tmpdir))
+            for i in range(7):
+                self.server.set_object('container', 'o%s' % i, i, [])
+            self.assertTrue(self.client.sync_listing_index(page_size=3))
+            self.assertFalse(self.client.sync_listing_index())
+            self.assertEqual([o['name'] for o in self.client.iter_objects(
+                prefix='o', marker='o2', limit=3)], ['o3', 'o4', 'o5'])
+            self.assertEqual(self.client.get_indexed_object_info('o1'), None)
+
+            self.server.set_object('container', 'o7', 7, [])
+            self.assertEqual(len(list(self.client.iter_objects())), 8)
+            self.client.listing_index.max_age = 60
+            self.server.delete_object('container', 'o7')
+            self.assertEqual(len(list(self.client.iter_objects())), 8)
+            self.assertEqual(
+                self.client.get_indexed_object_info('o7')['content-length'],
+                '7')
+            self.assertEqual(self.client.get_indexed_object_info('o8'), None)
+            #  Queries which the index cannot answer go to the server
+            self.assertEqual(len(list(self.client.iter_objects(
+                if_unmodified_since='Mon, 04 Mar 2013 18:22:31 GMT'))), 7)
+        finally:
+            rmtree(tmpdir)
+
+    def test_empty_container(self):
+        for i in range(12):
+            self.server.set_object('container', 'o%02d' % i, 0, [])
+        self.server.set_object('other', 'o00', 0, [])
+        self.assertEqual(self.client.empty_container(page_size=5), 12)
+        self.assertEqual(self.server.list_objects('container'), [])
+        self.assertEqual(len(self.server.list_objects('other')), 1)
+        self.assertEqual(self.client.empty_container(), 0)
+
+    def test_measure(self):
+        from kamaki.clients.pithos import benchmark
+        src = NamedTemporaryFile()
+        src.write(urandom(4000))
+        src.flush()
+        for operation in benchmark.OPERATIONS:
+            r = benchmark.measure(
+                self.server.url, operation, src.name, 4000, 2)
+            self.assertEqual(r['blocks'], 4)
+            self.assertTrue(r['throughput'] > 0)
+            self.assertTrue(r['p99'] >= r['p50'] >= 0)
+            self.assertTrue(r['rss'] > 0)
+        self.assertEqual(self.server.get_object('bench', 'appended')[0], 4000)
+
+
 class PithosClient(TestCase):
 
     files = []
@@ -785,6 +1177,102 @@ class PithosClient(TestCase):
         print('\t\tDone')
         return tmpFile
 
+    def test__calculate_blocks_for_upload(self):
+        from os import fstat
+        from kamaki.clients.pithos import _pithos_hash
+        blocksize, blockhash = 16, 'sha256'
+
+        class Index(object):
+            entries, append_only = dict(), True
+
+            def get(self, path, blocksize, blockhash):
+                return self.entries.get((path, blocksize, blockhash))
+
+            def set(self, path, blocksize, blockhash, *args):
+                self.entries[(path, blocksize, blockhash)] = dict(zip(
+                    ('inode', 'size', 'mtime', 'hashes'), args))
+
+        progress = []
+
+        def hash_cb(n):
+            for i in range(n + 1):
+                progress.append(i)
+                yield
+
+        def calculate(tmpFile, index):
+            size = fstat(tmpFile.fileno()).st_size
+            nblocks = 1 + (size - 1) // blocksize
+            hashes, hmap = [], {}
+            tmpFile.seek(0)
+            progress[:] = []
+            self.client._calculate_blocks_for_upload(
+                blocksize, blockhash, size, nblocks, hashes, hmap, tmpFile,
+                hash_cb=hash_cb, hash_index=index)
+            self.assertEqual(progress, range(nblocks + 1))
+            return hashes, hmap
+
+        def expected(data):
+            blocks = [data[i:i + 16] for i in range(0, len(data), 16)]
+            return [_pithos_hash(b, blockhash) for b in blocks]
+
+        self.client.HASH_THREADS = 4
+        self.files.append(NamedTemporaryFile())
+        tmpFile, index = self.files[-1], Index()
+        data = urandom(5 * blocksize + 3)
+        tmpFile.write(data)
+        tmpFile.flush()
+        hashes, hmap = calculate(tmpFile, index)
+        self.assertEqual(hashes, expected(data))
+        for i, h in enumerate(hashes):
+            self.assertEqual(
+                hmap[h], (i * blocksize, min(blocksize, len(data) - i * 16)))
+        self.assertEqual(index.entries.values()[0]['hashes'], hashes)
+
+        with patch('%s._pithos_hash' % pithos.__name__) as PH:
+            self.assertEqual(calculate(tmpFile, index), (hashes, hmap))
+            self.assertFalse(PH.mock_calls)
+
+        #  Appended: hash the last indexed full block and the new ones
+        appended = urandom(2 * blocksize)
+        tmpFile.seek(0, 2)
+        tmpFile.write(appended)
+        tmpFile.flush()
+        with patch(
+                '%s._pithos_hash' % pithos.__name__,
+                side_effect=_pithos_hash) as PH:
+            hashes, hmap = calculate(tmpFile, index)
+            self.assertEqual(len(PH.mock_calls), 1 + 3)
+        self.assertEqual(hashes, expected(data + appended))
+        self.assertEqual(
+            index.entries.values()[0]['size'], len(data + appended))
+
+        #  Modified: hash everything
+        tmpFile.seek(4 * blocksize)
+        tmpFile.write(urandom(16))
+        tmpFile.write(urandom(32))
+        tmpFile.flush()
+        tmpFile.seek(0)
+        data = tmpFile.read()
+        hashes, hmap = calculate(tmpFile, index)
+        self.assertEqual(hashes, expected(data))
+
+        #  Modified in the middle and appended: unless the index is
+        #  append_only, hash everything
+        index.append_only = False
+        tmpFile.seek(2 * blocksize)
+        tmpFile.write(urandom(16))
+        tmpFile.seek(0, 2)
+        tmpFile.write(urandom(16))
+        tmpFile.flush()
+        tmpFile.seek(0)
+        data = tmpFile.read()
+        with patch(
+                '%s._pithos_hash' % pithos.__name__,
+                side_effect=_pithos_hash) as PH:
+            hashes, hmap = calculate(tmpFile, index)
+            self.assertEqual(len(PH.mock_calls), len(expected(data)))
+        self.assertEqual(hashes, expected(data))
+
     def assert_dicts_are_equal(self, d1, d2):
         for k, v in d1.items():
             self.assertTrue(k in d2)
@@ -799,6 +1287,7 @@ class PithosClient(TestCase):
         self.client = pithos.PithosClient(self.url, self.token)
         self.client.account = user_id
         self.client.container = 'c0nt@1n3r_i'
+        self.client.retry_policy = RetryPolicy(backoff=0.001)
 
     def tearDown(self):
         FR.headers = dict()
@@ -846,6 +1335,129 @@ class PithosClient(TestCase):
         for i in range(len(r)):
             self.assert_dicts_are_equal(r[i], container_list[i])
 
+    def test_upload_object_pipelined(self):
+        from kamaki.clients.pithos import _pithos_hash
+        info = dict(container_info)
+        info['x-container-block-size'] = 16
+        data = urandom(16 * 20 + 5)
+        self.files.append(NamedTemporaryFile())
+        tmpFile = self.files[-1]
+        tmpFile.write(data)
+        tmpFile.flush()
+        tmpFile.seek(0)
+        failed = set()
+
+        def post(**kwargs):
+            #  Fail the first attempt to upload every 7th block
+            block = kwargs['data']
+            index = data.index(block) // 16
+            if index % 7 == 0 and index not in failed:
+                failed.add(index)
+                raise ClientError('Temporary failure', 503)
+            r = FR()
+            r.json = [_pithos_hash(block, 'sha256')]
+            return r
+
+        progress = []
+
+        def upload_cb(n):
+            for i in range(n + 1):
+                progress.append(i)
+                yield
+
+        created = FR()
+        created.status_code, created.headers = 201, dict(etag='3746')
+        self.client.MAX_THREADS = 3
+        with patch.object(
+                pithos.PithosClient, 'get_container_info', return_value=info):
+            with patch.object(
+                    pithos.PithosClient, 'container_post',
+                    side_effect=post) as CP:
+                with patch.object(
+                        pithos.PithosClient, 'object_put',
+                        return_value=created) as OP:
+                    r = self.client.upload_object(
+                        obj, tmpFile, pipeline=4, upload_cb=upload_cb)
+        self.assertEqual(r, created.headers)
+        self.assertEqual(len(CP.mock_calls), 21 + len(failed))
+        self.assertEqual(failed, set([0, 7, 14]))
+        self.assertEqual(progress, range(22))
+        self.assertEqual(len(OP.mock_calls), 1)
+        expected = [
+            _pithos_hash(data[i:i + 16], 'sha256') for i in range(0, 325, 16)]
+        self.assertEqual(OP.mock_calls[0][2]['json'], dict(
+            bytes=len(data), hashes=expected))
+
+    def test_upload_object_resumed(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from kamaki.clients.pithos import _pithos_hash
+        from kamaki.clients.pithos.hashindex import UploadJournal
+        info = dict(container_info)
+        info['x-container-block-size'] = 16
+        data = urandom(16 * 20 + 5)
+        self.files.append(NamedTemporaryFile())
+        tmpFile = self.files[-1]
+        tmpFile.write(data)
+        tmpFile.flush()
+        tmpFile.seek(0)
+        hashes = [
+            _pithos_hash(data[i:i + 16], 'sha256') for i in range(0, 325, 16)]
+        tmpdir = mkdtemp()
+        journal = UploadJournal('%s/uploads.db' % tmpdir)
+        posted, broken = [], [True]
+
+        def post(**kwargs):
+            #  The connection breaks after 5 blocks
+            if broken and len(posted) == 5:
+                raise ClientError('Connection lost', 503)
+            r = FR()
+            r.json = [_pithos_hash(kwargs['data'], 'sha256')]
+            posted.append(r.json[0])
+            return r
+
+        missing = FR()
+        missing.status_code, missing.json = 409, hashes[4:]
+        created = FR()
+        created.status_code, created.headers = 201, dict(etag='3746')
+        self.client.MAX_THREADS = 1
+        try:
+            with patch.object(
+                    pithos.PithosClient, 'get_container_info',
+                    return_value=info):
+                with patch.object(
+                        pithos.PithosClient, 'container_post',
+                        side_effect=post):
+                    with patch.object(
+                            pithos.PithosClient, 'object_put',
+                            return_value=missing):
+                        self.assertRaises(
+                            ClientError, self.client.upload_object,
+                            obj, tmpFile, journal=journal)
+                    self.assertEqual(posted, hashes[4:9])
+
+                    posted[:], broken[:] = [], []
+                    tmpFile.seek(0)
+                    with patch.object(
+                            pithos.PithosClient, 'object_put',
+                            return_value=created) as OP:
+                        with patch.object(
+                                pithos.PithosClient,
+                                '_calculate_blocks_for_upload') as CBU:
+                            r = self.client.upload_object(
+                                obj, tmpFile, journal=journal)
+            self.assertEqual(r, created.headers)
+            self.assertEqual(CBU.mock_calls, [])
+            self.assertEqual(sorted(posted), sorted(hashes[9:]))
+            self.assertEqual(len(OP.mock_calls), 1)
+            self.assertEqual(OP.mock_calls[0][2]['json'], dict(
+                bytes=len(data), hashes=hashes))
+            target = '%s/%s/%s/%s' % (
+                self.client.endpoint_url, user_id, self.client.container, obj)
+            self.assertEqual(journal.get(tmpFile.name, target), None)
+        finally:
+            rmtree(tmpdir)
+
     @patch('%s.get_container_info' % pithos_pkg, return_value=container_info)
     @patch('%s.container_post' % pithos_pkg, return_value=FR())
     @patch('%s.object_put' % pithos_pkg, return_value=FR())
@@ -1316,6 +1928,87 @@ class PithosClient(TestCase):
                 GET.mock_calls[-1][2][k],
                 v or kwargs.get(k))
 
+    def test_download_object_delta(self):
+        from kamaki.clients.pithos import _pithos_hash
+        blocks = [urandom(16) for i in range(4)]
+        local = ''.join(blocks[:3]) + blocks[3][:5]
+        remote = ''.join([
+            blocks[0], blocks[3][:5] + '\x00' * 11, urandom(16), blocks[1],
+            blocks[0], blocks[3][:5]])
+        hashes = [
+            _pithos_hash(remote[i:i + 16], 'sha256') for i in range(0, 85, 16)]
+        hashmap = dict(
+            block_size=16, block_hash='sha256', bytes=len(remote),
+            hashes=hashes)
+        self.files.append(NamedTemporaryFile())
+        tmpFile = self.files[-1]
+        tmpFile.write(local)
+        tmpFile.flush()
+        tmpFile.seek(0)
+
+        def get(obj, **kwargs):
+            start, end = kwargs['async_headers']['Range'][6:].split('-')
+            r = FR()
+            r.content = remote[int(start):int(end) + 1]
+            return r
+
+        with patch.object(
+                pithos.PithosClient, 'get_object_hashmap',
+                return_value=hashmap):
+            with patch.object(
+                    pithos.PithosClient, 'object_get',
+                    side_effect=get) as GET:
+                self.client.download_object(obj, tmpFile, resume=True)
+        self.assertEqual(len(GET.mock_calls), 1)
+        self.assertEqual(
+            GET.mock_calls[0][2]['async_headers'], dict(Range='bytes=32-47'))
+        tmpFile.seek(0)
+        self.assertEqual(tmpFile.read(), remote)
+
+    def test_download_object_delta_relocations(self):
+        from tempfile import TemporaryFile
+        from kamaki.clients.pithos import _pithos_hash
+        blocks = [urandom(16) for i in range(7)]
+
+        def download(local, order):
+            remote = ''.join([blocks[i] for i in order])
+            hashmap = dict(
+                block_size=16, block_hash='sha256', bytes=len(remote),
+                hashes=[_pithos_hash(blocks[i], 'sha256') for i in order])
+            self.files.append(NamedTemporaryFile())
+            tmpFile = self.files[-1]
+            tmpFile.write(''.join([blocks[i] for i in local]))
+            tmpFile.flush()
+            tmpFile.seek(0)
+
+            def get(obj, **kwargs):
+                start, end = kwargs['async_headers']['Range'][6:].split('-')
+                r = FR()
+                r.content = remote[int(start):int(end) + 1]
+                return r
+
+            with patch.object(
+                    pithos.PithosClient, 'get_object_hashmap',
+                    return_value=hashmap):
+                with patch.object(
+                        pithos.PithosClient, 'object_get',
+                        side_effect=get) as GET:
+                    with patch(
+                            '%s.TemporaryFile' % pithos.__name__,
+                            side_effect=TemporaryFile) as TF:
+                        self.client.download_object(
+                            obj, tmpFile, resume=True)
+            tmpFile.seek(0)
+            self.assertEqual(tmpFile.read(), remote)
+            return len(GET.mock_calls), len(TF.mock_calls)
+
+        #  Shifted blocks are moved in place, without staging
+        self.assertEqual(download(range(6), [6] + range(6)), (1, 0))
+        #  Swapped blocks are staged, or downloaded beyond the limit
+        self.assertEqual(download(range(6), [6, 0, 1, 2, 5, 4]), (1, 1))
+        self.client.DELTA_STAGING_LIMIT = 0
+        self.assertEqual(download(range(6), [6, 0, 1, 2, 5, 4]), (2, 0))
+
     @patch('%s.get_object_hashmap' % pithos_pkg, return_value=object_hashmap)
     @patch('%s.object_get' % pithos_pkg, return_value=FR())
     def test_download_object(self, GET, GOH):
@@ -1396,12 +2089,26 @@ class PithosClient(TestCase):
         tmpFile.seek(0)
         tmpFile.isatty = foo
         self.client.download_object(obj, tmpFile, **kwargs)
+        self.assertTrue(GET.mock_calls[-1][2]['stream'])
         for k, v in kwargs.items():
             if k == 'range_str':
                 self.assertTrue('data_range' in GET.mock_calls[-1][2])
             else:
                 self.assertEqual(GET.mock_calls[-1][2][k], v)
 
+        #  Not seekable destination, e.g., a pipe
+        from StringIO import StringIO
+        FR.content = 'some sample content'
+        dst, calls = StringIO(), len(GET.mock_calls)
+
+        def tell():
+            raise IOError(29, 'Illegal seek')
+        dst.tell = tell
+        self.client.download_object(obj, dst)
+        num_of_blocks = len(object_hashmap['hashes'])
+        self.assertEqual(len(GET.mock_calls), calls + num_of_blocks)
+        self.assertEqual(dst.getvalue(), FR.content * num_of_blocks)
+
     def test_get_object_hashmap(self):
         FR.json = object_hashmap
         for empty in (304, 412):
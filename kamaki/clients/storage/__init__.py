@@ -31,13 +31,16 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from kamaki.clients import Client, ClientError
+from kamaki.clients import Client, ClientError, iter_pages
 from kamaki.clients.utils import filter_in, filter_out, path4url
 
 
 class StorageClient(Client):
     """OpenStack Object Storage API 1.0 client"""
 
+    #  The max number of objects fetched per request, when iterating
+    LISTING_PAGE_SIZE = 10000
+
     def __init__(self, endpoint_url, token, account=None, container=None):
         super(StorageClient, self).__init__(endpoint_url, token)
         self.account = account
@@ -338,6 +341,47 @@ class StorageClient(Client):
             return []
         return r.json
 
+    def iter_objects(
+            self,
+            limit=None,
+            marker=None,
+            prefix=None,
+            delimiter=None,
+            path=None,
+            page_size=None):
+        """Iterate over the objects of the container, page by page
+        The next page is fetched in the background, while the current one is
+        consumed. The container should not change while iterating.
+
+        :param limit: (integer) The max number of objects (default: all)
+
+        :param marker: (string) Return objects with name lexicographically
+            after marker
+
+        :param prefix: (string) Return objects starting with prefix
+
+        :param delimiter: (string) Return objects up to the delimiter
+
+        :param path: (string) assume prefix = path and delimiter = /
+            (overwrites prefix and delimiter)
+
+        :param page_size: (integer) The objects requested per page
+            (default: LISTING_PAGE_SIZE)
+
+        :returns: (generator of dicts)
+
+        :raises ClientError: 404 Invalid account
+        """
+        self._assert_container()
+
+        def get_page(limit, marker):
+            return self.list_objects(
+                limit=limit, marker=marker, prefix=prefix,
+                delimiter=delimiter, path=path) or []
+
+        return iter_pages(
+            get_page, page_size or self.LISTING_PAGE_SIZE, marker, limit)
+
     def list_objects_in_path(self, path_prefix):
         """
         :param path_prefix: (str)
@@ -412,6 +412,22 @@ class StorageClient(TestCase):
         FR.status_code = 404
         self.assertRaises(ClientError, self.client.list_objects)
 
+    @patch('%s.list_objects' % storage_pkg)
+    def test_iter_objects(self, LO):
+        names = ['o%s' % i for i in range(7)]
+        LO.side_effect = lambda limit, marker, **kw: [dict(name=n) for n in (
+            names) if n > (marker or '')][:limit]
+        r = self.client.iter_objects(prefix='o', page_size=3)
+        self.assertEqual([o['name'] for o in r], names)
+        self.assertEqual(LO.mock_calls, [
+            call(limit=3, marker=None, prefix='o', delimiter=None, path=None),
+            call(limit=3, marker='o2', prefix='o', delimiter=None, path=None),
+            call(limit=3, marker='o5', prefix='o', delimiter=None, path=None)])
+        r = self.client.iter_objects(limit=2, marker='o4', path='p')
+        self.assertEqual([o['name'] for o in r], ['o5', 'o6'])
+        self.assertEqual(LO.mock_calls[-1], call(
+            limit=2, marker='o4', prefix=None, delimiter=None, path='p'))
+
     @patch('%s.get' % client_pkg, return_value=FR())
     @patch('%s.set_param' % client_pkg)
     def test_list_objects_in_path(self, SP, get):
@@ -37,8 +37,9 @@ from time import sleep
 from inspect import getmembers, isclass
 from itertools import product
 from random import randint
+from json import dumps, loads
 
-from kamaki.clients.utils.test import Utils
+from kamaki.clients.utils.test import Utils, ResponseCache
 from kamaki.clients.astakos.test import (
     AstakosClient, LoggedAstakosClient, CachedAstakosClient)
 from kamaki.clients.compute.test import ComputeClient, ComputeRestClient
@@ -49,7 +50,8 @@ from kamaki.clients.cyclades.test import (
 from kamaki.clients.image.test import ImageClient
 from kamaki.clients.storage.test import StorageClient
 from kamaki.clients.pithos.test import (
-    PithosClient, PithosRestClient, PithosMethods)
+    PithosClient, PithosRestClient, PithosMethods, BlockHashIndex,
+    UploadJournal, ListingIndex, PithosStubServer)
 from kamaki.clients.blockstorage.test import (
     BlockStorageRestClient, BlockStorageClient)
 
@@ -153,6 +155,19 @@ class FakeResp(object):
         return self.HEADERS.items()
 
 
+class FakeStreamResp(FakeResp):
+
+    def __init__(self):
+        from StringIO import StringIO
+        self.buffer = StringIO(self.READ)
+
+    def read(self, amt=None):
+        return self.buffer.read(amt) if amt else self.buffer.read()
+
+    def isclosed(self):
+        return self.buffer.tell() == len(self.READ)
+
+
 class ResponseManager(TestCase):
 
     def setUp(self):
@@ -189,6 +204,21 @@ class ResponseManager(TestCase):
         self.assertEqual(self.RM.headers, FakeResp.HEADERS)
         self.assertTrue(isinstance(perform.call_args[0][0], self.HTTPC))
 
+    @patch('kamaki.clients.RequestManager.perform')
+    def test_headers_decoding(self, perform):
+        perform.return_value = FakeResp()
+        perform.return_value.getheaders = lambda: [
+            ('X-Object-Meta-K', '%CE%BA'), ('Name', '%CE%BD'),
+            ('Other', '%CE%BF')]
+        self.RM.headers_to_decode = ['name']
+        self.RM.header_prefices = ['X-Object-Meta-']
+        self.assertEqual(self.RM.status_code, FakeResp.status)
+        self.assertEqual(self.RM._headers, None)
+        self.assertEqual(self.RM.headers, {
+            'X-Object-Meta-K': u'\u03ba', 'Name': u'\u03bd',
+            'Other': '%CE%BF'})
+        self.assertTrue(self.RM.headers is self.RM.headers)
+
     @patch('kamaki.clients.RequestManager.perform', return_value=FakeResp())
     def test_json(self, perform):
         try:
@@ -214,6 +244,304 @@ class ResponseManager(TestCase):
         self.assertEqual(self.RM.headers, FakeResp.HEADERS)
         perform.assert_called_only_once
 
+    @patch('kamaki.clients.RequestManager.perform', return_value=FakeResp())
+    def test_iter_content(self, perform):
+        chunks = list(self.RM.iter_content(3))
+        self.assertEqual(''.join(chunks), FakeResp.READ)
+        self.assertTrue(all([len(c) <= 3 for c in chunks]))
+        self.assertEqual(len(chunks), 1 + (len(FakeResp.READ) - 1) // 3)
+
+    @patch('kamaki.clients.https.PooledHTTPConnection')
+    @patch('kamaki.clients.RequestManager.perform')
+    def test_stream(self, perform, PHC):
+        from kamaki.clients import ResponseManager, RequestManager
+        pooled = PHC.return_value
+        for consume in ('iter_content', 'content', 'close'):
+            pooled.reset_mock()
+            perform.return_value = FakeStreamResp()
+            RM = ResponseManager(
+                RequestManager('GET', 'http://ok', '/'), stream=True)
+            self.assertEqual(RM.status_code, FakeResp.status)
+            self.assertEqual(RM.headers, FakeResp.HEADERS)
+            pooled.acquire.assert_called_once_with()
+            self.assertFalse(pooled.release.mock_calls)
+            if consume == 'iter_content':
+                chunks = RM.iter_content(4)
+                self.assertEqual(chunks.next(), FakeResp.READ[:4])
+                self.assertFalse(pooled.release.mock_calls)
+                self.assertEqual(
+                    FakeResp.READ[4:], ''.join([c for c in chunks]))
+                self.assertFalse(pooled.obj.close.mock_calls)
+            elif consume == 'content':
+                self.assertEqual(RM.content, FakeResp.READ)
+                self.assertEqual(RM.text, FakeResp.READ)
+                self.assertFalse(pooled.obj.close.mock_calls)
+            else:
+                RM.iter_content(4).next()
+                RM.close()
+                pooled.obj.close.assert_called_once_with()
+            pooled.release.assert_called_once_with()
+
+
+class ClientOverhead(TestCase):
+    """Requests on a local server
+    If KAMAKI_BENCHMARK is set, test_request also measures the time kamaki
+    spends on each request"""
+
+    REQUESTS = 200
+
+    def setUp(self):
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+        from threading import Thread
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            wbufsize = -1
+
+            def do_GET(self):
+                if self.path.startswith('/listing'):
+                    return self.listing()
+                if self.path.startswith('/slow'):
+                    sleep(0.5)
+                self.send_response(200)
+                for i in range(20):
+                    self.send_header('X-Object-Meta-Key%s' % i, '%CE%BA')
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write('{}')
+
+            def listing(self):
+                """A large JSON listing, with gzip and ETag support"""
+                from gzip import GzipFile
+                from StringIO import StringIO
+                self.server.listings.append(dict(self.headers))
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = self.server.listing
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    buf = StringIO()
+                    with GzipFile(fileobj=buf, mode='wb') as f:
+                        f.write(body)
+                    body = buf.getvalue()
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', '%s' % len(body))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            listing = dumps([dict(name='object%s' % i) for i in range(1000)])
+            listings = []
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_request(self):
+        from os import environ
+        from time import time
+        from kamaki.clients import Client
+        client = Client(
+            'http://127.0.0.1:%s' % self.server.server_address[1], 'token')
+        client.response_header_prefices = ['X-Object-Meta-']
+        benchmark = environ.get('KAMAKI_BENCHMARK')
+        requests = self.REQUESTS if benchmark else 2
+        for read_headers in (False, True):
+            start = time()
+            for i in range(requests):
+                r = client.get('/path')
+                if read_headers:
+                    self.assertEqual(
+                        r.headers['x-object-meta-key0'], u'\u03ba')
+            if benchmark:
+                per_request = (time() - start) / requests
+                print('%.0f usec per request%s' % (
+                    per_request * 1000000, ' (read headers)' if (
+                        read_headers) else ''))
+            self.assertEqual(r.json, dict())
+
+    def test_trace_hooks(self):
+        from kamaki.clients import Client, add_trace_hook, remove_trace_hook
+
+        class TracedClient(Client):
+            service_type = 'traced'
+
+            def list_things(self):
+                return self.get('/things')
+
+        events, global_events = [], []
+        client = TracedClient(
+            'http://127.0.0.1:%s' % self.server.server_address[1], 'token')
+        client.trace_hooks.append(events.append)
+        add_trace_hook(global_events.append)
+        try:
+            client.list_things()
+            client.list_things()
+            client.get('/path', stream=True).content
+        finally:
+            remove_trace_hook(global_events.append)
+        client.get('/path')
+        self.assertEqual(len(events), 4)
+        self.assertEqual(global_events, events[:3])
+        first, reused = events[:2]
+        for k, v in dict(
+                service='traced', operation='list_things', method='GET',
+                status=200, bytes_out=0, bytes_in=2).items():
+            self.assertEqual(first[k], v)
+        self.assertTrue(first['url'].endswith('/things'))
+        self.assertEqual(
+            set(first['timings']),
+            set(['wait', 'dns', 'connect', 'ttfb', 'body']))
+        self.assertEqual(
+            set(reused['timings']), set(['wait', 'ttfb', 'body']))
+        self.assertTrue(all([t >= 0 for t in first['timings'].values()]))
+        self.assertEqual(events[2]['bytes_in'], 2)
+        self.assertEqual(events[2]['operation'], '')
+
+    def test_timeouts(self):
+        from socket import timeout
+        from time import time
+        from kamaki.clients import (
+            Client, RetryPolicy, Deadline, DeadlineExceeded)
+        client = Client(
+            'http://127.0.0.1:%s' % self.server.server_address[1], 'token')
+        client.retry_policy = RetryPolicy(retries=0)
+        client.READ_TIMEOUT = 0.1
+        self.assertRaises(timeout, client.get, '/slow')
+        client.READ_TIMEOUT = 2
+        self.assertEqual(client.get('/slow').json, dict())
+
+        #  Deadlines cap timeouts and stop retries
+        client.retry_policy = RetryPolicy(retries=5, backoff=0.01)
+        start = time()
+        with Deadline(0.2):
+            self.assertRaises(DeadlineExceeded, client.get, '/slow')
+        self.assertTrue(time() - start < 0.4)
+        self.assertEqual(client.get('/path').json, dict())
+
+    def test_gzip(self):
+        from kamaki.clients import Client
+        client = Client(
+            'http://127.0.0.1:%s' % self.server.server_address[1], 'token')
+        client.trace_hooks.append(lambda event: sizes.append(
+            event['bytes_in']))
+        sizes, expected = [], loads(self.server.listing)
+        self.assertEqual(client.get('/listing').json, expected)
+        r = client.get('/listing', stream=True)
+        self.assertEqual(loads(''.join(r.iter_content(1024))), expected)
+        client.set_header('Accept-Encoding', 'identity')
+        self.assertEqual(client.get('/listing').json, expected)
+        self.assertTrue(sizes[0] == sizes[1] < len(self.server.listing) / 4)
+        self.assertEqual(sizes[2], len(self.server.listing))
+        self.assertEqual([h.get('accept-encoding') for h in (
+            self.server.listings)], ['gzip', 'gzip', 'identity'])
+
+    def test_response_cache(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from kamaki.clients import Client
+        from kamaki.clients.utils.cache import ResponseCache
+        tmpdir = mkdtemp()
+        try:
+            client = Client(
+                'http://127.0.0.1:%s' % self.server.server_address[1], 'tkn')
+            client.response_cache = ResponseCache('%s/responses.db' % tmpdir)
+            expected = loads(self.server.listing)
+            for i in range(3):
+                r = client.get('/listing')
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(r.json, expected)
+                self.assertEqual(r.headers['etag'], '"v1"')
+            r = client.get('/listing', cached=False)
+            self.assertEqual(r.json, expected)
+            self.assertEqual(
+                [h.get('if-none-match') for h in self.server.listings],
+                [None, '"v1"', '"v1"', None])
+
+            #  Other users do not share the cached responses
+            client.token = 'other'
+            client.get('/listing')
+            self.assertEqual(
+                self.server.listings[-1].get('if-none-match'), None)
+        finally:
+            rmtree(tmpdir)
+
+
+class Deadline(TestCase):
+
+    def test_deadline(self):
+        from time import time
+        from kamaki.clients import (
+            Deadline, DeadlineExceeded, get_deadline, time_left)
+        self.assertEqual(get_deadline(), None)
+        self.assertEqual(time_left(), None)
+        with Deadline(10):
+            outer = get_deadline()
+            self.assertTrue(9 < time_left() <= 10)
+            with Deadline(20):
+                self.assertEqual(get_deadline(), outer)
+            with Deadline(0.01):
+                self.assertTrue(get_deadline() < outer)
+                sleep(0.02)
+                self.assertRaises(DeadlineExceeded, time_left)
+            self.assertEqual(get_deadline(), outer)
+        self.assertEqual(get_deadline(), None)
+
+    def test_executor(self):
+        from kamaki.clients import (
+            Deadline, DeadlineExceeded, Executor, time_left)
+        executor, finished = Executor(2), []
+
+        def run(i):
+            sleep(0.05)
+            finished.append(time_left())
+
+        with Deadline(0.2):
+            try:
+                for job in executor.imap(run, [dict(i=i) for i in range(20)]):
+                    if job.exception:
+                        self.assertTrue(
+                            isinstance(job.exception, DeadlineExceeded))
+                self.fail('Deadline not exceeded')
+            except DeadlineExceeded:
+                pass
+        #  Jobs run under the deadline of the caller, the rest are dropped
+        self.assertTrue(0 < len(finished) < 20)
+        self.assertTrue(all([left > 0 for left in finished]))
+
+
+class TraceFile(TestCase):
+
+    def test_call(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from os.path import join
+        from kamaki.clients import TraceFile
+        tmpdir = mkdtemp()
+        try:
+            path = join(tmpdir, 'trace.jsonl')
+            trace = TraceFile(path)
+            trace(dict(status=200, url='http://a'))
+            trace(dict(status=404))
+            with open(path) as f:
+                lines = f.readlines()
+            self.assertEqual(lines, [
+                '{"status": 200, "url": "http://a"}\n', '{"status": 404}\n'])
+        finally:
+            rmtree(tmpdir)
+
 
 class SilentEvent(TestCase):
 
@@ -269,6 +597,319 @@ class SilentEvent(TestCase):
                 self.assertFalse(t.exception)
 
 
+class Executor(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import Executor
+        self.executor = Executor(3)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+
+    def square(self, x, wait=0.0, fail=False):
+        sleep(wait)
+        if fail:
+            raise Exception('Job %s failed' % x)
+        return x * x
+
+    def test___init__(self):
+        from kamaki.clients import Executor
+        self.assertEqual(self.executor.size, 3)
+        self.assertFalse(self.executor.closed)
+        for size in (0, -1, 'not an int'):
+            self.assertRaises(AssertionError, Executor, size)
+
+    def test_submit(self):
+        job = self.executor.submit(self.square, 4)
+        self.assertEqual([job], list(self.executor.finished(wait=True)))
+        self.assertEqual(job.value, 16)
+        self.assertFalse(job.exception)
+        self.assertEqual(len(self.executor._workers), 3)
+
+    def test_imap(self):
+        kwarg_list = [dict(x=x, wait=0.05 * (8 - x)) for x in range(8)]
+        jobs = list(self.executor.imap(self.square, kwarg_list))
+        self.assertEqual(sorted([j.index for j in jobs]), range(8))
+        for job in jobs:
+            self.assertEqual(job.value, job.index * job.index)
+        self.assertNotEqual([j.index for j in jobs], range(8))
+
+        jobs = list(self.executor.imap(self.square, [
+            dict(x=x, fail=bool(x % 2)) for x in range(4)]))
+        for job in jobs:
+            if job.index % 2:
+                self.assertTrue(isinstance(job.exception, Exception))
+                self.assertEqual(job.value, None)
+            else:
+                self.assertFalse(job.exception)
+
+    def test_imap_is_bounded(self):
+        from threading import Lock
+        lock, counters = Lock(), dict(running=0, max_running=0, fed=0)
+
+        def count(x):
+            with lock:
+                counters['running'] += 1
+                counters['max_running'] = max(
+                    counters['max_running'], counters['running'])
+            sleep(0.02)
+            with lock:
+                counters['running'] -= 1
+
+        def kwarg_gen():
+            for x in range(20):
+                counters['fed'] += 1
+                yield dict(x=x)
+
+        jobs = self.executor.imap(count, kwarg_gen())
+        for yielded, job in enumerate(jobs):
+            #  Jobs in flight: running, queued and the one being submitted
+            self.assertTrue(counters['fed'] - yielded <= 2 * 3 + 1)
+        self.assertEqual(counters['max_running'], 3)
+        self.assertEqual(counters['fed'], 20)
+
+        #  Without a queue, jobs are handed to the workers
+        from kamaki.clients import Executor
+        self.executor.shutdown(wait=True)
+        self.executor = Executor(3, 0)
+        counters.update(running=0, max_running=0, fed=0)
+        jobs = self.executor.imap(count, kwarg_gen())
+        for yielded, job in enumerate(jobs):
+            self.assertTrue(counters['fed'] - yielded <= 3 + 1)
+        self.assertEqual(counters['max_running'], 3)
+        self.assertEqual(counters['fed'], 20)
+
+    def test_imap_controlled(self):
+        from threading import Lock
+        from kamaki.clients import Executor, ConcurrencyController
+        lock, counters = Lock(), dict(running=0, max_running=0)
+        controller = ConcurrencyController(3, 2)
+
+        def count(data):
+            with lock:
+                counters['running'] += 1
+                counters['max_running'] = max(
+                    counters['max_running'], counters['running'])
+            sleep(0.01)
+            with lock:
+                counters['running'] -= 1
+        self.executor.shutdown(wait=True)
+        self.executor = Executor(3, controller=controller)
+        controller.limit = 2
+        controller._adapt = lambda: controller._new_window()
+        list(self.executor.imap(count, [dict(data='x')] * 12))
+        self.assertEqual(counters['max_running'], 2)
+        self.assertEqual(controller.running, 0)
+
+    def test_imap_interrupted(self):
+        kwarg_list = [dict(x=x, wait=0.02) for x in range(20)]
+        for job in self.executor.imap(self.square, kwarg_list):
+            break
+        self.assertTrue(self.executor.closed)
+        self.assertFalse(self.executor._workers)
+        self.assertRaises(AssertionError, self.executor.submit, self.square)
+
+    def test_shutdown(self):
+        for x in range(3):
+            self.executor.submit(self.square, x)
+        workers = list(self.executor._workers)
+        self.executor.shutdown(wait=True)
+        self.assertTrue(self.executor.closed)
+        self.assertFalse([w for w in workers if w.isAlive()])
+
+
+class ConcurrencyController(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import ConcurrencyController
+        self.CC = ConcurrencyController
+
+    def test___init__(self):
+        for faulty in (0, -1, 0.5, 'a string'):
+            self.assertRaises(AssertionError, self.CC, faulty)
+        self.assertEqual(self.CC(5).limit, 1)
+        self.assertEqual(self.CC(5, 3).limit, 3)
+        self.assertEqual(self.CC(5, 10).limit, 5)
+
+    def test_is_congestion(self):
+        from socket import timeout
+        from httplib import BadStatusLine
+        from kamaki.clients import ClientError as CE
+        cc = self.CC(4)
+        for error, expected in (
+                (CE('Bad Gateway', 502), True),
+                (CE('Service Unavailable', 503), True),
+                (CE('Gateway Timeout', 504), True),
+                (CE('Not Found', 404), False),
+                (CE('Unknown'), False),
+                (timeout('timed out'), True),
+                (BadStatusLine(''), True),
+                (AssertionError('Hashes do not match'), False)):
+            self.assertEqual(cc.is_congestion(error), expected)
+
+    @patch('kamaki.clients.time')
+    def test_release(self, time):
+        from kamaki.clients import ClientError as CE
+        clock = [0.0]
+        time.side_effect = lambda: clock[0]
+
+        def run_window(cc, bytes_per_job, seconds):
+            for i in range(cc.limit):
+                cc.acquire()
+            clock[0] += seconds
+            for i in range(cc.limit):
+                cc.release(bytes_per_job)
+
+        cc = self.CC(4)
+        #  Throughput improves, up to max_limit
+        for limit, expected in ((1, 2), (2, 3), (3, 4), (4, 4)):
+            self.assertEqual(cc.limit, limit)
+            run_window(cc, 100, 1.0)
+            self.assertEqual(cc.limit, expected)
+        self.assertEqual(cc.running, 0)
+
+        #  Throughput does not improve, the limit holds
+        run_window(cc, 100, 1.0)
+        self.assertEqual(cc.limit, 4)
+
+        #  Failures halve the limit, unless they are not about congestion
+        cc.acquire()
+        cc.release(error=CE('Not Found', 404))
+        self.assertEqual(cc.limit, 4)
+        for expected in (2, 1, 1):
+            cc.acquire()
+            cc.release(error=CE('Service Unavailable', 503))
+            self.assertEqual(cc.limit, expected)
+        self.assertEqual(cc.running, 0)
+
+        #  ... and the limit is probed upwards again
+        run_window(cc, 100, 1.0)
+        self.assertEqual(cc.limit, 2)
+
+    def test_acquire(self):
+        from threading import Thread
+        cc = self.CC(4, 2)
+        cc.acquire()
+        cc.acquire()
+        acquired = []
+        t = Thread(target=lambda: acquired.append(cc.acquire()))
+        t.start()
+        t.join(0.1)
+        self.assertFalse(acquired)
+        cc.release()
+        t.join(1)
+        self.assertEqual(acquired, [None])
+        self.assertEqual(cc.running, 2)
+
+
+class IterPages(TestCase):
+
+    names = ['o%03d' % i for i in range(25)]
+
+    def get_page(self, limit, marker):
+        self.calls.append((limit, marker))
+        names = [n for n in self.names if n > (marker or '')][:limit]
+        if marker in self.fail_after:
+            raise self.CE('Listing failed', status=500)
+        return [dict(name=n) for n in names]
+
+    def setUp(self):
+        from kamaki.clients import iter_pages, ClientError
+        self.iter_pages, self.CE = iter_pages, ClientError
+        self.calls, self.fail_after = [], []
+
+    def test_iter_pages(self):
+        objects = self.iter_pages(self.get_page, 10)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(next(objects), dict(name='o000'))
+        #  The second page is prefetched, before the first is consumed
+        sleep(0.1)
+        self.assertEqual(self.calls, [(10, None), (10, 'o009')])
+        self.assertEqual(
+            [o['name'] for o in objects], self.names[1:])
+        self.assertEqual(self.calls[2:], [(10, 'o019')])
+
+        self.calls = []
+        self.assertEqual([o['name'] for o in self.iter_pages(
+            self.get_page, 5, marker='o009', limit=12)], self.names[10:22])
+        self.assertEqual(
+            self.calls, [(5, 'o009'), (5, 'o014'), (2, 'o019')])
+
+        self.calls = []
+        self.assertEqual(list(self.iter_pages(self.get_page, 25)), [
+            dict(name=n) for n in self.names])
+        self.assertEqual(self.calls, [(25, None), (25, 'o024')])
+
+        self.fail_after = ['o009']
+        objects = self.iter_pages(self.get_page, 10)
+        self.assertEqual(len([next(objects) for i in range(10)]), 10)
+        self.assertRaises(self.CE, next, objects)
+
+    def test_abandoned(self):
+        objects = self.iter_pages(self.get_page, 10)
+        next(objects)
+        objects.close()
+        #  The prefetch is finished, before the listing is closed
+        self.assertEqual(len(self.calls), 2)
+
+
+class RetryPolicy(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import RetryPolicy as RP
+        self.RP = RP
+
+    def test_can_retry(self):
+        rp = self.RP()
+        for method in ('get', 'HEAD', 'put', 'delete'):
+            self.assertTrue(rp.can_retry(method))
+        for method in ('post', 'COPY', 'move'):
+            self.assertFalse(rp.can_retry(method))
+        self.assertTrue(rp.can_retry('post', idempotent=True))
+        self.assertFalse(rp.can_retry('get', idempotent=False))
+
+    def test_is_transient(self):
+        from httplib import BadStatusLine
+        from socket import error, timeout
+        from kamaki.clients import ClientError as CE, KamakiSSLError
+        rp = self.RP()
+        for e in (
+                CE('Service Unavailable', 503), CE('Internal', 500),
+                CE('HTTPResponse takes too long'), BadStatusLine(''),
+                error(104, 'Connection reset by peer'), timeout()):
+            self.assertTrue(rp.is_transient(e))
+        for e in (
+                CE('Not Found', 404), CE('Conflict', 409),
+                KamakiSSLError('SSL Connection error'), AssertionError()):
+            self.assertFalse(rp.is_transient(e))
+
+    def test_delay(self):
+        rp = self.RP(retries=10, backoff=0.5, max_backoff=4.0)
+        for attempt, limit in enumerate((0.5, 1.0, 2.0, 4.0, 4.0, 4.0)):
+            delays = [rp.delay(attempt) for i in range(50)]
+            self.assertTrue(all([0 <= d <= limit for d in delays]))
+            self.assertTrue(max(delays) > limit / 4)
+
+    def test_run(self):
+        from kamaki.clients import ClientError as CE
+        rp, calls = self.RP(retries=2, backoff=0.001), []
+
+        def method(failures, error, value):
+            calls.append(value)
+            if len(calls) <= failures:
+                raise error
+            return value
+
+        self.assertEqual(rp.run(method, 2, CE('Bad Gateway', 502), 'v'), 'v')
+        self.assertEqual(calls, ['v'] * 3)
+        for failures, error in (
+                (3, CE('Bad Gateway', 502)), (1, CE('Not Found', 404))):
+            calls = []
+            self.assertRaises(
+                CE, rp.run, method, failures, error, value='v')
+            self.assertEqual(len(calls), min(failures, 3))
+
+
 class FR(object):
     json = None
     text = None
@@ -309,49 +950,95 @@ class Client(TestCase):
         DATE_FORMATS = ['%a %b %d %H:%M:%S %Y']
         self.assertEqual(self.client.DATE_FORMATS, DATE_FORMATS)
 
-    def test__init_thread_limit(self):
-        exp = 'Nothing set here'
-        for faulty in (-1, 0.5, 'a string', {}):
-            self.assertRaises(
-                AssertionError,
-                self.client._init_thread_limit,
-                faulty)
-            self.assertEqual(exp, getattr(self.client, '_thread_limit', exp))
-            self.assertEqual(exp, getattr(self.client, '_elapsed_old', exp))
-            self.assertEqual(exp, getattr(self.client, '_elapsed_new', exp))
-        self.client._init_thread_limit(42)
-        self.assertEqual(42, self.client._thread_limit)
-        self.assertEqual(0.0, self.client._elapsed_old)
-        self.assertEqual(0.0, self.client._elapsed_new)
-
-    def test__watch_thread_limit(self):
-        waits = (
-            dict(args=((0.1, 1), (0.1, 2), (0.2, 1), (0.7, 1), (0.3, 2))),
-            dict(args=((1.0 - (i / 10.0), (i + 1)) for i in range(7))),
-            dict(max=1, args=tuple([(randint(1, 10) / 3.0, 1), ] * 10)),
-            dict(
-                limit=5,
-                args=tuple([
-                    (1.0 + (i / 10.0), (5 - i - 1)) for i in range(4)] + [
-                    (2.0, 1), (1.9, 2), (2.0, 1), (2.0, 2)])),
-            dict(args=tuple(
-                [(1.0 - (i / 10.0), (i + 1)) for i in range(7)] + [
-                (0.1, 7), (0.2, 6), (0.4, 5), (0.3, 6), (0.2, 7), (0.1, 7)])),)
-        for wait_dict in waits:
-            if 'max' in wait_dict:
-                self.client.MAX_THREADS = wait_dict['max']
-            else:
-                self.client.MAX_THREADS = 7
-            if 'limit' in wait_dict:
-                self.client._init_thread_limit(wait_dict['limit'])
-            else:
-                self.client._init_thread_limit()
-                self.client._watch_thread_limit(list())
-                self.assertEqual(1, self.client._thread_limit)
-            for wait, exp_limit in wait_dict['args']:
-                self.client._elapsed_new = wait
-                self.client._watch_thread_limit(list())
-                self.assertEqual(exp_limit, self.client._thread_limit)
+    def test_executor(self):
+        executor = self.client.executor
+        self.assertEqual(executor.size, 1)
+        self.assertEqual(executor, self.client.executor)
+        self.client.MAX_THREADS = 4
+        self.assertEqual(self.client.executor.size, 4)
+        self.assertTrue(executor.closed)
+        self.client.executor.shutdown()
+        self.assertFalse(self.client.executor.closed)
+        self.client.executor.shutdown()
+        from threading import Thread
+        executors = []
+        thread = Thread(target=lambda: executors.append(self.client.executor))
+        thread.start()
+        thread.join()
+        self.assertNotEqual(executors[0], self.client.executor)
+        executors[0].shutdown()
+        self.client.executor.shutdown()
+
+    def test_async_run(self):
+        self.client.MAX_THREADS = 3
+
+        def method(x, wait=0):
+            sleep(wait)
+            if x < 0:
+                raise self.CE('Negative %s' % x, status=x)
+            return x
+        kwarg_list = [dict(x=x, wait=0.01 * (5 - x)) for x in range(5)]
+        self.assertEqual(
+            self.client.async_run(method, kwarg_list), range(5))
+        kwarg_list.append(dict(x=-1))
+        self.assertRaises(self.CE, self.client.async_run, method, kwarg_list)
+        self.client.executor.shutdown()
+
+    @patch('kamaki.clients.Client.request')
+    def test_batch(self, request):
+        def perform(method, path, async_params={}, **kwargs):
+            sleep(0.01)
+            if path == 'fail':
+                raise self.CE('Failed %s' % path, status=404)
+            return (method, path, async_params, kwargs)
+        request.side_effect = perform
+        results, errors = self.client.batch(dict(
+            a=('get', 'p1'),
+            b=('head', 'p2', dict(k='v')),
+            c=('delete', 'fail'),
+            d=('put', 'p3', None, dict(success=201, async_params=dict(x=1)))),
+            max_threads=3)
+        self.assertEqual(results, dict(
+            a=('get', 'p1', {}, {}),
+            b=('head', 'p2', dict(k='v'), {}),
+            d=('put', 'p3', dict(x=1), dict(success=201))))
+        self.assertEqual(errors.keys(), ['c'])
+        self.assertEqual(errors['c'].status, 404)
+
+        results, errors = self.client.batch([('get', 'p%s' % i) for i in (
+            range(5))])
+        self.assertEqual(sorted(results), range(5))
+        self.assertEqual(results[3], ('get', 'p3', {}, {}))
+        self.assertEqual(errors, {})
+        self.assertEqual(self.client.batch([]), ({}, {}))
+
+    def test_per_thread_state(self):
+        from threading import Thread
+        self.client.set_header('main', 'v')
+        self.client.response_headers = ['Shared']
+        seen = dict()
+
+        def run(name):
+            seen[name] = (
+                dict(self.client.headers), self.client.response_headers)
+            self.client.set_header('h', name)
+            self.client.set_param('p', name)
+            self.client.response_headers = [name]
+            sleep(0.01)
+            seen[name] += (
+                dict(self.client.headers), dict(self.client.params),
+                self.client.response_headers)
+        threads = [Thread(target=run, args=(n, )) for n in ('t1', 't2')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for name in ('t1', 't2'):
+            self.assertEqual(seen[name], (
+                {}, ['Shared'], dict(h=name), dict(p=name), [name]))
+        self.assertEqual(self.client.headers, dict(main='v'))
+        self.assertEqual(self.client.params, dict())
+        self.assertEqual(self.client.response_headers, ['Shared'])
 
     @patch('kamaki.clients.Client.set_header')
     def test_set_header(self, SH):
@@ -373,6 +1060,43 @@ class Client(TestCase):
             self.assertEqual(
                 SP.mock_calls[-1], call(name, value, iff=condition))
 
+    @patch('kamaki.clients.RequestManager', return_value=FR)
+    @patch('kamaki.clients.ResponseManager')
+    def test_request_retries(self, Resp, Requ):
+        from kamaki.clients import RetryPolicy
+
+        def responses(*status_codes):
+            for status_code in status_codes:
+                r = FakeResp()
+                r.status_code, r.text = status_code, 'text'
+                r.close = lambda: None
+                yield r
+
+        self.client.retry_policy = RetryPolicy(retries=2, backoff=0.001)
+        for method, idempotent, statuses, tries in (
+                ('get', None, (503, 502, 200), 3),
+                ('get', None, (503, 503, 503), 3),
+                ('get', None, (404, 200), 1),
+                ('get', False, (503, 200), 1),
+                ('post', None, (503, 200), 1),
+                ('post', True, (500, 200), 2)):
+            Resp.reset_mock()
+            Resp.side_effect = responses(*statuses)
+            try:
+                r = self.client.request(
+                    method, '/path', idempotent=idempotent)
+                self.assertEqual(r.status_code, 200)
+            except self.CE as ce:
+                self.assertEqual(ce.status, statuses[tries - 1])
+            self.assertEqual(len(Resp.mock_calls), tries)
+
+        #  Requests which are not performed are not retried
+        Resp.reset_mock()
+        Resp.side_effect = responses(503, 200)
+        r = self.client.request('get', '/path', success=None)
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(len(Resp.mock_calls), 1)
+
     @patch('kamaki.clients.RequestManager', return_value=FR)
     @patch('kamaki.clients.ResponseManager', return_value=FakeResp())
     @patch('kamaki.clients.ResponseManager.__init__')
@@ -398,7 +1122,9 @@ class Client(TestCase):
             self.client.request(method, path, **kwargs)
             self.assertEqual(
                 RespInit.mock_calls[-1],
-                call(FR, connection_retry_limit=0, poolsize=None))
+                call(
+                    FR,
+                    connection_retry_limit=0, poolsize=1, stream=False))
 
     @patch('kamaki.clients.Client.request', return_value='lala')
     def _test_foo(self, foo, request):
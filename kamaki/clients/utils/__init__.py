@@ -31,6 +31,9 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
+import os
+import mmap
+import sqlite3
 import unicodedata
 
 
@@ -97,18 +100,102 @@ def path4url(*args):
 def readall(openfile, size, retries=7):
     """Read a file until size is reached"""
     remains = size if size > 0 else 0
-    buf = ''
+    bufs = []
     for i in range(retries):
         tmp_buf = openfile.read(remains)
         if tmp_buf:
-            buf += tmp_buf
+            bufs.append(tmp_buf)
             remains -= len(tmp_buf)
             if remains > 0:
                 continue
-        return buf
+        return bufs[0] if len(bufs) == 1 else ''.join(bufs)
     raise IOError('Failed to read %s bytes from file' % size)
 
 
+class BlockReader(object):
+    """Read blocks of a file at random offsets, without copying if possible
+
+    Regular files are memory mapped and blocks are read-only buffers on the
+    map, so hashing or sending them does not copy any data. Other files are
+    read into a new bytearray per block. Blocks must not be used after the
+    reader is closed. A mapped file must not shrink while it is being read.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj, self._map = fileobj, None
+        try:
+            if os.fstat(fileobj.fileno()).st_size:
+                self._map = mmap.mmap(
+                    fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError, mmap.error):
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        self.close()
+
+    def read(self, offset, size):
+        """:returns: (buffer) up to size bytes from offset, less at EOF"""
+        if self._map is not None:
+            return buffer(self._map, offset, max(size, 0))
+        self.fileobj.seek(offset)
+        if not hasattr(self.fileobj, 'readinto'):
+            return buffer(readall(self.fileobj, size))
+        block, length = bytearray(max(size, 0)), 0
+        while length < size:
+            n = self.fileobj.readinto(memoryview(block)[length:])
+            if not n:
+                break
+            length += n
+        return buffer(block, 0, length)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def write_private_file(path, content):
+    """Replace a file with content, so that only the owner can access it
+    The parent directory is created (also private) if it does not exist. The
+    new content is written in a temporary file first and then moved into
+    place, so that concurrent readers never see a partially written file.
+
+    :param path: (str) the file path
+
+    :param content: (str) the new file content
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0700)
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def open_private_db(path, timeout, *schema):
+    """Open an sqlite database only accessible by the user, creating it and
+    its tables if they do not exist"""
+    if not os.path.exists(path):
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0600))
+    db = sqlite3.connect(path, timeout=timeout)
+    for statement in schema:
+        db.execute(statement)
+    return db
+
+
 def escape_ctrl_chars(s):
     """Escape control characters from unicode and string objects."""
     if isinstance(s, unicode):
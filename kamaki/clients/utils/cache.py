@@ -0,0 +1,124 @@
+# Copyright 2015 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from contextlib import closing
+from hashlib import sha256
+from json import dumps, loads
+from time import time
+
+from kamaki.clients.utils import open_private_db
+
+
+class ResponseCache(object):
+    """A local cache of GET responses, in an sqlite database
+
+    Cached responses are revalidated with the server (If-None-Match,
+    If-Modified-Since), so that unchanged bodies are not transferred again.
+    Entries are keyed by the request URL and a hash of the token, since
+    responses depend on the user.
+    """
+
+    TIMEOUT = 30
+    MAX_CONTENT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path):
+        """:param path: (str) the database file, created if it does not exist
+        """
+        self.path = path
+
+    def _connect(self):
+        return open_private_db(
+            self.path, self.TIMEOUT,
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'url TEXT, auth TEXT, etag TEXT, last_modified TEXT, '
+            'status INTEGER, reason TEXT, headers TEXT, content BLOB, '
+            'stored REAL, PRIMARY KEY (url, auth))')
+
+    @staticmethod
+    def _auth(token):
+        return sha256(token or '').hexdigest()
+
+    def get(self, url, token):
+        """
+        :param url: (str) the full request URL
+
+        :param token: (str) the token of the request
+
+        :returns: (dict) with keys etag, last_modified, status, reason,
+            headers (list of (key, value)) and content, or None
+        """
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'SELECT etag, last_modified, status, reason, headers, content '
+                'FROM responses WHERE url = ? AND auth = ?',
+                (url, self._auth(token))).fetchone()
+        if row:
+            etag, last_modified, status, reason, headers, content = row
+            return dict(
+                etag=etag, last_modified=last_modified, status=status,
+                reason=reason, headers=[tuple(h) for h in loads(headers)],
+                content=str(content))
+        return None
+
+    def set(
+            self, url, token, etag, last_modified, status, reason, headers,
+            content):
+        """Add or replace the response of a URL
+
+        :param headers: (list of (key, value)) the raw response headers. The
+            content is stored decoded, so Content-Encoding is dropped and
+            Content-Length is set to the length of the content
+        """
+        decoded = []
+        for k, v in headers:
+            if k.lower() == 'content-length':
+                decoded.append((k, '%s' % len(content)))
+            elif k.lower() != 'content-encoding':
+                decoded.append((k, v))
+        with closing(self._connect()) as db:
+            with db:
+                db.execute(
+                    'INSERT OR REPLACE INTO responses VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        url, self._auth(token), etag, last_modified, status,
+                        reason, dumps(decoded), buffer(content), time()))
+
+    def remove(self, url=None):
+        """Remove the entries of a URL (for all tokens), or all entries"""
+        with closing(self._connect()) as db:
+            with db:
+                if url is None:
+                    db.execute('DELETE FROM responses')
+                else:
+                    db.execute('DELETE FROM responses WHERE url = ?', (url, ))
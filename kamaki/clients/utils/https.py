@@ -35,16 +35,108 @@ import logging
 import httplib
 import socket
 import ssl
-from objpool import http
+from threading import Lock
+from time import time
+from objpool import http, PoolLimitError
 
 log = logging.getLogger(__name__)
 
+POOL_SETTINGS = ('size', 'idle_timeout', 'max_lifetime')
+POOL_COUNTERS = (
+    'connections', 'reuses', 'handshake_time', 'waits', 'wait_time',
+    'expired')
+
+_pool_settings, _pool_stats, _lock = {None: dict()}, dict(), Lock()
+_ssl_contexts, _ssl_sessions = dict(), dict()
+
 
 class SSLUnicodeError(ssl.SSLError):
     """SSL module cannot handle unicode file names"""
 
 
-class HTTPSClientAuthConnection(httplib.HTTPSConnection):
+def get_ssl_context(ca_file, ignore_ssl=False, key_file=None, cert_file=None):
+    """An SSL context, shared by all connections with the same settings, so
+    that the CA certificates are loaded once
+
+    :returns: (ssl.SSLContext) or None if not supported (Python < 2.7.9)
+    """
+    if not hasattr(ssl, 'SSLContext'):
+        return None
+    key = (ca_file, ignore_ssl, key_file, cert_file)
+    with _lock:
+        context = _ssl_contexts.get(key)
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            if ignore_ssl:
+                context.verify_mode = ssl.CERT_NONE
+            else:
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(ca_file)
+            if cert_file:
+                context.load_cert_chain(cert_file, key_file)
+            _ssl_contexts[key] = context
+    return context
+
+
+def reset_ssl_cache():
+    """Forget the shared SSL contexts and the TLS sessions to resume"""
+    with _lock:
+        _ssl_contexts.clear()
+        _ssl_sessions.clear()
+
+
+class TimedConnectionMixin(object):
+    """Record the time spent on each new connection, in self.timings
+
+    timings: {'dns': seconds, 'connect': seconds[, 'tls': seconds]}
+
+    The connect timeout is self.timeout, as in httplib. If read_timeout is
+    set (None for no timeout), it applies to the socket once connected.
+    """
+
+    timings = None
+    read_timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+
+    def _timed_connection(
+            self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+            source_address=None):
+        """Like socket.create_connection, but times DNS and connect apart"""
+        host, port = address
+        start = time()
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolved = time()
+        self.timings = dict(dns=resolved - start)
+        last_error = None
+        for family, socktype, proto, canonname, sockaddr in addresses:
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                self.timings['connect'] = time() - resolved
+                if self.read_timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(self.read_timeout)
+                return sock
+            except socket.error as error:
+                last_error = error
+                if sock is not None:
+                    sock.close()
+        raise last_error or socket.error('getaddrinfo returns an empty list')
+
+
+class HTTPClientConnection(TimedConnectionMixin, httplib.HTTPConnection):
+    """HTTP connection, with connection timings"""
+
+    def __init__(self, *args, **kwargs):
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        self._create_connection = self._timed_connection
+
+
+class HTTPSClientAuthConnection(
+        TimedConnectionMixin, httplib.HTTPSConnection):
     """HTTPS connection, with full client-based SSL Authentication support"""
 
     ca_file, ignore_ssl = None, False
@@ -71,17 +163,34 @@ class HTTPSClientAuthConnection(httplib.HTTPSConnection):
         This is needed to pass cert_reqs=ssl.CERT_REQUIRED as parameter to
         ssl.wrap_socket(), which forces SSL to check server certificate against
         our client certificate.
+
+        If supported, sockets are wrapped with a shared SSL context instead,
+        and the last TLS session with the same host is resumed (Python 3.6+).
         """
         source_address = getattr(self, 'source_address', None)
         socket_args = [(self.host, self.port), self.timeout] + (
             [source_address, ] if source_address else [])
-        sock = socket.create_connection(*socket_args)
+        sock = self._timed_connection(*socket_args)
         if self._tunnel_host:
             self.sock = sock
             self._tunnel()
 
+        start = time()
         try:
-            if self.ignore_ssl:
+            context = get_ssl_context(
+                self.ca_file, self.ignore_ssl, self.key_file, self.cert_file)
+            if context:
+                kwargs = dict(
+                    server_hostname=self.host if ssl.HAS_SNI else None)
+                session_key = (id(context), self.host, self.port)
+                if hasattr(ssl, 'SSLSession'):
+                    kwargs['session'] = _ssl_sessions.get(session_key)
+                self.sock = context.wrap_socket(sock, **kwargs)
+                session = getattr(self.sock, 'session', None)
+                if session is not None:
+                    with _lock:
+                        _ssl_sessions[session_key] = session
+            elif self.ignore_ssl:
                 self.sock = ssl.wrap_socket(
                     sock, self.key_file, self.cert_file,
                     cert_reqs=ssl.CERT_NONE)
@@ -91,10 +200,163 @@ class HTTPSClientAuthConnection(httplib.HTTPSConnection):
                     ca_certs=self.ca_file, cert_reqs=ssl.CERT_REQUIRED)
         except UnicodeError as ue:
             raise SSLUnicodeError(0, SSLUnicodeError.__doc__, ue)
+        self.timings['tls'] = time() - start
 
 
+http.HTTPConnectionPool._scheme_to_class['http'] = HTTPClientConnection
 http.HTTPConnectionPool._scheme_to_class['https'] = HTTPSClientAuthConnection
-PooledHTTPConnection = http.PooledHTTPConnection
+
+
+def configure_pool(netloc=None, **settings):
+    """Set the connection pool settings of a host, or the default ones
+
+    :param netloc: (str) e.g., "example.com:443", None for all hosts
+
+    :param size: (int) the max number of connections to the host, in use or
+        idle. It only affects pools created afterwards. Pools grow to fit the
+        size clients request (Client.poolsize or MAX_THREADS)
+
+    :param idle_timeout: (float) seconds after which an idle connection is
+        closed instead of reused
+
+    :param max_lifetime: (float) seconds after which a connection is closed
+        instead of reused
+    """
+    for key, value in settings.items():
+        assert key in POOL_SETTINGS, 'Unknown pool setting %s' % key
+    with _lock:
+        netloc_settings = _pool_settings.setdefault(netloc, dict())
+        for key, value in settings.items():
+            if value is None:
+                netloc_settings.pop(key, None)
+            else:
+                netloc_settings[key] = value
+
+
+def get_pool_setting(netloc, key):
+    """:returns: the setting of a host, or the default one, or None"""
+    value = _pool_settings.get(netloc, {}).get(key)
+    return _pool_settings[None].get(key) if value is None else value
+
+
+def _count(netloc, **counters):
+    with _lock:
+        stats = _pool_stats.get(netloc)
+        if stats is None:
+            stats = _pool_stats[netloc] = dict.fromkeys(POOL_COUNTERS, 0)
+        for key, value in counters.items():
+            stats[key] += value
+
+
+def pool_stats(netloc=None):
+    """Connection counters, per host
+
+    - connections: new connections (TCP handshakes, and TLS for https)
+    - reuses: requests sent on a kept-alive connection
+    - handshake_time: seconds spent to open connections
+    - waits: requests that waited for a free connection slot
+    - wait_time: seconds spent waiting for free connection slots
+    - expired: connections closed for being idle or old for too long
+
+    :param netloc: (str) if given, return the counters of this host only
+
+    :returns: (dict) {netloc: {counter: value}} or {counter: value}
+    """
+    with _lock:
+        if netloc:
+            return dict(
+                _pool_stats.get(netloc, dict.fromkeys(POOL_COUNTERS, 0)))
+        return dict((k, dict(v)) for k, v in _pool_stats.items())
+
+
+def reset_pool_stats():
+    with _lock:
+        _pool_stats.clear()
+
+
+class HTTPConnectionPool(http.HTTPConnectionPool):
+    """Connection pool with expiration and usage counters"""
+
+    def _pool_create(self):
+        conn = super(HTTPConnectionPool, self)._pool_create()
+        conn._connected_at, conn._released_at = None, None
+        connect, netloc = conn.connect, self.netloc
+
+        def timed_connect():
+            start = time()
+            connect()
+            conn._connected_at = time()
+            _count(netloc, connections=1, handshake_time=(
+                conn._connected_at - start))
+
+        conn.connect = timed_connect
+        return conn
+
+    def _pool_verify(self, conn):
+        if not super(HTTPConnectionPool, self)._pool_verify(conn):
+            return False
+        if conn.sock is not None:
+            now = time()
+            idle_timeout = get_pool_setting(self.netloc, 'idle_timeout')
+            max_lifetime = get_pool_setting(self.netloc, 'max_lifetime')
+            if (idle_timeout is not None and conn._released_at and (
+                    now - conn._released_at > float(idle_timeout))) or (
+                    max_lifetime is not None and conn._connected_at and (
+                        now - conn._connected_at > float(max_lifetime))):
+                log.debug('Close expired connection to %s' % self.netloc)
+                conn.close()
+                _count(self.netloc, expired=1)
+        return True
+
+    def _pool_cleanup(self, conn):
+        conn._released_at = time()
+        return super(HTTPConnectionPool, self)._pool_cleanup(conn)
+
+    def pool_get(self, *args, **kwargs):
+        try:
+            conn = super(HTTPConnectionPool, self).pool_get(
+                *args, **dict(kwargs, blocking=False))
+        except PoolLimitError:
+            start = time()
+            conn = super(HTTPConnectionPool, self).pool_get(*args, **kwargs)
+            _count(self.netloc, waits=1, wait_time=time() - start)
+        if conn is not None and conn.sock is not None:
+            _count(self.netloc, reuses=1)
+        return conn
+
+    def grow(self, size):
+        """Allow up to size connections, if the pool is smaller"""
+        with self._mutex:
+            for i in range(size - self.size):
+                self._semaphore.release()
+            self.size = max(self.size, size)
+
+
+class PooledHTTPConnection(http.PooledHTTPConnection):
+    """A connection from a per-host pool, sized by configure_pool"""
+
+    _pools, _pools_mutex = dict(), Lock()
+
+    def get_pool(self):
+        kwargs = self._pool_kwargs
+        pool = kwargs.pop('pool', None)
+        if pool is not None:
+            return pool
+
+        scheme, netloc = kwargs['scheme'], kwargs['netloc']
+        size = int(kwargs.get('size') or 0)
+        key = (kwargs.get('pool_key', self._pool_key), scheme, netloc)
+        with self._pools_mutex:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool_size = max(size, int(get_pool_setting(
+                    netloc, 'size') or http.default_pool_size))
+                log.debug('Create pool of %s for %s' % (pool_size, key))
+                pool = HTTPConnectionPool(scheme, netloc, size=pool_size)
+                self._pools[key] = pool
+            elif pool.size < size:
+                pool.grow(size)
+        return pool
 
 
 def patch_with_certs(ca_file):
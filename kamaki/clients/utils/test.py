@@ -139,6 +139,50 @@ class Utils(TestCase):
             self.assertEqual(utils.readall(f, 1), '')
             self.assertRaises(IOError, utils.readall, f, 1, 0)
 
+    def test_BlockReader(self):
+        from StringIO import StringIO
+        tstr = '1234567890'
+        with TemporaryFile() as f:
+            f.write(tstr)
+            f.flush()
+            empty = TemporaryFile()
+            for fileobj, mapped in (
+                    (f, True), (empty, False), (StringIO(tstr), False)):
+                with utils.BlockReader(fileobj) as reader:
+                    self.assertEqual(reader._map is not None, mapped)
+                    for offset, size in product((0, 3, 9, 10, 12), (0, 4)):
+                        block = reader.read(offset, size)
+                        self.assertTrue(isinstance(block, buffer))
+                        self.assertEqual(
+                            str(block),
+                            tstr[offset:offset + size] if (
+                                fileobj is not empty) else '')
+                self.assertEqual(reader._map, None)
+            empty.close()
+
+            #  Not mapped, read into a bytearray
+            reader = utils.BlockReader(f)
+            reader.close()
+            self.assertEqual(str(reader.read(2, 5)), tstr[2:7])
+            self.assertEqual(str(reader.read(8, 5)), tstr[8:])
+
+    def test_write_private_file(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from os import path, stat, listdir
+        tmp_dir = mkdtemp()
+        try:
+            fpath = path.join(tmp_dir, 'private', 'file')
+            for content in ('some content', 'other content'):
+                utils.write_private_file(fpath, content)
+                with open(fpath) as f:
+                    self.assertEqual(f.read(), content)
+            self.assertEqual(stat(fpath).st_mode & 0777, 0600)
+            self.assertEqual(stat(path.dirname(fpath)).st_mode & 0777, 0700)
+            self.assertEqual(listdir(path.dirname(fpath)), ['file'])
+        finally:
+            rmtree(tmp_dir)
+
     def test_escape_ctrl_chars(self):
         gr_synnefo = u'\u03c3\u03cd\u03bd\u03bd\u03b5\u03c6\u03bf'
         gr_kamaki = u'\u03ba\u03b1\u03bc\u03ac\u03ba\u03b9'
@@ -157,7 +201,123 @@ class Utils(TestCase):
                 esc_str = word1 + esc_char + word2
                 self.assertEqual(utils.escape_ctrl_chars(orig_str), esc_str)
 
+    def test_https_pools(self):
+        from socket import socketpair
+        from threading import Thread
+        from time import time
+        from mock import patch
+        from kamaki.clients.utils import https
+        netloc = 'pool.example.com:80'
+        https.configure_pool(netloc, size=1, idle_timeout=10)
+        try:
+            pooled = https.PooledHTTPConnection(netloc, pool_key='test')
+            pool = pooled.get_pool()
+            self.assertEqual(pool.size, 1)
+            self.assertEqual(https.get_pool_setting(netloc, 'size'), 1)
+            self.assertEqual(https.get_pool_setting('other', 'size'), None)
+
+            with patch('httplib.HTTPConnection.connect') as connect:
+                conn = pool.pool_get()
+                conn.connect()
+            connect.assert_called_once_with()
+            stats = https.pool_stats(netloc)
+            self.assertEqual(stats['connections'], 1)
+            self.assertTrue(stats['handshake_time'] >= 0)
+
+            #  A second request waits for the connection to be released
+            conn.sock, peer = socketpair()
+            waiting = Thread(target=lambda: pool.pool_put(pool.pool_get()))
+            waiting.start()
+            waiting.join(0.1)
+            pool.pool_put(conn)
+            waiting.join()
+            stats = https.pool_stats(netloc)
+            self.assertEqual((stats['reuses'], stats['waits']), (1, 1))
+
+            #  Idle connections expire
+            conn._released_at = time() - 11
+            self.assertEqual(pool.pool_get(), conn)
+            self.assertEqual(conn.sock, None)
+            self.assertEqual(https.pool_stats(netloc)['expired'], 1)
+            pool.pool_put(conn)
+
+            #  Pools grow to the size clients ask for
+            https.PooledHTTPConnection(
+                netloc, size=3, pool_key='test').get_pool()
+            self.assertEqual(pool.size, 3)
+            self.assertTrue(netloc in https.pool_stats())
+        finally:
+            https.PooledHTTPConnection._pools.pop(('test', 'http', netloc))
+            https.configure_pool(netloc, size=None, idle_timeout=None)
+            https.reset_pool_stats()
+        self.assertEqual(https.pool_stats(), dict())
+
+    def test_get_ssl_context(self):
+        import ssl
+        from kamaki.clients.utils import https
+        if not hasattr(ssl, 'SSLContext'):
+            self.assertEqual(https.get_ssl_context('ca', True), None)
+            return
+        try:
+            context = https.get_ssl_context('ca', True)
+            self.assertEqual(context.verify_mode, ssl.CERT_NONE)
+            self.assertTrue(context is https.get_ssl_context('ca', True))
+            self.assertFalse(context is https.get_ssl_context('ca2', True))
+        finally:
+            https.reset_ssl_cache()
+        self.assertFalse(context is https.get_ssl_context('ca', True))
+        https.reset_ssl_cache()
+
+
+class ResponseCache(TestCase):
+
+    def setUp(self):
+        from tempfile import mkdtemp
+        from kamaki.clients.utils.cache import ResponseCache
+        self.tmpdir = mkdtemp()
+        self.db_path = '%s/cache/responses.db' % self.tmpdir
+        self.cache = ResponseCache(self.db_path)
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.tmpdir)
+
+    def test_get_set_remove(self):
+        from os import stat
+        url, headers = 'http://example.com/c?format=json', [('etag', '"e"')]
+        self.assertEqual(self.cache.get(url, 'token'), None)
+        self.cache.set(url, 'token', '"e"', None, 200, 'OK', headers, '[1]')
+        self.assertEqual(self.cache.get(url, 'token'), dict(
+            etag='"e"', last_modified=None, status=200, reason='OK',
+            headers=headers, content='[1]'))
+        self.assertEqual(self.cache.get(url, 'other token'), None)
+        self.assertEqual(stat(self.db_path).st_mode & 0777, 0600)
+        self.assertEqual(open(self.db_path).read().find('token'), -1)
+
+        #  Decoded content, e.g., of a gzipped response
+        self.cache.set(url, 'token', '"e"', None, 200, 'OK', [
+            ('content-encoding', 'gzip'), ('content-length', '23'),
+            ('etag', '"e"')], '[1, 2, 3]')
+        self.assertEqual(self.cache.get(url, 'token')['headers'], [
+            ('content-length', '9'), ('etag', '"e"')])
+
+        self.cache.set(url, 'token', None, 'Thu', 200, 'OK', [], '[2]')
+        self.cache.set(url, 'other token', '"f"', None, 200, 'OK', [], '[]')
+        self.assertEqual(self.cache.get(url, 'token')['content'], '[2]')
+        self.cache.remove(url)
+        self.assertEqual(self.cache.get(url, 'token'), None)
+        self.assertEqual(self.cache.get(url, 'other token'), None)
+
+
 if __name__ == '__main__':
     from sys import argv
     from kamaki.clients.test import runTestCase
-    runTestCase(Utils, 'clients.utils methods', argv[1:])
+    not_found = True
+    if not argv[1:] or argv[1] == 'Utils':
+        not_found = False
+        runTestCase(Utils, 'clients.utils methods', argv[2:])
+    if not argv[1:] or argv[1] == 'ResponseCache':
+        not_found = False
+        runTestCase(ResponseCache, 'Response Cache', argv[2:])
+    if not_found:
+        print('TestCase %s not found' % argv[1])